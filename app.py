@@ -1,10 +1,239 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
+from flask import Flask, render_template, request, jsonify, send_from_directory, g, has_request_context
+from flask import Response, stream_with_context
+import atexit
+import bisect
+import contextlib
+import gzip
+import hashlib
+import heapq
 import json
+import locale
+import logging
+import logging.handlers
+import math
+import mmap
+import multiprocessing
 import os
+import pickle
+import queue
+import random
 import re
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as TiempoAgotado
+from functools import lru_cache
+from itertools import islice
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 
+# Registro de la actividad por petición. Por defecto sólo avisos y errores; con
+# NIVEL_LOG=DEBUG se registra el detalle de cada búsqueda y comentario.
+NIVEL_LOG = os.environ.get('NIVEL_LOG', 'WARNING').upper()
+# Fracción de peticiones cuyo detalle (DEBUG) se registra: 0.01 = una de cada cien
+MUESTREO_LOG = float(os.environ.get('MUESTREO_LOG', '1.0'))
+# 'texto' para lectura humana o 'json' (una línea por evento) para agregadores
+FORMATO_LOG = os.environ.get('FORMATO_LOG', 'texto')
+
+logger = logging.getLogger('biblia')
+
+class FormatoJSON(logging.Formatter):
+    """Formatea cada evento como una línea JSON con los campos pasados en extra={'campos': ...}"""
+    def format(self, record):
+        evento = {
+            'ts': self.formatTime(record),
+            'nivel': record.levelname,
+            'mensaje': record.getMessage()
+        }
+        evento.update(getattr(record, 'campos', {}))
+        if record.exc_info:
+            evento['excepcion'] = self.formatException(record.exc_info)
+        return json.dumps(evento, ensure_ascii=False, default=str)
+
+class FiltroMuestreo(logging.Filter):
+    """Deja pasar todos los avisos y errores, y el detalle sólo de las peticiones muestreadas"""
+    def filter(self, record):
+        if record.levelno >= logging.INFO or MUESTREO_LOG >= 1:
+            return True
+        if not has_request_context():
+            return random.random() < MUESTREO_LOG
+        # La decisión se toma una vez por petición para no registrar trazas a medias
+        if 'log_muestreado' not in g:
+            g.log_muestreado = random.random() < MUESTREO_LOG
+        return g.log_muestreado
+
+def configurar_logging():
+    """Envía los eventos a una cola que un hilo aparte escribe en stdout
+    
+    Así una petición nunca espera a que se escriba su línea de log. Se vuelve a
+    llamar en cada proceso hijo (workers de gunicorn) porque el hilo no sobrevive al fork.
+    """
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(FormatoJSON() if FORMATO_LOG == 'json' else
+                        logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    
+    cola = queue.SimpleQueue()
+    manejador = logging.handlers.QueueHandler(cola)
+    manejador.addFilter(FiltroMuestreo())
+    
+    for anterior in list(logger.handlers):
+        logger.removeHandler(anterior)
+    logger.addHandler(manejador)
+    logger.setLevel(getattr(logging, NIVEL_LOG, logging.WARNING))
+    logger.propagate = False
+    
+    listener = logging.handlers.QueueListener(cola, salida)
+    listener.start()
+    atexit.register(listener.stop)
+
+configurar_logging()
+if hasattr(os, 'register_at_fork'):  # no existe en Windows
+    os.register_at_fork(after_in_child=configurar_logging)
+
+# Métricas por proceso, expuestas en /metrics con el formato de texto de Prometheus.
+# Con varios workers cada uno tiene las suyas: Prometheus debe consultar cada
+# worker o un único proceso (asgi.py).
+LIMITES_HISTOGRAMA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# (nombre, etiquetas) -> valor; en los histogramas [cuentas por límite, suma, total]
+CONTADORES = Counter()
+HISTOGRAMAS = {}
+DESCRIPCIONES_METRICAS = {
+    'biblia_peticiones_total': ('counter', 'Peticiones atendidas por ruta, método y estado'),
+    'biblia_peticion_segundos': ('histogram', 'Duración de las peticiones por ruta'),
+    'biblia_fase_segundos': ('histogram', 'Duración de cada fase dentro de una petición'),
+    'biblia_cache_aciertos_total': ('counter', 'Aciertos de cada caché'),
+    'biblia_cache_fallos_total': ('counter', 'Fallos de cada caché'),
+    'biblia_recargas_total': ('counter', 'Recargas en caliente de archivos de datos'),
+    'biblia_busquedas_compartidas_total': ('counter', 'Búsquedas servidas con el cálculo de otra petición igual'),
+    'biblia_busquedas_rechazadas_total': ('counter', 'Búsquedas rechazadas por el control de admisión'),
+}
+_lock_metricas = threading.Lock()
+
+def contar(nombre, cantidad=1, **etiquetas):
+    """Incrementa un contador"""
+    with _lock_metricas:
+        CONTADORES[(nombre, tuple(sorted(etiquetas.items())))] += cantidad
+
+def observar(nombre, segundos, **etiquetas):
+    """Registra una duración en un histograma"""
+    clave = (nombre, tuple(sorted(etiquetas.items())))
+    with _lock_metricas:
+        histograma = HISTOGRAMAS.get(clave)
+        if histograma is None:
+            histograma = HISTOGRAMAS[clave] = [[0] * len(LIMITES_HISTOGRAMA), 0.0, 0]
+        posicion = bisect.bisect_left(LIMITES_HISTOGRAMA, segundos)
+        if posicion < len(LIMITES_HISTOGRAMA):
+            histograma[0][posicion] += 1
+        histograma[1] += segundos
+        histograma[2] += 1
+
+def contar_cache(cache, acierto):
+    contar('biblia_cache_aciertos_total' if acierto else 'biblia_cache_fallos_total', cache=cache)
+
+@contextlib.contextmanager
+def fase(nombre):
+    """Mide una fase de la petición en curso: with fase('serializar'): ..."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        ruta = (request.endpoint or '-') if has_request_context() else '-'
+        observar('biblia_fase_segundos', time.perf_counter() - inicio, ruta=ruta, fase=nombre)
+
+@app.before_request
+def iniciar_medicion():
+    g.inicio_peticion = time.perf_counter()
+
+# Registrado antes que cualquier otro after_request, así que se ejecuta el último
+# y la duración incluye la compresión
+@app.after_request
+def registrar_medicion(respuesta):
+    if request.environ.get(FUERA_DE_CACHE):
+        # asgi.py repite la petición en su pool de hilos: se mide allí
+        return respuesta
+    ruta = request.endpoint or 'desconocida'
+    if 'inicio_peticion' in g:
+        observar('biblia_peticion_segundos', time.perf_counter() - g.inicio_peticion, ruta=ruta)
+    contar('biblia_peticiones_total', ruta=ruta, metodo=request.method, estado=str(respuesta.status_code))
+    return respuesta
+
+def _etiquetas_prometheus(etiquetas):
+    if not etiquetas:
+        return ''
+    pares = []
+    for clave, valor in etiquetas:
+        valor = str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pares.append(f'{clave}="{valor}"')
+    return '{' + ','.join(pares) + '}'
+
+def texto_metricas():
+    """Todas las métricas en el formato de texto de Prometheus"""
+    with _lock_metricas:
+        contadores = dict(CONTADORES)
+        histogramas = {clave: (list(h[0]), h[1], h[2]) for clave, h in HISTOGRAMAS.items()}
+    
+    # Cachés con su propia contabilidad (lru_cache)
+    for cache, funcion in CACHES_LRU.items():
+        informacion = funcion.cache_info()
+        contadores[('biblia_cache_aciertos_total', (('cache', cache),))] = informacion.hits
+        contadores[('biblia_cache_fallos_total', (('cache', cache),))] = informacion.misses
+    
+    lineas = []
+    for nombre, (tipo, descripcion) in DESCRIPCIONES_METRICAS.items():
+        lineas.append(f'# HELP {nombre} {descripcion}')
+        lineas.append(f'# TYPE {nombre} {tipo}')
+        if tipo == 'counter':
+            for (metrica, etiquetas), valor in sorted(contadores.items()):
+                if metrica == nombre:
+                    lineas.append(f'{nombre}{_etiquetas_prometheus(etiquetas)} {valor}')
+            continue
+        for (metrica, etiquetas), (cuentas, suma, total) in sorted(histogramas.items()):
+            if metrica != nombre:
+                continue
+            acumulado = 0
+            for limite, cuenta in zip(LIMITES_HISTOGRAMA, cuentas):
+                acumulado += cuenta
+                lineas.append(f'{nombre}_bucket{_etiquetas_prometheus(etiquetas + (("le", limite),))} {acumulado}')
+            lineas.append(f'{nombre}_bucket{_etiquetas_prometheus(etiquetas + (("le", "+Inf"),))} {total}')
+            lineas.append(f'{nombre}_sum{_etiquetas_prometheus(etiquetas)} {suma}')
+            lineas.append(f'{nombre}_count{_etiquetas_prometheus(etiquetas)} {total}')
+    return '\n'.join(lineas) + '\n'
+
+# Perfilador por muestreo, sólo con PERFILADOR=1: POST /perfil empieza a muestrear
+# las pilas de todos los hilos del worker y GET /perfil devuelve las más frecuentes
+PERFILADOR = os.environ.get('PERFILADOR', '0') == '1'
+PERFIL = {'muestras': Counter(), 'activo': False, 'segundos': 0, 'intervalo': 0}
+_lock_perfil = threading.Lock()
+
+def _muestrear_pilas(segundos, intervalo):
+    """Cuenta cada pila (formato plegado de flamegraph.pl) de los demás hilos"""
+    propio = threading.get_ident()
+    fin = time.monotonic() + segundos
+    muestras = Counter()
+    while time.monotonic() < fin:
+        for hilo, marco in sys._current_frames().items():
+            if hilo == propio:
+                continue
+            pila = []
+            while marco is not None:
+                codigo = marco.f_code
+                pila.append(f"{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{marco.f_lineno})")
+                marco = marco.f_back
+            muestras[';'.join(reversed(pila))] += 1
+        time.sleep(intervalo)
+    with _lock_perfil:
+        PERFIL['muestras'] = muestras
+        PERFIL['activo'] = False
+
 # Orden correcto de los libros de la Biblia Reina Valera 1960
 ORDEN_LIBROS = {
     "Antiguo Testamento": [
@@ -24,6 +253,8 @@ ORDEN_LIBROS = {
 
 # Lista plana de todos los libros para búsqueda
 TODOS_LIBROS = ORDEN_LIBROS["Antiguo Testamento"] + ORDEN_LIBROS["Nuevo Testamento"]
+# Posición de cada libro en el orden canónico
+POSICIONES_LIBROS = {libro: posicion for posicion, libro in enumerate(TODOS_LIBROS)}
 
 # Mapeo de nombres alternativos para coincidencias flexibles
 MAPEO_LIBROS = {
@@ -119,11 +350,157 @@ MAPEO_LIBROS = {
     "salmo": "Salmos"
 }
 
+# Abreviaturas habituales (sin acentos ni puntos) de cada libro
+ABREVIATURAS_LIBROS = {
+    # Antiguo Testamento
+    "gn": "Génesis", "gen": "Génesis",
+    "ex": "Éxodo", "exo": "Éxodo", "exod": "Éxodo",
+    "lv": "Levítico", "lev": "Levítico",
+    "nm": "Números", "num": "Números",
+    "dt": "Deuteronomio", "deut": "Deuteronomio",
+    "jos": "Josué",
+    "jue": "Jueces", "jc": "Jueces",
+    "rt": "Rut",
+    "1 s": "1 Samuel", "1 sa": "1 Samuel", "1 sam": "1 Samuel",
+    "2 s": "2 Samuel", "2 sa": "2 Samuel", "2 sam": "2 Samuel",
+    "1 r": "1 Reyes", "1 re": "1 Reyes", "1 rey": "1 Reyes",
+    "2 r": "2 Reyes", "2 re": "2 Reyes", "2 rey": "2 Reyes",
+    "1 cr": "1 Crónicas", "1 cro": "1 Crónicas", "1 cron": "1 Crónicas",
+    "2 cr": "2 Crónicas", "2 cro": "2 Crónicas", "2 cron": "2 Crónicas",
+    "esd": "Esdras",
+    "neh": "Nehemías",
+    "est": "Ester",
+    "jb": "Job",
+    "sal": "Salmos", "sl": "Salmos",
+    "pr": "Proverbios", "pro": "Proverbios", "prov": "Proverbios",
+    "ec": "Eclesiastés", "ecl": "Eclesiastés", "ecles": "Eclesiastés",
+    "cnt": "Cantares", "cant": "Cantares",
+    "is": "Isaías", "isa": "Isaías",
+    "jr": "Jeremías", "jer": "Jeremías",
+    "lm": "Lamentaciones", "lam": "Lamentaciones",
+    "ez": "Ezequiel", "eze": "Ezequiel", "ezeq": "Ezequiel",
+    "dn": "Daniel", "dan": "Daniel",
+    "os": "Oseas",
+    "jl": "Joel",
+    "am": "Amós",
+    "abd": "Abdías",
+    "jon": "Jonás",
+    "mi": "Miqueas", "miq": "Miqueas",
+    "nah": "Nahum",
+    "hab": "Habacuc",
+    "sof": "Sofonías",
+    "hag": "Hageo",
+    "zac": "Zacarías",
+    "mal": "Malaquías",
+    
+    # Nuevo Testamento
+    "mt": "Mateo", "mat": "Mateo",
+    "mr": "Marcos", "mc": "Marcos", "mar": "Marcos",
+    "lc": "Lucas", "luc": "Lucas",
+    "jn": "Juan",
+    "hch": "Hechos", "hech": "Hechos",
+    "ro": "Romanos", "rom": "Romanos",
+    "1 co": "1 Corintios", "1 cor": "1 Corintios",
+    "2 co": "2 Corintios", "2 cor": "2 Corintios",
+    "ga": "Gálatas", "gal": "Gálatas",
+    "ef": "Efesios", "efe": "Efesios",
+    "fil": "Filipenses", "flp": "Filipenses",
+    "col": "Colosenses",
+    "1 ts": "1 Tesalonicenses", "1 tes": "1 Tesalonicenses",
+    "2 ts": "2 Tesalonicenses", "2 tes": "2 Tesalonicenses",
+    "1 ti": "1 Timoteo", "1 tim": "1 Timoteo",
+    "2 ti": "2 Timoteo", "2 tim": "2 Timoteo",
+    "tit": "Tito",
+    "flm": "Filemón",
+    "he": "Hebreos", "heb": "Hebreos",
+    "stg": "Santiago", "sant": "Santiago",
+    "1 p": "1 Pedro", "1 pe": "1 Pedro", "1 ped": "1 Pedro",
+    "2 p": "2 Pedro", "2 pe": "2 Pedro", "2 ped": "2 Pedro",
+    "1 jn": "1 Juan",
+    "2 jn": "2 Juan",
+    "3 jn": "3 Juan",
+    "jud": "Judas",
+    "ap": "Apocalipsis", "apoc": "Apocalipsis"
+}
+
+def _plegar_lento(texto):
+    descompuesto = unicodedata.normalize('NFD', texto)
+    return ''.join(c for c in descompuesto if not unicodedata.combining(c))
+
+# Letras latinas con tilde, diéresis, etc. -> su letra base, para plegar con str.translate
+_TABLA_PLEGADO = {codigo: _plegar_lento(chr(codigo)) for codigo in range(0xC0, 0x250)
+                  if _plegar_lento(chr(codigo)) != chr(codigo)}
+
+def plegar_acentos(texto):
+    """Convierte a minúsculas y elimina tildes y diéresis (Jesús -> jesus)"""
+    plegado = texto.lower().translate(_TABLA_PLEGADO)
+    # Sólo los caracteres fuera del alfabeto latino necesitan la descomposición Unicode
+    if not plegado or max(plegado) < '\u0250':
+        return plegado
+    return _plegar_lento(plegado)
+
+def clave_libro(nombre):
+    """Forma de comparación de un nombre de libro: "S. Juan", "JUAN" y "juan." dan "juan"""
+    clave = plegar_acentos(nombre.strip())
+    clave = re.sub(r'^(s\.\s*|(san|santa|santo)\s+)', '', clave)
+    clave = clave.replace('.', ' ')
+    # "1co" y "1 co" son la misma abreviatura
+    clave = re.sub(r'^(\d)\s*', r'\1 ', clave)
+    return ' '.join(clave.split())
+
+def construir_indice_nombres_libros():
+    """Mapea cada forma aceptada (nombre, alias, abreviatura) a su libro canónico"""
+    indice = {}
+    for alias, libro in list(ABREVIATURAS_LIBROS.items()) + list(MAPEO_LIBROS.items()):
+        indice[clave_libro(alias)] = libro
+    # Los nombres canónicos tienen prioridad sobre cualquier alias
+    for libro in TODOS_LIBROS:
+        indice[clave_libro(libro)] = libro
+    return indice
+
+INDICE_NOMBRES_LIBROS = construir_indice_nombres_libros()
+
+@lru_cache(maxsize=4096)
+def resolver_libro(nombre):
+    """Devuelve el libro canónico para cualquier forma aceptada del nombre, o None"""
+    if not nombre:
+        return None
+    return INDICE_NOMBRES_LIBROS.get(clave_libro(nombre))
+
+# Claves de INDICE_NOMBRES_LIBROS en orden, para completar nombres por bisección
+CLAVES_LIBROS = tuple(sorted(INDICE_NOMBRES_LIBROS))
+
+def libros_por_prefijo(prefijo, disponibles=None):
+    """Libros canónicos con algún nombre, alias o abreviatura que empieza por prefijo
+    
+    Primero el libro que ya nombra el prefijo completo ("Jn" -> Juan) y después
+    los demás en el orden canónico. disponibles (un contenedor de libros) deja
+    sólo los que están en él.
+    """
+    clave = clave_libro(prefijo)
+    if not clave:
+        return []
+    # "II Co" es "2 Co"
+    clave = re.sub(r'^(i{1,3}) ', lambda match: NUMEROS_ROMANOS[match.group(1).upper()] + ' ', clave)
+    inicio = bisect.bisect_left(CLAVES_LIBROS, clave)
+    fin = bisect.bisect_left(CLAVES_LIBROS, clave + '\U0010ffff', inicio)
+    exacto = INDICE_NOMBRES_LIBROS.get(clave)
+    libros = {INDICE_NOMBRES_LIBROS[c] for c in CLAVES_LIBROS[inicio:fin]}
+    if disponibles is not None:
+        libros = {libro for libro in libros if libro in disponibles}
+    return sorted(libros, key=lambda libro: (libro != exacto, POSICIONES_LIBROS.get(libro, len(TODOS_LIBROS))))
+
+@lru_cache(maxsize=4096)
 def normalizar_nombre_libro(nombre):
     """Normaliza el nombre del libro para coincidencias consistentes"""
     if not nombre:
         return ""
     
+    # Buscar en el índice de nombres, alias y abreviaturas
+    libro = resolver_libro(nombre)
+    if libro:
+        return libro
+    
     nombre = nombre.strip()
     
     # Limpiar prefijos comunes (S., San, etc.)
@@ -134,11 +511,7 @@ def normalizar_nombre_libro(nombre):
     # Convertir a minúsculas para comparación
     nombre_lower = nombre.lower()
     
-    # Buscar en el mapeo primero
-    if nombre_lower in MAPEO_LIBROS:
-        return MAPEO_LIBROS[nombre_lower]
-    
-    # Si no está en el mapeo, capitalizar normalmente
+    # Si no es un libro conocido, capitalizar normalmente
     nombre_normalizado = ' '.join(word.capitalize() for word in nombre_lower.split())
     
     return nombre_normalizado
@@ -171,7 +544,8 @@ def ordenar_capitulos_versiculos(data):
         capitulos_numericos.sort()
         capitulos_no_numericos.sort()
         
-        capitulos_ordenados_lista = [str(cap) for cap in capitulos_numericos] + capitulos_no_numericos
+        # Las claves se comparten entre capítulos y libros ("1", "2"...): una cadena por número
+        capitulos_ordenados_lista = [sys.intern(str(cap)) for cap in capitulos_numericos] + capitulos_no_numericos
         
         for capitulo in capitulos_ordenados_lista:
             if capitulo in data and es_diccionario_valido(data[capitulo]):
@@ -191,7 +565,8 @@ def ordenar_capitulos_versiculos(data):
                 versiculos_numericos.sort()
                 versiculos_no_numericos.sort()
                 
-                versiculos_ordenados_lista = [str(vers) for vers in versiculos_numericos] + versiculos_no_numericos
+                versiculos_ordenados_lista = ([sys.intern(str(vers)) for vers in versiculos_numericos]
+                                              + versiculos_no_numericos)
                 
                 for versiculo in versiculos_ordenados_lista:
                     if versiculo in data[capitulo]:
@@ -352,6 +727,45 @@ def cargar_comentarios_cba():
     
     return comentarios_cba
 
+def fusionar_capitulos(destino, capitulos):
+    """Añade a destino los capítulos y versículos que aún no tenga"""
+    for capitulo, versiculos in capitulos.items():
+        if isinstance(versiculos, dict):
+            destino_capitulo = destino.setdefault(str(capitulo), {})
+            for versiculo, textos in versiculos.items():
+                destino_capitulo.setdefault(versiculo, textos)
+    return destino
+
+def cargar_comentarios_cba2():
+    """Cargar los comentarios de data/cba2.json (libro -> capítulo -> versículo -> [textos])
+    
+    El archivo se extrajo de un PDF y algunas claves no son libros sino restos del
+    texto ("(CTBH 7).", "SALMO 1"...). Los capítulos bajo esas claves continúan
+    el último libro reconocido.
+    """
+    comentarios_cba2 = {}
+    try:
+        print("Cargando comentarios CBA 2...")
+        archivo_cba2 = 'data/cba2.json'
+        if os.path.exists(archivo_cba2):
+            with open(archivo_cba2, 'r', encoding='utf-8') as f:
+                cba2_data = json.load(f)
+            
+            ultimo_libro = None
+            for clave, capitulos in cba2_data.items():
+                ultimo_libro = resolver_libro(clave) or ultimo_libro
+                if ultimo_libro and isinstance(capitulos, dict) and capitulos:
+                    fusionar_capitulos(comentarios_cba2.setdefault(ultimo_libro, {}), capitulos)
+            
+            print(f"✅ Comentarios CBA 2 cargados: {len(comentarios_cba2)} libros")
+        else:
+            print("⚠️  Archivo data/cba2.json no encontrado")
+            
+    except Exception as e:
+        print(f"❌ Error cargando comentarios CBA 2: {e}")
+    
+    return comentarios_cba2
+
 def cargar_cba_append():
     """Cargar el archivo de apéndices CBA"""
     try:
@@ -401,344 +815,2844 @@ def procesar_referencias(referencia_completa):
     
     return referencias
 
+def versiculos_de_referencia(vers_ref):
+    """Devuelve los versículos que cubre una clave de comentario: 5 o un rango 1-3"""
+    vers_ref = str(vers_ref)
+    if '-' in vers_ref:
+        try:
+            inicio, fin = map(int, vers_ref.split('-'))
+        except ValueError:
+            return []
+        return [str(v) for v in range(inicio, fin + 1)]
+    return [vers_ref]
+
+# Capítulo y versículos de una cita: "3:16", "3:1-5, 8", "1:1-2:3"...
+PATRON_CITA_VERSICULOS = re.compile(r'(\d+)\s*:\s*(\d[\d\s,:\-–]*)')
+# Cita de capítulos enteros: "Salmos 23", "Éxodo 20-24."
+PATRON_CITA_CAPITULOS = re.compile(r'^(.*?\D)\s*(\d+)(?:\s*[-–]\s*(\d+))?\s*\.?\s*$')
+# Palabras que, en lugar del libro, remiten al libro del propio comentario ("Cap. 2: 18")
+PALABRAS_MISMO_LIBRO = {'cap', 'capitulo', 'vers', 'v', 'vs'}
+# Número de los libros numerados escrito en romanos ("I Crón. 27:32")
+NUMEROS_ROMANOS = {'I': '1', 'II': '2', 'III': '3'}
+
+def libro_de_cita(nombre, libro_actual=None):
+    """Libro canónico del texto que precede al capítulo de una cita, o None
+
+    Sin nombre (o con "Cap.") la cita es del libro del comentario. Algunas
+    referencias arrastran el libro anterior delante de uno numerado ("Efesios 1
+    Pedro"): se prueba quitando palabras por la izquierda.
+    """
+    palabras = [NUMEROS_ROMANOS.get(palabra, palabra) for palabra in nombre.split()]
+    if not palabras or plegar_acentos(palabras[0].lower()).rstrip('.') in PALABRAS_MISMO_LIBRO:
+        return libro_actual
+    for inicio in range(len(palabras)):
+        libro = resolver_libro(' '.join(palabras[inicio:]))
+        if libro:
+            return libro
+    return None
+
+def _versiculos_capitulo(biblia, libro, capitulo):
+    """Números de versículo de un capítulo de la Biblia, en orden ([] si no existe)"""
+    versiculos = biblia.get(libro, {}).get(str(capitulo))
+    if not isinstance(versiculos, dict):
+        return []
+    return sorted(int(v) for v in versiculos if v.isdigit())
+
+def _punto_cita(texto, capitulo):
+    """(capítulo, versículo) de "16" o "2:3" dentro de una cita, o None"""
+    capitulo_texto, _, versiculo = texto.rpartition(':')
+    capitulo_texto, versiculo = capitulo_texto.strip(), versiculo.strip()
+    if not versiculo.isdigit() or (capitulo_texto and not capitulo_texto.isdigit()):
+        return None
+    return (int(capitulo_texto) if capitulo_texto else capitulo, int(versiculo))
+
+def claves_cita(referencia, biblia, libro_actual=None):
+    """Versículos (libro, capítulo, versículo) que cita una referencia de comentario
+
+    Acepta las formas de referencias_separadas: "Juan 3:16", "Juan 3:16-18, 21",
+    "Génesis 1:1-2:3", capítulos enteros ("Salmos 23", "Éxodo 20-24") y colas que
+    no son versículos ("Hechos 2:38, t. II, pág. 12"). Sólo se devuelven los
+    versículos que existen en biblia; [] si la referencia no se reconoce.
+    """
+    match = PATRON_CITA_VERSICULOS.search(referencia)
+    if match:
+        libro = libro_de_cita(referencia[:match.start()], libro_actual)
+        tramos = []
+        capitulo = int(match.group(1))
+        for parte in match.group(2).split(','):
+            inicio, _, fin = parte.replace('–', '-').partition('-')
+            desde = _punto_cita(inicio, capitulo)
+            if desde is None:
+                continue
+            hasta = _punto_cita(fin, desde[0]) if fin.strip() else desde
+            if hasta is None or hasta < desde:
+                continue
+            tramos.append((desde, hasta))
+            capitulo = hasta[0]
+    else:
+        match = PATRON_CITA_CAPITULOS.match(referencia)
+        if not match:
+            return []
+        libro = libro_de_cita(match.group(1), libro_actual)
+        primero = int(match.group(2))
+        ultimo = int(match.group(3) or primero)
+        tramos = [((primero, 0), (ultimo, float('inf')))] if ultimo >= primero else []
+
+    if not libro:
+        return []
+    claves = []
+    for (capitulo_inicio, versiculo_inicio), (capitulo_fin, versiculo_fin) in tramos:
+        for capitulo in range(capitulo_inicio, capitulo_fin + 1):
+            for versiculo in _versiculos_capitulo(biblia, libro, capitulo):
+                if (capitulo, versiculo) < (capitulo_inicio, versiculo_inicio):
+                    continue
+                if (capitulo, versiculo) > (capitulo_fin, versiculo_fin):
+                    break
+                claves.append((libro, str(capitulo), str(versiculo)))
+    return claves
+
+def compilar_comentarios_principales(capitulos):
+    """Entradas (capítulo, versículo) -> comentario de un libro de data/comment/
+    
+    Dentro de un capítulo gana la primera entrada que cubre el versículo, como en
+    la búsqueda lineal original.
+    """
+    tabla = {}
+    for comentario_capitulo in capitulos:
+        capitulo = str(comentario_capitulo.get('capitulo'))
+        asignados = set()
+        
+        for comentario_versiculo in comentario_capitulo.get('versiculos', []):
+            vers_ref = str(comentario_versiculo.get('versiculo', ''))
+            referencia = comentario_versiculo.get('referencia', '')
+            entrada = {
+                'versiculo': vers_ref,
+                'comentario': comentario_versiculo.get('comentario', ''),
+                'encontrado': True,
+                'referencia': referencia,
+                'referencias_separadas': procesar_referencias(referencia) if referencia else []
+            }
+            for versiculo in versiculos_de_referencia(vers_ref):
+                if versiculo not in asignados:
+                    asignados.add(versiculo)
+                    tabla[(capitulo, versiculo)] = entrada
+    return tabla
+
+def compilar_comentarios_cba(capitulos):
+    """Entradas (capítulo, versículo) -> comentario de un libro de data/cba.json"""
+    tabla = {}
+    for capitulo, versiculos_cba in capitulos.items():
+        if not isinstance(versiculos_cba, dict):
+            continue
+            
+        for versiculo_ref, datos_versiculo in versiculos_cba.items():
+            if not isinstance(datos_versiculo, dict):
+                continue
+                
+            comentarios_lista = datos_versiculo.get('comentarios', [])
+            referencias_cba = []
+            for ref in datos_versiculo.get('referencias_cruzadas', []):
+                if ref and str(ref).strip():
+                    referencias_cba.extend(procesar_referencias(str(ref)))
+            entrada = {
+                'versiculo': versiculo_ref,
+                'comentario': " ".join(str(c) for c in comentarios_lista) if comentarios_lista else "",
+                'encontrado': bool(comentarios_lista),
+                'referencias_separadas': referencias_cba
+            }
+            for versiculo in versiculos_de_referencia(versiculo_ref):
+                tabla.setdefault((str(capitulo), versiculo), entrada)
+    return tabla
+
+def compilar_comentarios_cba2(capitulos):
+    """Entradas (capítulo, versículo) -> comentario de un libro de data/cba2.json
+    
+    Un versículo con comentario propio lo conserva aunque además lo cubra un rango.
+    """
+    tabla = {}
+    rangos = []
+    for capitulo, versiculos in capitulos.items():
+        for versiculo_ref, textos in versiculos.items():
+            if not isinstance(textos, list):
+                continue
+            entrada = {
+                'versiculo': versiculo_ref,
+                'comentario': " ".join(str(t) for t in textos),
+                'encontrado': bool(textos),
+                'referencias_separadas': []
+            }
+            if '-' in versiculo_ref:
+                rangos.append((capitulo, entrada))
+            else:
+                tabla.setdefault((capitulo, versiculo_ref), entrada)
+    
+    for capitulo, entrada in rangos:
+        for versiculo in versiculos_de_referencia(entrada['versiculo']):
+            tabla.setdefault((capitulo, versiculo), entrada)
+    return tabla
+
+# Fuentes de comentarios, en el orden en que se fusionan en cada respuesta
+# (ver registrar_fuente_comentarios)
+FUENTES_COMENTARIOS = []
+
+def registrar_fuente_comentarios(nombre, etiqueta, archivos, cargar, cargar_libro, compilar, alcance='cba'):
+    """Añade una fuente de comentarios
+    
+    nombre: clave en 'fuentes' de la respuesta de /comentarios.
+    etiqueta: encabezado de su texto al fusionarlo ("[CBA]"), o None para la principal.
+    archivos: rutas de los JSON de los que se lee (para el snapshot y la recarga).
+    cargar(): datos crudos de todos los libros, {libro: datos}.
+    cargar_libro(libro): datos crudos de un libro, o None (carga perezosa).
+    compilar(datos): tabla (capítulo, versículo) -> entrada de un libro. Cada entrada
+    tiene 'versiculo', 'comentario', 'encontrado' y 'referencias_separadas', y
+    opcionalmente 'referencia' con el texto original de las referencias.
+    alcance: valor de /buscar?scope= con el que se buscan sus comentarios.
+    """
+    FUENTES_COMENTARIOS.append({
+        'nombre': nombre,
+        'etiqueta': etiqueta,
+        'archivos': tuple(archivos),
+        'cargar': cargar,
+        'cargar_libro': cargar_libro,
+        'compilar': compilar,
+        'alcance': alcance
+    })
+
+def construir_tabla_comentarios(comentarios):
+    """Compila todas las fuentes en una tabla libro -> (capítulo, versículo) -> {fuente: entrada}
+    
+    comentarios es {fuente: {libro: datos crudos}}. Los rangos se expanden a cada
+    versículo que cubren y las referencias se procesan una sola vez.
+    """
+    tabla = {}
+    for fuente in FUENTES_COMENTARIOS:
+        for libro, datos in comentarios.get(fuente['nombre'], {}).items():
+            tabla_libro = tabla.setdefault(libro, {})
+            for clave, entrada in fuente['compilar'](datos).items():
+                tabla_libro.setdefault(clave, {})[fuente['nombre']] = entrada
+    
+    return tabla
+
+def fusionar_comentarios(entradas):
+    """Combina las entradas de cada fuente para un versículo en la respuesta de /comentarios"""
+    textos = []
+    referencias_texto = []
+    referencias_separadas = []
+    fuentes = {}
+    
+    for fuente in FUENTES_COMENTARIOS:
+        entrada = entradas.get(fuente['nombre'])
+        fuentes[fuente['nombre']] = bool(entrada and entrada['encontrado'])
+        if not entrada:
+            continue
+        
+        if entrada['encontrado']:
+            texto = texto_corpus(entrada['comentario'])
+            textos.append(f"{fuente['etiqueta']}\n{texto}" if fuente['etiqueta'] else texto)
+            logger.debug("  ✅ Encontrado comentario %s para %s", fuente['nombre'], entrada['versiculo'])
+        
+        referencia = entrada.get('referencia') or "; ".join(entrada['referencias_separadas'])
+        if referencia:
+            referencias_texto.append(referencia)
+        referencias_separadas.extend(entrada['referencias_separadas'])
+    
+    if not textos:
+        logger.debug("  ❌ No hay comentarios disponibles")
+    
+    return {
+        'comentario': "\n\n".join(textos) if textos else 'No hay comentario disponible para este versículo.',
+        'referencia': "; ".join(referencias_texto),
+        'referencias_separadas': list(set(referencias_separadas)),  # Eliminar duplicados
+        'fuentes': fuentes
+    }
+
+# Límite de resultados devueltos por /buscar (por página, si no se indica limit)
+LIMITE_RESULTADOS_BUSQUEDA = 200
+# Máximo que admite /buscar?limit=
+LIMITE_MAXIMO_BUSQUEDA = 1000
+
+PATRON_TOKEN = re.compile(r'\w+')
+
+def tokenizar(texto):
+    """Divide el texto en términos plegados (minúsculas y sin acentos)"""
+    return PATRON_TOKEN.findall(plegar_acentos(texto))
+
+def _posiciones_originales(texto, plegado):
+    """Posición en texto de cada carácter de plegado, o None si coinciden una a una
+    
+    Plegar conserva las posiciones en el texto latino; sólo algunos caracteres
+    (letras con marcas combinantes, "İ") cambian de longitud al plegarse.
+    """
+    if len(plegado) == len(texto):
+        return None
+    origen = []
+    for posicion, caracter in enumerate(texto):
+        origen.extend([posicion] * len(plegar_acentos(caracter)))
+    return origen if len(origen) == len(plegado) else None
+
+def construir_indice_textos(alcance, documentos, textos):
+    """Construye un índice invertido término -> IDs de documento
+    
+    documentos son las ubicaciones de los textos (el ID es la posición en la
+    lista) y textos sus textos en el mismo orden. Junto a cada lista de IDs se
+    guarda cuántas veces aparece el término en cada documento y dónde aparece por
+    primera vez (para los fragmentos resaltados), y la longitud (en términos) de
+    cada documento, para puntuar por relevancia con BM25.
+    """
+    terminos = {}
+    frecuencias = {}
+    posiciones = {}
+    longitudes = array('I')
+    
+    for id_documento, texto in enumerate(textos):
+        texto = str(texto) if texto else ''
+        plegado = plegar_acentos(texto)
+        origen = _posiciones_originales(texto, plegado)
+        cuentas = Counter()
+        primeras = {}
+        for match in PATRON_TOKEN.finditer(plegado):
+            cuentas[match.group()] += 1
+            if match.group() not in primeras:
+                primeras[match.group()] = match.start() if origen is None else origen[match.start()]
+        
+        longitudes.append(sum(cuentas.values()))
+        for termino, frecuencia in cuentas.items():
+            if termino not in terminos:
+                terminos[termino] = array('I')
+                frecuencias[termino] = array('B')
+                posiciones[termino] = array('I')
+            terminos[termino].append(id_documento)
+            frecuencias[termino].append(min(frecuencia, 0xFF))
+            posiciones[termino].append(primeras[termino])
+    
+    return {
+        'alcance': alcance,
+        'documentos': documentos,
+        'terminos': terminos,
+        'vocabulario': tuple(sorted(terminos)),
+        'frecuencias': frecuencias,
+        'posiciones': posiciones,
+        'longitudes': longitudes,
+        'longitud_media': sum(longitudes) / len(longitudes) if longitudes else 0
+    }
+
+# Número de los versículos cuya clave no es un número ("12a"): quedan tras los numéricos del capítulo
+SIN_NUMERO = 0xFFFF
+
+def construir_almacen_versiculos(biblia):
+    """Almacén compacto de los versículos, con un ID global por versículo en orden canónico
+    
+    'textos' guarda el texto de cada ID (su número de texto con el corpus
+    mapeado) y 'numeros' su número de versículo; las pocas claves que no son un
+    número sin más ("12a", "01") se guardan aparte en 'etiquetas'. 'capitulos' da,
+    por libro y capítulo, el intervalo [primer ID, ID final) de sus versículos, e
+    'inicios' y 'ubicaciones' el primer ID y el (libro, capítulo) de cada capítulo,
+    en orden. Así cualquier tramo de versículos, aunque cruce capítulos, es un
+    slice de 'textos'.
+    """
+    textos = []
+    numeros = array('H')
+    etiquetas = {}
+    capitulos = {}
+    inicios = array('I')
+    ubicaciones = []
+    for libro, capitulos_libro in biblia.items():
+        if not es_diccionario_valido(capitulos_libro):
+            continue
+        capitulos[libro] = {}
+        for capitulo, versiculos_capitulo in capitulos_libro.items():
+            if not isinstance(versiculos_capitulo, dict):
+                continue
+            inicio = len(textos)
+            for num_versiculo, texto in versiculos_capitulo.items():
+                numero = int(num_versiculo) if num_versiculo.isdigit() else SIN_NUMERO
+                if str(numero) != num_versiculo:
+                    etiquetas[len(textos)] = num_versiculo
+                numeros.append(min(numero, SIN_NUMERO))
+                textos.append(texto)
+            capitulos[libro][capitulo] = (inicio, len(textos))
+            inicios.append(inicio)
+            ubicaciones.append((libro, capitulo))
+    
+    logger.info("✅ Almacén de versículos construido: %d versículos en %d capítulos", len(textos), len(ubicaciones))
+    return {
+        'textos': textos,
+        'numeros': numeros,
+        'etiquetas': etiquetas,
+        'capitulos': capitulos,
+        'inicios': inicios,
+        'ubicaciones': ubicaciones
+    }
+
+def etiqueta_versiculo(almacen, id_versiculo):
+    """Clave del versículo de un ID ("16")"""
+    etiqueta = almacen['etiquetas'].get(id_versiculo)
+    return etiqueta if etiqueta is not None else str(almacen['numeros'][id_versiculo])
+
+def ubicacion_versiculo(almacen, id_versiculo):
+    """(libro, capítulo, versículo) de un ID del almacén"""
+    libro, capitulo = almacen['ubicaciones'][bisect.bisect_right(almacen['inicios'], id_versiculo) - 1]
+    return libro, capitulo, etiqueta_versiculo(almacen, id_versiculo)
+
+def id_versiculo(almacen, libro, capitulo, versiculo):
+    """ID de un versículo del almacén, o None si no existe"""
+    intervalo = almacen['capitulos'].get(libro, {}).get(capitulo)
+    if intervalo is None:
+        return None
+    inicio, fin = intervalo
+    if versiculo.isdigit() and str(int(versiculo)) == versiculo and int(versiculo) < SIN_NUMERO:
+        # Los números del capítulo están en orden: se busca por bisección
+        posicion = bisect.bisect_left(almacen['numeros'], int(versiculo), inicio, fin)
+        if (posicion < fin and almacen['numeros'][posicion] == int(versiculo)
+                and posicion not in almacen['etiquetas']):
+            return posicion
+        return None
+    for posicion, etiqueta in almacen['etiquetas'].items():
+        if inicio <= posicion < fin and etiqueta == versiculo:
+            return posicion
+    return None
+
+def tramo_versiculos(almacen, libro, capitulo, desde=None, capitulo_fin=None, hasta=None):
+    """Intervalo [primer ID, ID final) de un tramo de versículos, o None si algún capítulo no existe
+    
+    desde y hasta son números de versículo (None: desde el principio del primer
+    capítulo, hasta el final del último); capitulo_fin, el último capítulo si el
+    tramo cruza capítulos. Los números que el capítulo no tiene acotan el tramo
+    sin error ("3:30-40" acaba en el último versículo del 3).
+    """
+    capitulos = almacen['capitulos'].get(libro, {})
+    primero = capitulos.get(capitulo)
+    ultimo = capitulos.get(capitulo_fin or capitulo)
+    if primero is None or ultimo is None:
+        return None
+    inicio = primero[0] if desde is None else bisect.bisect_left(almacen['numeros'], desde, *primero)
+    fin = ultimo[1] if hasta is None else bisect.bisect_right(almacen['numeros'], hasta, *ultimo)
+    return inicio, max(inicio, fin)
+
+def construir_indice_busqueda(almacen):
+    """Índice de los versículos del almacén
+    
+    Sus documentos son los textos del almacén (el ID de búsqueda es el ID global
+    del versículo); su ubicación se obtiene del propio almacén, que el índice guarda.
+    """
+    indice = construir_indice_textos('versiculos', almacen['textos'], map(texto_corpus, almacen['textos']))
+    indice['almacen'] = almacen
+    logger.info("✅ Índice de búsqueda construido: %d versículos, %d términos", len(almacen['textos']), len(indice['terminos']))
+    return indice
+
+# Longitud (en letras) hasta la que se precalculan los términos más frecuentes de cada prefijo
+LONGITUD_PREFIJO_PRECALCULADO = 2
+# Máximo de sugerencias de /sugerir (y de términos guardados por prefijo precalculado)
+LIMITE_SUGERENCIAS = 20
+
+def construir_sugerencias(indice):
+    """Estructuras de /sugerir para completar palabras con el vocabulario de los versículos
+    
+    'apariciones' da las veces que aparece cada término, en la misma posición
+    que en 'vocabulario' (el del índice de versículos), y 'formas' la forma con
+    acentos más frecuente de los términos que la tienen ("jesus" -> "jesús").
+    Para los prefijos de hasta LONGITUD_PREFIJO_PRECALCULADO letras, que abarcan
+    gran parte del vocabulario, 'mejores' guarda ya las posiciones de sus términos
+    más frecuentes; los prefijos más largos abarcan pocos y se ordenan al consultarlos.
+    """
+    vocabulario = indice['vocabulario']
+    apariciones = array('I', (sum(indice['frecuencias'][termino]) for termino in vocabulario))
+    
+    cuentas_formas = Counter()
+    for texto in indice['documentos']:
+        cuentas_formas.update(PATRON_TOKEN.findall(str(texto_corpus(texto) or '').lower()))
+    mas_frecuentes = {}
+    for forma, cuenta in cuentas_formas.items():
+        plegado = plegar_acentos(forma)
+        if cuenta > mas_frecuentes.get(plegado, ('', 0))[1]:
+            mas_frecuentes[plegado] = (forma, cuenta)
+    posiciones = {termino: posicion for posicion, termino in enumerate(vocabulario)}
+    formas = {posiciones[plegado]: forma for plegado, (forma, _) in mas_frecuentes.items()
+              if forma != plegado and plegado in posiciones}
+    
+    por_prefijo = {}
+    for posicion, termino in enumerate(vocabulario):
+        for longitud in range(1, min(len(termino), LONGITUD_PREFIJO_PRECALCULADO) + 1):
+            por_prefijo.setdefault(termino[:longitud], []).append(posicion)
+    mejores = {prefijo: array('I', heapq.nlargest(LIMITE_SUGERENCIAS, candidatos, key=apariciones.__getitem__))
+               for prefijo, candidatos in por_prefijo.items()}
+    
+    logger.info("✅ Sugerencias construidas: %d prefijos precalculados", len(mejores))
+    return {'vocabulario': vocabulario, 'apariciones': apariciones, 'formas': formas, 'mejores': mejores}
+
+def terminos_por_prefijo(sugerencias, prefijo, limite):
+    """Posiciones en el vocabulario de los términos más frecuentes que empiezan por prefijo (ya plegado)"""
+    if len(prefijo) <= LONGITUD_PREFIJO_PRECALCULADO:
+        return sugerencias['mejores'].get(prefijo, ())[:limite]
+    vocabulario = sugerencias['vocabulario']
+    inicio = bisect.bisect_left(vocabulario, prefijo)
+    fin = bisect.bisect_left(vocabulario, prefijo + '\U0010ffff', inicio)
+    return heapq.nlargest(limite, range(inicio, fin), key=sugerencias['apariciones'].__getitem__)
+
+def _orden_numerico(valor):
+    """Clave para ordenar capítulos y versículos ("2" antes que "10")"""
+    valor = str(valor)
+    return (0, int(valor), '') if valor.isdigit() else (1, 0, valor)
+
+def construir_indice_comentarios(alcance, tablas):
+    """Índice de los comentarios de las fuentes de un alcance
+    
+    tablas da pares (libro, tabla de comentarios del libro). Cada comentario
+    distinto es un documento (fuente, libro, capítulo, versículo, referencia): el
+    versículo es el primero que cubre y referencia su clave original ("1-3"). El
+    texto no se guarda en el índice: se lee de la tabla de comentarios.
+    """
+    fuentes = [fuente['nombre'] for fuente in FUENTES_COMENTARIOS if fuente['alcance'] == alcance]
+    documentos = []
+    textos = []
+    for libro, tabla_libro in tablas:
+        vistas = set()
+        for capitulo, versiculo in sorted(tabla_libro, key=lambda clave: tuple(map(_orden_numerico, clave))):
+            entradas = tabla_libro[(capitulo, versiculo)]
+            for fuente in fuentes:
+                entrada = entradas.get(fuente)
+                # Un comentario de un rango aparece en cada versículo: se indexa una vez
+                if not entrada or not entrada['encontrado'] or id(entrada) in vistas:
+                    continue
+                vistas.add(id(entrada))
+                documentos.append((fuente, libro, capitulo, versiculo, entrada['versiculo']))
+                textos.append(texto_corpus(entrada['comentario']))
+    
+    indice = construir_indice_textos(alcance, documentos, textos)
+    logger.info("✅ Índice de búsqueda '%s' construido: %d comentarios", alcance, len(documentos))
+    return indice
+
+def textos_apendices(cba_append):
+    """(documento, ruta, texto) de cada texto de los apéndices del CBA
+    
+    La ruta son las claves (o posiciones de lista) que llevan al texto dentro del
+    documento, p. ej. ('apendices', 'APÉNDICE A', 'secciones', 'I', 'citas', '0', 'texto').
+    """
+    def recorrer(valor, ruta):
+        if isinstance(valor, dict):
+            for clave, hijo in valor.items():
+                yield from recorrer(hijo, ruta + (str(clave),))
+        elif isinstance(valor, list):
+            for posicion, hijo in enumerate(valor):
+                yield from recorrer(hijo, ruta + (str(posicion),))
+        elif isinstance(valor, str) and valor.strip():
+            yield ruta, valor
+    
+    return [(documento, ruta, texto)
+            for documento, contenido in cba_append.items()
+            for ruta, texto in recorrer(contenido, ())]
+
+def construir_indice_apendices(cba_append):
+    """Índice de los textos de los apéndices del CBA"""
+    documentos = textos_apendices(cba_append)
+    indice = construir_indice_textos('apendices', documentos, (texto for _, _, texto in documentos))
+    logger.info("✅ Índice de búsqueda 'apendices' construido: %d textos", len(documentos))
+    return indice
+
+def construir_indice_citas(tablas, biblia):
+    """Índice inverso de las referencias de los comentarios: quién cita cada versículo
+
+    tablas da pares (libro, tabla de comentarios del libro). Cada comentario
+    distinto con referencias es un pasaje (fuente, libro, capítulo, versículo,
+    referencia, fragmento), con el versículo y la clave original como en
+    construir_indice_comentarios y el comienzo de su texto. Cada una de sus
+    referencias_separadas se lee con claves_cita y 'citas' guarda, por
+    (libro, capítulo, versículo) citado, los pares (pasaje, referencia que lo cita),
+    en el orden de los libros y de las fuentes.
+    """
+    fuentes = [fuente['nombre'] for fuente in FUENTES_COMENTARIOS]
+    pasajes = []
+    citas = {}
+    for libro, tabla_libro in sorted(tablas, key=lambda par: POSICIONES_LIBROS.get(par[0], len(TODOS_LIBROS))):
+        vistas = set()
+        for capitulo, versiculo in sorted(tabla_libro, key=lambda clave: tuple(map(_orden_numerico, clave))):
+            entradas = tabla_libro[(capitulo, versiculo)]
+            for fuente in fuentes:
+                entrada = entradas.get(fuente)
+                if not entrada or not entrada['encontrado'] or not entrada['referencias_separadas'] or id(entrada) in vistas:
+                    continue
+                vistas.add(id(entrada))
+                posicion = len(pasajes)
+                citados = [(clave, referencia) for referencia in entrada['referencias_separadas']
+                           for clave in claves_cita(referencia, biblia, libro)]
+                if not citados:
+                    continue
+                for clave, referencia in citados:
+                    # Un pasaje que cita dos veces el mismo versículo aparece una vez
+                    citas.setdefault(clave, {}).setdefault(posicion, referencia)
+                fragmento, _ = fragmento_resaltado(texto_corpus(entrada['comentario']), [])
+                pasajes.append((fuente, libro, capitulo, versiculo, entrada['versiculo'], fragmento))
+
+    logger.info("✅ Índice de citas construido: %d comentarios citan %d versículos", len(pasajes), len(citas))
+    return {'pasajes': pasajes, 'citas': {clave: tuple(pares.items()) for clave, pares in citas.items()}}
+
+def _unir_listas(listas, desde=-1, hasta=None):
+    """Une listas de IDs ordenadas sin materializarlas, omitiendo duplicados
+    
+    Sólo se recorren los IDs mayores que desde (y menores que hasta), saltando
+    directamente a ellos.
+    """
+    iteradores = [islice(lista, bisect.bisect_right(lista, desde),
+                         None if hasta is None else bisect.bisect_left(lista, hasta))
+                  for lista in listas]
+    if len(iteradores) == 1:
+        yield from iteradores[0]
+        return
+    
+    anterior = None
+    for id_versiculo in heapq.merge(*iteradores):
+        if id_versiculo != anterior:
+            anterior = id_versiculo
+            yield id_versiculo
+
+# Longitud máxima de los n-gramas del vocabulario con que se buscan subcadenas
+LONGITUD_NGRAMA = 3
+
+_lock_ngramas = threading.Lock()
+
+def ngramas_vocabulario(indice):
+    """n-grama (de 1 a LONGITUD_NGRAMA letras) -> posiciones en el vocabulario de los términos que lo contienen
+    
+    Se construye la primera vez que se busca una subcadena en el índice y se
+    guarda en él.
+    """
+    ngramas = indice.get('ngramas')
+    if ngramas is None:
+        with _lock_ngramas:
+            ngramas = indice.get('ngramas')
+            if ngramas is None:
+                ngramas = {}
+                for posicion, termino in enumerate(indice['vocabulario']):
+                    for ngrama in {termino[i:i + n] for n in range(1, LONGITUD_NGRAMA + 1)
+                                   for i in range(len(termino) - n + 1)}:
+                        if ngrama not in ngramas:
+                            ngramas[ngrama] = array('I')
+                        ngramas[ngrama].append(posicion)
+                indice['ngramas'] = ngramas
+    return ngramas
+
+def terminos_con_subcadena(indice, fragmento):
+    """Términos del vocabulario que contienen el fragmento, sin recorrer el vocabulario entero
+    
+    Se parte de los términos del n-grama del fragmento con menos términos y sólo
+    sobre ellos se comprueba la subcadena completa.
+    """
+    ngramas = ngramas_vocabulario(indice)
+    n = min(len(fragmento), LONGITUD_NGRAMA)
+    candidatos = min((ngramas.get(fragmento[i:i + n], ()) for i in range(len(fragmento) - n + 1)), key=len)
+    vocabulario = indice['vocabulario']
+    return [vocabulario[posicion] for posicion in candidatos if fragmento in vocabulario[posicion]]
+
+def _grupos_busqueda(indice, termino):
+    """Listas de IDs de cada palabra de la consulta, la más selectiva primero
+    
+    Devuelve None si alguna palabra no aparece en el vocabulario y una lista vacía
+    si la consulta no tiene palabras (sólo signos).
+    """
+    grupos = []
+    for fragmento in set(tokenizar(termino)):
+        listas = [indice['terminos'][t] for t in terminos_con_subcadena(indice, fragmento)]
+        if not listas:
+            return None
+        grupos.append(listas)
+    grupos.sort(key=lambda listas: sum(len(lista) for lista in listas))
+    return grupos
+
+# Palabras que coinciden con más términos que estos no filtran candidatos por sus listas
+MAXIMO_LISTAS_FILTRO = 8
+
+def _en_lista(lista, id_documento):
+    """Si el ID está en una lista ordenada de IDs"""
+    posicion = bisect.bisect_left(lista, id_documento)
+    return posicion < len(lista) and lista[posicion] == id_documento
+
+def buscar_en_indice(indice, termino, desde=-1, hasta=None):
+    """Genera los IDs de los documentos que contienen el término, en orden canónico
+    
+    El término ya viene en minúsculas. Cada palabra de la consulta se compara como
+    subcadena contra el vocabulario (igual que la búsqueda original sobre el texto),
+    se intersectan las listas de cada palabra y se verifica la coincidencia exacta
+    sólo sobre los candidatos, sin distinguir acentos ("jesus" encuentra "Jesús").
+    Con desde (el cursor de una página anterior) sólo se generan los IDs
+    posteriores a él, y con hasta sólo los anteriores a ese ID.
+    """
+    total = len(indice['documentos'])
+    termino = plegar_acentos(termino)
+    hasta = total if hasta is None else min(hasta, total)
+    grupos = _grupos_busqueda(indice, termino)
+    
+    if grupos is None:
+        return
+    if grupos and sum(len(lista) for lista in grupos[0]) < total:
+        # Recorrer la palabra más selectiva y descartar los candidatos que no tienen las
+        # demás, mirando sus listas sólo si son pocas (si no, basta la comprobación del texto)
+        candidatos = _unir_listas(grupos[0], desde, hasta)
+        filtros = [listas for listas in grupos[1:] if len(listas) <= MAXIMO_LISTAS_FILTRO]
+    else:
+        # Sin palabras (sólo signos) o con palabras en casi todos los documentos, como
+        # "a": recorrer los documentos en orden es más barato que mezclar sus listas
+        candidatos = range(desde + 1, hasta)
+        filtros = []
+    
+    for id_versiculo in candidatos:
+        if not all(any(_en_lista(lista, id_versiculo) for lista in listas) for listas in filtros):
+            continue
+        texto = texto_documento(indice, id_versiculo)
+        texto_versiculo = plegar_acentos(str(texto)) if texto else ""
+        if termino in texto_versiculo:
+            yield id_versiculo
+
+# Parámetros de BM25: saturación de la frecuencia y peso de la longitud del versículo
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Longitud mínima de una palabra incompleta para completarla con el vocabulario
+LONGITUD_MINIMA_PREFIJO = 3
+
+def terminos_consulta(indice, termino):
+    """Términos del índice para cada palabra de la consulta, una lista por palabra
+    
+    Una palabra que está en el vocabulario cuenta tal cual; si no (una palabra a
+    medias como "bienaventur"), se usan los términos que empiezan por ella.
+    """
+    vocabulario = indice['vocabulario']
+    grupos = []
+    for fragmento in dict.fromkeys(tokenizar(termino)):
+        if fragmento in indice['terminos']:
+            grupos.append([fragmento])
+        elif len(fragmento) >= LONGITUD_MINIMA_PREFIJO:
+            inicio = bisect.bisect_left(vocabulario, fragmento)
+            fin = bisect.bisect_left(vocabulario, fragmento + '\U0010ffff', inicio)
+            if fin > inicio:
+                grupos.append(vocabulario[inicio:fin])
+    return grupos
+
+def buscar_por_relevancia(indice, termino, k):
+    """Los k versículos más relevantes para la consulta, [(ID, puntuación)] de mayor a menor
+    
+    Puntúa con BM25 recorriendo sólo las listas de los términos de la consulta y
+    elige los k mejores con un montículo, sin ordenar todos los candidatos. Si una
+    palabra se completó con varios términos cuenta el que más puntúe en cada
+    versículo. A igual puntuación va primero el versículo anterior en el orden canónico.
+    """
+    total = len(indice['documentos'])
+    longitudes = indice['longitudes']
+    media = indice['longitud_media'] or 1
+    puntuaciones = {}
+    
+    for grupo in terminos_consulta(indice, termino):
+        puntuaciones_grupo = {}
+        for termino_indice in grupo:
+            ids = indice['terminos'][termino_indice]
+            idf = math.log(1 + (total - len(ids) + 0.5) / (len(ids) + 0.5))
+            for id_versiculo, frecuencia in zip(ids, indice['frecuencias'][termino_indice]):
+                normalizacion = BM25_K1 * (1 - BM25_B + BM25_B * longitudes[id_versiculo] / media)
+                puntuacion = idf * frecuencia * (BM25_K1 + 1) / (frecuencia + normalizacion)
+                if puntuacion > puntuaciones_grupo.get(id_versiculo, 0.0):
+                    puntuaciones_grupo[id_versiculo] = puntuacion
+        for id_versiculo, puntuacion in puntuaciones_grupo.items():
+            puntuaciones[id_versiculo] = puntuaciones.get(id_versiculo, 0.0) + puntuacion
+    
+    return heapq.nlargest(k, puntuaciones.items(), key=lambda par: (par[1], -par[0]))
+
+def texto_documento(indice, id_documento):
+    """Texto de un documento de cualquier índice de búsqueda"""
+    documento = indice['documentos'][id_documento]
+    if indice['alcance'] == 'versiculos':
+        return texto_corpus(documento)
+    if indice['alcance'] == 'apendices':
+        return texto_corpus(documento[-1])
+    fuente, libro, capitulo, versiculo, _ = documento
+    entrada = comentarios_libro(libro).get((capitulo, versiculo), {}).get(fuente)
+    return texto_corpus(entrada['comentario']) if entrada else ''
+
+# Longitud aproximada (caracteres) de los fragmentos de comentarios y apéndices en /buscar
+LONGITUD_FRAGMENTO = int(os.environ.get('LONGITUD_FRAGMENTO', 240))
+
+def apariciones_consulta(indice, id_documento, grupos):
+    """(posición, longitud) de la primera aparición en el documento de cada palabra de la consulta
+    
+    Las posiciones salen del índice (se guardaron al construirlo), sin volver a
+    recorrer el texto. grupos son los de terminos_consulta.
+    """
+    apariciones = []
+    for grupo in grupos:
+        primera = None
+        for termino in grupo:
+            ids = indice['terminos'][termino]
+            posicion = bisect.bisect_left(ids, id_documento)
+            if posicion < len(ids) and ids[posicion] == id_documento:
+                aparicion = (indice['posiciones'][termino][posicion], len(termino))
+                primera = aparicion if primera is None else min(primera, aparicion)
+        if primera is not None:
+            apariciones.append(primera)
+    return sorted(apariciones)
+
+def fragmento_resaltado(texto, apariciones, longitud=LONGITUD_FRAGMENTO):
+    """Fragmento del texto en torno a la primera aparición y las posiciones [inicio, fin] a resaltar en él
+    
+    Los textos que caben enteros se devuelven tal cual; si no, el fragmento
+    empieza y termina en palabras completas, marcado con "…" donde se corta.
+    """
+    if len(texto) <= longitud:
+        inicio, fin = 0, len(texto)
+    else:
+        primera = apariciones[0][0] if apariciones else 0
+        inicio = max(0, primera - longitud // 3)
+        if inicio:
+            espacio = texto.find(' ', inicio, primera)
+            inicio = espacio + 1 if espacio != -1 else inicio
+        fin = min(len(texto), inicio + longitud)
+        if fin < len(texto):
+            espacio = texto.rfind(' ', primera + 1, fin)
+            fin = espacio if espacio != -1 else fin
+    
+    prefijo = '…' if inicio else ''
+    fragmento = prefijo + texto[inicio:fin] + ('…' if fin < len(texto) else '')
+    desplazamiento = len(prefijo) - inicio
+    resaltados = [[posicion + desplazamiento, posicion + largo + desplazamiento]
+                  for posicion, largo in apariciones if inicio <= posicion and posicion + largo <= fin]
+    return fragmento, resaltados
+
+# Valores de /buscar?scope= (también en inglés) -> alcance del índice
+ALCANCES_BUSQUEDA = {
+    'versiculos': 'versiculos', 'verses': 'versiculos',
+    'comentarios': 'comentarios', 'commentary': 'comentarios',
+    'cba': 'cba',
+    'apendices': 'apendices', 'appendix': 'apendices',
+}
+
+_lock_indices_busqueda = threading.Lock()
+
+def indice_alcance(alcance):
+    """Índice de búsqueda de un alcance
+    
+    Con carga perezosa los índices de comentarios no se construyen al arrancar
+    sino en la primera búsqueda que los necesita, leyendo cada libro una vez (sin
+    pasar por la caché de comentarios).
+    """
+    datos = datos_actuales()
+    if alcance == 'versiculos':
+        return datos['indice_busqueda']
+    indices = datos['indices_busqueda']
+    with _lock_indices_busqueda:
+        if alcance not in indices:
+            with fase('construir_indice_comentarios'):
+                indices[alcance] = construir_indice_comentarios(
+                    alcance, ((libro, cargar_comentarios_libro(libro)) for libro in TODOS_LIBROS))
+        return indices[alcance]
+
+def indice_citas():
+    """Índice inverso de citas (ver construir_indice_citas)
+
+    Como los índices de comentarios, con carga perezosa se construye en la primera
+    consulta que lo necesita.
+    """
+    datos = datos_actuales()
+    with _lock_indices_busqueda:
+        if datos['indice_citas'] is None:
+            with fase('construir_indice_citas'):
+                datos['indice_citas'] = construir_indice_citas(
+                    ((libro, cargar_comentarios_libro(libro)) for libro in TODOS_LIBROS), datos['biblia'])
+        return datos['indice_citas']
+
+# Búsqueda en paralelo: procesos por worker (0 = buscar siempre en el propio worker)
+# No se combina con INTERVALO_RECARGA_DATOS, que la desactiva (ver iniciar_pool_busqueda)
+BUSQUEDA_PROCESOS = int(os.environ.get('BUSQUEDA_PROCESOS', 0))
+# Candidatos a verificar a partir de los cuales una consulta se reparte entre los procesos
+UMBRAL_BUSQUEDA_PARALELA = int(os.environ.get('UMBRAL_BUSQUEDA_PARALELA', 5000))
+# Segundos máximos por consulta repartida; al agotarse se devuelven resultados parciales
+PLAZO_BUSQUEDA = float(os.environ.get('PLAZO_BUSQUEDA', 2.0))
+
+_POOL_BUSQUEDA = None
+_lock_pool_busqueda = threading.Lock()
+
+def rangos_libros(almacen):
+    """Fragmentos de la búsqueda en paralelo: (libro, primer ID, ID final) en orden canónico"""
+    rangos = []
+    for libro, capitulos in almacen['capitulos'].items():
+        intervalos = list(capitulos.values())
+        if intervalos and intervalos[-1][1] > intervalos[0][0]:
+            rangos.append((libro, intervalos[0][0], intervalos[-1][1]))
+    return rangos
+
+def _iniciar_proceso_busqueda():
+    # Las consultas pesadas ceden la CPU a las lecturas ligeras de los workers web
+    if hasattr(os, 'nice'):
+        os.nice(5)
+
+def pool_busqueda():
+    """Pool de procesos de búsqueda del worker (iniciar_pool_busqueda lo crea)
+    
+    Donde existe fork, los procesos heredan el índice ya cargado (y el corpus mapeado)
+    sin copiarlo.
+    """
+    global _POOL_BUSQUEDA
+    with _lock_pool_busqueda:
+        if _POOL_BUSQUEDA is None:
+            contexto = (multiprocessing.get_context('fork')
+                        if 'fork' in multiprocessing.get_all_start_methods() else None)
+            _POOL_BUSQUEDA = ProcessPoolExecutor(BUSQUEDA_PROCESOS, mp_context=contexto,
+                                                 initializer=_iniciar_proceso_busqueda)
+            atexit.register(_POOL_BUSQUEDA.shutdown, wait=False, cancel_futures=True)
+        return _POOL_BUSQUEDA
+
+def iniciar_pool_busqueda():
+    """Crea los procesos de búsqueda del worker antes que sus hilos de fondo
+    
+    Es el primero de HILOS_PROCESO. Un hijo creado por fork en un proceso con hilos
+    puede heredar un lock tomado (del logging, de las métricas, de una CacheLRU) y
+    bloquearse en él, así que los procesos se crean aquí, antes de la precarga de
+    comentarios, y no en la primera consulta pesada. Por lo mismo el pool no se
+    renueva tras una recarga: BUSQUEDA_PROCESOS e INTERVALO_RECARGA_DATOS no se combinan.
+    """
+    if BUSQUEDA_PROCESOS:
+        # Con fork, el primer envío crea todos los procesos del pool a la vez
+        pool_busqueda().submit(int).result()
+
+def _reiniciar_pool_busqueda():
+    # Un worker creado por fork no puede usar el pool de su padre
+    global _POOL_BUSQUEDA
+    _POOL_BUSQUEDA = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reiniciar_pool_busqueda)
+
+def es_busqueda_pesada(indice, termino):
+    """Decide si merece la pena repartir la consulta entre los procesos de búsqueda"""
+    if not BUSQUEDA_PROCESOS:
+        return False
+    grupos = _grupos_busqueda(indice, termino)
+    if grupos is None:
+        return False
+    candidatos = sum(len(lista) for lista in grupos[0]) if grupos else len(indice['documentos'])
+    return candidatos >= UMBRAL_BUSQUEDA_PARALELA
+
+def _buscar_en_libro(termino, desde, hasta, limite):
+    """Tarea de un proceso de búsqueda: IDs que coinciden en un rango (un libro)"""
+    return list(islice(buscar_en_indice(datos_actuales()['indice_busqueda'], termino, desde, hasta), limite))
+
+def buscar_en_paralelo(termino, desde, limite):
+    """Reparte la consulta por libros entre los procesos de búsqueda
+    
+    Los libros se envían en orden canónico, como mucho dos por proceso a la vez, y
+    se dejan de enviar en cuanto hay resultados para llenar la página (más uno, para
+    saber si hay página siguiente). Devuelve (IDs, cursor); si se agota PLAZO_BUSQUEDA
+    los IDs son sólo los de los libros terminados hasta el primero pendiente y el
+    cursor apunta al final del último terminado, para que la página siguiente
+    continúe desde ahí. Si no se agota, el cursor es None.
+    """
+    pool = pool_busqueda()
+    fin_plazo = time.monotonic() + PLAZO_BUSQUEDA
+    pendientes = deque((max(desde, inicio - 1), fin) for _, inicio, fin in datos_actuales()['rangos_libros']
+                        if fin - 1 > desde)
+    en_curso = deque()
+    ids = []
+    ultimo_terminado = desde
+    
+    try:
+        while pendientes or en_curso:
+            while pendientes and len(en_curso) < 2 * BUSQUEDA_PROCESOS:
+                inicio, fin = pendientes.popleft()
+                en_curso.append((fin, pool.submit(_buscar_en_libro, termino, inicio, fin, limite + 1)))
+            
+            fin, futuro = en_curso.popleft()
+            try:
+                ids.extend(futuro.result(timeout=max(0, fin_plazo - time.monotonic())))
+            except TiempoAgotado:
+                futuro.cancel()
+                logger.warning("⏱️  Búsqueda '%s' cortada por el plazo de %ss", termino, PLAZO_BUSQUEDA)
+                return ids, ultimo_terminado
+            ultimo_terminado = fin - 1
+            if len(ids) > limite:
+                break
+    finally:
+        for _, futuro in en_curso:
+            futuro.cancel()
+    return ids[:limite + 1], None
+
+# Segundos que clientes y CDN pueden reutilizar las respuestas de datos estáticos (con
+# INTERVALO_RECARGA_DATOS activo no se usa: los datos pueden cambiar y se revalidan siempre)
+CACHE_MAX_AGE = int(os.environ.get('CACHE_MAX_AGE', 86400))
+
+# Tamaño mínimo (bytes) a partir del cual una respuesta se envía comprimida
+UMBRAL_COMPRESION = int(os.environ.get('UMBRAL_COMPRESION', 1024))
+
+TIPOS_COMPRIMIBLES = ('application/json', 'text/html')
+
+def codificaciones_disponibles():
+    """Codificaciones que el servidor sabe producir, en orden de preferencia"""
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+def comprimir(cuerpo, codificacion, nivel_maximo=False):
+    """Comprime el cuerpo con brotli o gzip"""
+    if codificacion == 'br':
+        return brotli.compress(cuerpo, quality=11 if nivel_maximo else 5)
+    return gzip.compress(cuerpo, compresslevel=9 if nivel_maximo else 6, mtime=0)
+
+@lru_cache(maxsize=128)
+def comprimir_cacheado(cuerpo, codificacion):
+    """Comprime respuestas dinámicas recordando las más recientes (comentarios populares)"""
+    return comprimir(cuerpo, codificacion)
+
+# Respuestas ya serializadas: clave -> {'cuerpo': bytes, 'etag': str, 'variantes': {codificación: bytes}}
+RESPUESTAS_CACHE = {}
+
+# Claves del entorno WSGI con las que asgi.py pide una respuesta sólo si ya está en
+# RESPUESTAS_CACHE (para servirla en el bucle de eventos) y sabe que no lo estaba
+SOLO_CACHE = 'biblia.solo_cache'
+FUERA_DE_CACHE = 'biblia.fuera_de_cache'
+
+class FueraDeCache(Exception):
+    """La respuesta habría que generarla y la petición sólo admitía una ya cacheada"""
+
+@app.errorhandler(FueraDeCache)
+def fuera_de_cache(error):
+    request.environ[FUERA_DE_CACHE] = True
+    return '', 503
+
+def respuesta_cacheada(clave, generar, mimetype, max_age=CACHE_MAX_AGE):
+    """Sirve contenido que no cambia tras el arranque, generado una sola vez
+    
+    La primera petición guarda los bytes de generar() con su ETag fuerte y, si
+    superan UMBRAL_COMPRESION, sus variantes comprimidas. Las siguientes eligen la
+    variante según Accept-Encoding y, si el cliente envía If-None-Match con el
+    mismo ETag, reciben un 304 sin cuerpo. Con max_age=None el cliente debe
+    revalidar siempre (útil para el HTML de la página), y también con la recarga
+    en caliente activa, para que vea los cambios en cuanto cambia el ETag. Si el
+    entorno lleva SOLO_CACHE y la respuesta aún no está cacheada, lanza
+    FueraDeCache sin generarla.
+    
+    Una respuesta generada con datos que una recarga ya sustituyó se sirve pero no
+    se guarda: la recarga publica los datos nuevos antes de invalidar sus claves,
+    así que la que se guardó antes de publicarlos se invalida y la de después se descarta.
+    """
+    entrada = RESPUESTAS_CACHE.get(clave)
+    if entrada is None and request.environ.get(SOLO_CACHE):
+        raise FueraDeCache()
+    contar_cache('respuestas', entrada is not None)
+    if entrada is None:
+        cuerpo = generar()
+        variantes = {}
+        if len(cuerpo) >= UMBRAL_COMPRESION:
+            for codificacion in codificaciones_disponibles():
+                comprimido = comprimir(cuerpo, codificacion, nivel_maximo=True)
+                if len(comprimido) < len(cuerpo):
+                    variantes[codificacion] = comprimido
+        entrada = {
+            'cuerpo': cuerpo,
+            'etag': hashlib.sha256(cuerpo).hexdigest()[:32],
+            'variantes': variantes
+        }
+        RESPUESTAS_CACHE[clave] = entrada
+        if datos_actuales() is not DATOS and RESPUESTAS_CACHE.get(clave) is entrada:
+            RESPUESTAS_CACHE.pop(clave, None)
+    
+    codificacion = request.accept_encodings.best_match(list(entrada['variantes']))
+    if codificacion:
+        respuesta = app.response_class(entrada['variantes'][codificacion], mimetype=mimetype)
+        respuesta.headers['Content-Encoding'] = codificacion
+        # Cada representación necesita su propio ETag fuerte
+        respuesta.set_etag(f"{entrada['etag']}-{codificacion}")
+    else:
+        respuesta = app.response_class(entrada['cuerpo'], mimetype=mimetype)
+        respuesta.set_etag(entrada['etag'])
+    
+    if entrada['variantes']:
+        respuesta.vary.add('Accept-Encoding')
+    respuesta.cache_control.public = True
+    if max_age is None or INTERVALO_RECARGA_DATOS > 0:
+        respuesta.cache_control.no_cache = True
+    else:
+        respuesta.cache_control.max_age = max_age
+    return respuesta.make_conditional(request)
+
+def respuesta_json_cacheada(clave, generar):
+    """Como respuesta_cacheada, serializando generar() igual que jsonify"""
+    return respuesta_cacheada(
+        clave,
+        lambda: f"{app.json.dumps(generar())}\n".encode('utf-8'),
+        app.json.mimetype
+    )
+
+def invalidar_respuestas(*prefijo):
+    """Descarta las respuestas cacheadas cuya clave empieza por prefijo
+    
+    invalidar_respuestas('versiculos', 'Juan') descarta todos los capítulos de Juan;
+    la siguiente petición las regenera con su nuevo ETag.
+    """
+    for clave in list(RESPUESTAS_CACHE):
+        partes = clave if isinstance(clave, tuple) else (clave,)
+        if partes[:len(prefijo)] == prefijo:
+            RESPUESTAS_CACHE.pop(clave, None)
+
+# Carga de comentarios: 'completa' (todos al arrancar) o 'perezosa' (cada libro al
+# consultarlo por primera vez, en una caché LRU acotada por memoria)
+CARGA_COMENTARIOS = os.environ.get('CARGA_COMENTARIOS', 'completa')
+COMENTARIOS_PEREZOSOS = CARGA_COMENTARIOS == 'perezosa'
+# Memoria máxima aproximada de los comentarios cargados en modo perezoso
+MEMORIA_COMENTARIOS_MB = int(os.environ.get('MEMORIA_COMENTARIOS_MB', 64))
+# Libros a precargar en segundo plano al arrancar (los más consultados)
+PRECARGA_COMENTARIOS = int(os.environ.get('PRECARGA_COMENTARIOS', 10))
+ARCHIVO_POPULARIDAD = os.environ.get('ARCHIVO_POPULARIDAD', 'data/popularidad_comentarios.json')
+
+class CacheLRU:
+    """Caché LRU acotada por el tamaño total aproximado (en bytes) de sus valores"""
+    
+    def __init__(self, capacidad):
+        self.capacidad = capacidad
+        self.tamano = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def obtener(self, clave):
+        with self._lock:
+            if clave not in self._datos:
+                self.fallos += 1
+                return None
+            self.aciertos += 1
+            self._datos.move_to_end(clave)
+            return self._datos[clave][0]
+    
+    def guardar(self, clave, valor, tamano):
+        with self._lock:
+            if clave in self._datos:
+                self.tamano -= self._datos.pop(clave)[1]
+            self._datos[clave] = (valor, tamano)
+            self.tamano += tamano
+            # Siempre se conserva el último valor guardado, aunque supere la capacidad
+            while self.tamano > self.capacidad and len(self._datos) > 1:
+                _, (_, tamano_expulsado) = self._datos.popitem(last=False)
+                self.tamano -= tamano_expulsado
+    
+    def ver(self, clave):
+        """Valor guardado, sin contar acierto ni fallo ni renovar su posición"""
+        with self._lock:
+            return self._datos[clave][0] if clave in self._datos else None
+    
+    def __contains__(self, clave):
+        with self._lock:
+            return clave in self._datos
+    
+    def __len__(self):
+        return len(self._datos)
+    
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+            self.tamano = 0
+
+CACHE_COMENTARIOS = CacheLRU(MEMORIA_COMENTARIOS_MB * 1024 * 1024)
+POPULARIDAD_COMENTARIOS = Counter()
+_lock_popularidad = threading.Lock()
+
+# Índices de la carga perezosa: dónde está cada libro en los archivos de cada fuente
+_INDICES_COMENTARIOS = {}
+_lock_indices_comentarios = threading.Lock()
+
+def _indice_comentarios(nombre, construir):
+    """Construye una sola vez el índice de una fuente"""
+    with _lock_indices_comentarios:
+        if nombre not in _INDICES_COMENTARIOS:
+            _INDICES_COMENTARIOS[nombre] = construir()
+        return _INDICES_COMENTARIOS[nombre]
+
+def _indice_archivos_comentarios():
+    """Libro de cada data/comment/{i}.json, leyendo sólo el principio de cada archivo"""
+    patron = re.compile(r'"libro"\s*:\s*"([^"]*)"')
+    archivos = {}
+    for i in range(1, 67):
+        archivo = f'data/comment/{i}.json'
+        if not os.path.exists(archivo):
+            continue
+        try:
+            with open(archivo, 'r') as f:
+                match = patron.search(f.read(512))
+            if match:
+                nombre_libro = match.group(1)
+            else:
+                with open(archivo, 'r') as f:
+                    nombre_libro = json.load(f).get('libro', '')
+            if nombre_libro:
+                archivos[normalizar_nombre_libro(nombre_libro)] = archivo
+        except Exception as e:
+            logger.error("❌ Error indexando %s: %s", archivo, e)
+    return archivos
+
+def _indice_posiciones(archivo, libro_de_clave, encoding=None):
+    """Posiciones en bytes (inicio, fin) de los datos de cada libro dentro de un JSON libro -> datos
+    
+    Se recorre el archivo una vez decodificando cada valor sin conservarlo; después
+    cada libro se lee de sus fragmentos (ver _leer_fragmentos), sin volver a leer
+    el archivo entero. libro_de_clave(clave, ultimo_libro) da el libro de cada
+    clave del archivo, o None para ignorarla.
+    """
+    posiciones = {}
+    if not os.path.exists(archivo):
+        return posiciones
+    
+    try:
+        codificacion = encoding or locale.getpreferredencoding(False)
+        with open(archivo, 'rb') as f:
+            texto = f.read().decode(codificacion)
+        decodificador = json.JSONDecoder()
+        espacios = re.compile(r'\s*')
+        
+        # Posición en bytes de cada posición del texto, avanzando siempre hacia delante
+        anterior = [0, 0]
+        def en_bytes(posicion):
+            anterior[1] += len(texto[anterior[0]:posicion].encode(codificacion))
+            anterior[0] = posicion
+            return anterior[1]
+        
+        ultimo_libro = None
+        pos = espacios.match(texto, texto.index('{') + 1).end()
+        while pos < len(texto) and texto[pos] != '}':
+            clave, pos = decodificador.raw_decode(texto, pos)
+            pos = espacios.match(texto, pos).end() + 1  # ':'
+            inicio = espacios.match(texto, pos).end()
+            valor, fin = decodificador.raw_decode(texto, inicio)
+            libro = libro_de_clave(clave, ultimo_libro) if clave else None
+            if libro:
+                ultimo_libro = libro
+                if isinstance(valor, dict) and valor:
+                    posiciones.setdefault(libro, []).append((en_bytes(inicio), en_bytes(fin)))
+            pos = espacios.match(texto, fin).end()
+            if texto[pos:pos + 1] == ',':
+                pos = espacios.match(texto, pos + 1).end()
+    except Exception as e:
+        logger.error("❌ Error indexando %s: %s", archivo, e)
+    return posiciones
+
+def _leer_fragmentos(archivo, posiciones, encoding=None):
+    """Decodifica los fragmentos JSON de un archivo en las posiciones (en bytes) dadas"""
+    codificacion = encoding or locale.getpreferredencoding(False)
+    fragmentos = []
+    with open(archivo, 'rb') as f:
+        for inicio, fin in posiciones:
+            f.seek(inicio)
+            fragmentos.append(json.loads(f.read(fin - inicio).decode(codificacion)))
+    return fragmentos
+
+def cargar_libro_principal(libro):
+    """Comentarios de data/comment/ de un único libro"""
+    archivo = _indice_comentarios('principal', _indice_archivos_comentarios).get(libro)
+    if not archivo:
+        return None
+    try:
+        with open(archivo, 'r') as f:
+            return json.load(f).get('comentarios', [])
+    except Exception as e:
+        logger.error("❌ Error cargando %s: %s", archivo, e)
+        return None
+
+def cargar_libro_cba(libro):
+    """Comentarios de data/cba.json de un único libro"""
+    posiciones = _indice_comentarios('cba', lambda: _indice_posiciones(
+        'data/cba.json', lambda clave, ultimo: normalizar_nombre_libro(clave)))
+    if libro not in posiciones:
+        return None
+    try:
+        # Como en la carga completa, si dos claves dan el mismo libro gana la última
+        return _leer_fragmentos('data/cba.json', posiciones[libro][-1:])[0]
+    except Exception as e:
+        logger.error("❌ Error cargando comentarios CBA de %s: %s", libro, e)
+        return None
+
+def cargar_libro_cba2(libro):
+    """Comentarios de data/cba2.json de un único libro"""
+    posiciones = _indice_comentarios('cba2', lambda: _indice_posiciones(
+        'data/cba2.json', lambda clave, ultimo: resolver_libro(clave) or ultimo, encoding='utf-8'))
+    if libro not in posiciones:
+        return None
+    try:
+        capitulos = {}
+        for fragmento in _leer_fragmentos('data/cba2.json', posiciones[libro], encoding='utf-8'):
+            fusionar_capitulos(capitulos, fragmento)
+        return capitulos
+    except Exception as e:
+        logger.error("❌ Error cargando comentarios CBA 2 de %s: %s", libro, e)
+        return None
+
+def leer_comentarios_libro(libro):
+    """Datos crudos de todas las fuentes de un único libro, {fuente: {libro: datos}}"""
+    comentarios = {}
+    for fuente in FUENTES_COMENTARIOS:
+        datos = fuente['cargar_libro'](libro)
+        if datos is not None:
+            comentarios[fuente['nombre']] = {libro: datos}
+    return comentarios
+
+def cargar_comentarios_libro(libro):
+    """Lee y compila todas las fuentes de comentarios de un único libro"""
+    comentarios = leer_comentarios_libro(libro)
+    logger.info("💭 Comentarios de %s cargados", libro)
+    return construir_tabla_comentarios(comentarios).get(libro, {})
+
+def _tamano_tabla(tabla):
+    """Memoria aproximada de la tabla de comentarios de un libro"""
+    entradas = {id(e): e for fuentes in tabla.values() for e in fuentes.values()}
+    return (sys.getsizeof(tabla) + 200 * len(tabla)
+            + sum(sys.getsizeof(e['comentario']) for e in entradas.values()))
+
+# Un lock por libro para cargarlo una sola vez aunque lo pidan varias peticiones a la vez
+_LOCKS_CARGA_LIBRO = {}
+
+def comentarios_libro(libro):
+    """Tabla de comentarios de un libro: (capítulo, versículo) -> {fuente: entrada}"""
+    if not COMENTARIOS_PEREZOSOS:
+        return datos_actuales()['tabla_comentarios'].get(libro, {})
+    
+    with _lock_popularidad:
+        POPULARIDAD_COMENTARIOS[libro] += 1
+    tabla = CACHE_COMENTARIOS.obtener(libro)
+    if tabla is None:
+        # Las peticiones que piden a la vez un libro sin cargar esperan a que lo cargue la primera
+        with _LOCKS_CARGA_LIBRO.setdefault(libro, threading.Lock()):
+            tabla = CACHE_COMENTARIOS.ver(libro)
+            if tabla is None:
+                with fase('cargar_comentarios_libro'):
+                    tabla = cargar_comentarios_libro(libro)
+                CACHE_COMENTARIOS.guardar(libro, tabla, _tamano_tabla(tabla))
+    return tabla
+
+def _leer_popularidad():
+    try:
+        with open(ARCHIVO_POPULARIDAD, 'r', encoding='utf-8') as f:
+            return Counter(json.load(f))
+    except (OSError, ValueError):
+        return Counter()
+
+def guardar_popularidad():
+    """Acumula las consultas por libro de este proceso en ARCHIVO_POPULARIDAD"""
+    with _lock_popularidad:
+        consultas = Counter(POPULARIDAD_COMENTARIOS)
+        POPULARIDAD_COMENTARIOS.clear()
+    if not consultas:
+        return
+    try:
+        popularidad = _leer_popularidad() + consultas
+        temporal = f"{ARCHIVO_POPULARIDAD}.{os.getpid()}.tmp"
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(popularidad, f, ensure_ascii=False)
+        os.replace(temporal, ARCHIVO_POPULARIDAD)
+    except OSError as e:
+        logger.warning("No se pudo guardar %s: %s", ARCHIVO_POPULARIDAD, e)
+        # Se vuelven a sumar para el siguiente intento
+        with _lock_popularidad:
+            POPULARIDAD_COMENTARIOS.update(consultas)
+
+def precargar_comentarios():
+    """Carga los comentarios de los libros más consultados (o los de LIBROS_PRECARGA)"""
+    libros = [l for l in os.environ.get('LIBROS_PRECARGA', '').split(',') if l.strip()]
+    if not libros:
+        libros = [libro for libro, _ in _leer_popularidad().most_common(PRECARGA_COMENTARIOS)]
+    
+    for libro in libros:
+        libro = normalizar_nombre_libro(libro)
+        if libro not in CACHE_COMENTARIOS:
+            tabla = cargar_comentarios_libro(libro)
+            CACHE_COMENTARIOS.guardar(libro, tabla, _tamano_tabla(tabla))
+
+def iniciar_precarga_comentarios():
+    """Lanza la precarga en un hilo para no retrasar el arranque"""
+    if COMENTARIOS_PEREZOSOS:
+        threading.Thread(target=precargar_comentarios, name='precarga-comentarios', daemon=True).start()
+
+# Funciones que lanzan los hilos de fondo de cada proceso que atiende peticiones
+HILOS_PROCESO = [iniciar_pool_busqueda, iniciar_precarga_comentarios]
+# Proceso en el que ya se lanzaron
+_PID_HILOS = None
+_lock_hilos_proceso = threading.Lock()
+
+@app.before_request
+def iniciar_hilos_proceso():
+    """Lanza los hilos de HILOS_PROCESO una vez por proceso
+    
+    Se llama antes de cada petición, nunca al importar app.py: ni el maestro de
+    gunicorn (con preload_app) ni los scripts que importan app.py
+    (compilar_snapshot.py, benchmark.py) los lanzan, y los workers no se crean
+    por fork desde un proceso con hilos. Cada worker los lanza en su primera
+    petición; los procesos del pool de búsqueda no atienden peticiones, así que
+    nunca los lanzan.
+    """
+    global _PID_HILOS
+    if _PID_HILOS == os.getpid():
+        return
+    with _lock_hilos_proceso:
+        if _PID_HILOS != os.getpid():
+            _PID_HILOS = os.getpid()
+            for iniciar in HILOS_PROCESO:
+                iniciar()
+
+registrar_fuente_comentarios('principal', None, [f'data/comment/{i}.json' for i in range(1, 67)],
+                             cargar_comentarios, cargar_libro_principal,
+                             compilar_comentarios_principales, alcance='comentarios')
+registrar_fuente_comentarios('cba', '[CBA]', ['data/cba.json'], cargar_comentarios_cba,
+                             cargar_libro_cba, compilar_comentarios_cba)
+registrar_fuente_comentarios('cba2', '[CBA 2]', ['data/cba2.json'], cargar_comentarios_cba2,
+                             cargar_libro_cba2, compilar_comentarios_cba2)
+
+# Resultados de /buscar recientes: memoria máxima aproximada (MB) de la caché por consulta
+MEMORIA_BUSQUEDAS_MB = int(os.environ.get('MEMORIA_BUSQUEDAS_MB', 16))
+# Búsquedas calculándose a la vez en el worker (0 = sin límite)
+BUSQUEDAS_SIMULTANEAS = int(os.environ.get('BUSQUEDAS_SIMULTANEAS', 4))
+# Búsquedas que pueden esperar un hueco; con la cola llena se rechazan al momento (429)
+COLA_BUSQUEDAS = int(os.environ.get('COLA_BUSQUEDAS', 16))
+# Segundos que una búsqueda espera un hueco antes de rechazarse (503)
+ESPERA_BUSQUEDA = float(os.environ.get('ESPERA_BUSQUEDA', 0.5))
+
+CACHE_BUSQUEDAS = CacheLRU(MEMORIA_BUSQUEDAS_MB * 1024 * 1024)
+# Consultas calculándose ahora: clave -> {'evento', 'resultado' o 'error'}
+_BUSQUEDAS_EN_CURSO = {}
+_lock_busquedas = threading.Lock()
+_HUECOS_BUSQUEDA = threading.BoundedSemaphore(BUSQUEDAS_SIMULTANEAS) if BUSQUEDAS_SIMULTANEAS > 0 else None
+_esperando_hueco = 0
+
+class BusquedaRechazada(Exception):
+    """La búsqueda no se admite ahora: estado 429 (cola llena) o 503 (sin hueco a tiempo)"""
+
+    def __init__(self, estado, mensaje):
+        super().__init__(mensaje)
+        self.estado = estado
+
+@contextlib.contextmanager
+def hueco_busqueda():
+    """Reserva uno de los BUSQUEDAS_SIMULTANEAS huecos para calcular una búsqueda
+
+    Así una avalancha de búsquedas no ocupa todos los hilos y las lecturas de
+    versículos y comentarios siguen respondiendo. Si ya hay COLA_BUSQUEDAS
+    esperando se rechaza al momento (429); si el hueco no llega en ESPERA_BUSQUEDA
+    segundos, también (503).
+    """
+    global _esperando_hueco
+    if _HUECOS_BUSQUEDA is None:
+        yield
+        return
+    if not _HUECOS_BUSQUEDA.acquire(blocking=False):
+        with _lock_busquedas:
+            if _esperando_hueco >= COLA_BUSQUEDAS:
+                raise BusquedaRechazada(429, 'Demasiadas búsquedas en curso, inténtelo de nuevo en un momento')
+            _esperando_hueco += 1
+        try:
+            admitida = _HUECOS_BUSQUEDA.acquire(timeout=ESPERA_BUSQUEDA)
+        finally:
+            with _lock_busquedas:
+                _esperando_hueco -= 1
+        if not admitida:
+            raise BusquedaRechazada(503, 'El servicio de búsqueda está saturado, inténtelo de nuevo en un momento')
+    try:
+        yield
+    finally:
+        _HUECOS_BUSQUEDA.release()
+
+def _esperar_busqueda(vuelo):
+    """Resultado de una búsqueda que calcula otra petición
+    
+    La espera está fuera de los huecos de hueco_busqueda(): se acota con
+    PLAZO_BUSQUEDA para que una búsqueda lenta no retenga sin límite los hilos de
+    todas las peticiones que la esperan.
+    """
+    contar('biblia_busquedas_compartidas_total')
+    if not vuelo['evento'].wait(PLAZO_BUSQUEDA):
+        raise BusquedaRechazada(503, 'La búsqueda está tardando demasiado, inténtelo de nuevo en un momento')
+    if 'error' in vuelo:
+        raise vuelo['error']
+    return vuelo['resultado']
+
+def _vuelo_busqueda(clave, indice):
+    """(cálculo en curso de la consulta, si le toca calcularla a esta petición)"""
+    with _lock_busquedas:
+        vuelo = _BUSQUEDAS_EN_CURSO.get((clave, id(indice)))
+        if vuelo is not None:
+            return vuelo, False
+        vuelo = _BUSQUEDAS_EN_CURSO[(clave, id(indice))] = {'evento': threading.Event()}
+        return vuelo, True
+
+def _terminar_vuelo(clave, indice, vuelo):
+    """Da por terminado el cálculo: despierta a las peticiones que esperan su resultado o su error"""
+    with _lock_busquedas:
+        _BUSQUEDAS_EN_CURSO.pop((clave, id(indice)), None)
+    vuelo['evento'].set()
+
+def busqueda_compartida(clave, indice, calcular, guardar=lambda resultado: True, tamano=len):
+    """Resultado de una consulta, calculado una sola vez aunque llegue muchas veces a la vez
+
+    clave identifica la consulta con su término normalizado (no incluye el
+    índice: el resultado se guarda junto al índice con que se calculó y sólo vale
+    para ése). Se sirve de CACHE_BUSQUEDAS si está; si otra petición ya la está
+    calculando, se espera a su resultado (o a su error, también un rechazo) como
+    mucho PLAZO_BUSQUEDA segundos, o se rechaza con 503; si no, se calcula dentro
+    de hueco_busqueda() y se guarda en la caché cuando guardar(resultado) lo
+    permite. tamano(resultado) es su número de resultados, para estimar su memoria.
+    """
+    entrada = CACHE_BUSQUEDAS.obtener(clave)
+    if entrada is not None and entrada[0] is indice:
+        return entrada[1]
+
+    vuelo, lider = _vuelo_busqueda(clave, indice)
+    if not lider:
+        return _esperar_busqueda(vuelo)
+
+    try:
+        with hueco_busqueda():
+            resultado = calcular()
+        vuelo['resultado'] = resultado
+    except Exception as e:
+        vuelo['error'] = e
+        raise
+    finally:
+        _terminar_vuelo(clave, indice, vuelo)
+
+    if guardar(resultado):
+        # Tamaño aproximado: una tupla o un ID por resultado
+        CACHE_BUSQUEDAS.guardar(clave, (indice, resultado), 64 * (tamano(resultado) + 1))
+    return resultado
+
+def rechazo_busqueda(error):
+    """Respuesta de una búsqueda rechazada por el control de admisión"""
+    contar('biblia_busquedas_rechazadas_total', estado=str(error.estado))
+    respuesta = jsonify({'error': str(error)})
+    respuesta.status_code = error.estado
+    respuesta.headers['Retry-After'] = '1'
+    return respuesta
+
+# Snapshot compilado de todas las fuentes (ver compilar_snapshot.py)
+ARCHIVO_SNAPSHOT = os.environ.get('ARCHIVO_SNAPSHOT', 'data/biblia.snapshot')
+USAR_SNAPSHOT = os.environ.get('USAR_SNAPSHOT', '1') != '0'
+
+# Incrementar al cambiar la forma de cualquier estructura guardada en el snapshot
+VERSION_SNAPSHOT = 9
+
+def archivos_fuente():
+    """Rutas de los JSON de los que se construyen los datos, existan o no"""
+    return (['data/RV1960.json']
+            + [archivo for fuente in FUENTES_COMENTARIOS for archivo in fuente['archivos']]
+            + ['data/cba_append.json'])
+
+def _hash_archivo(ruta):
+    with open(ruta, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def huella_fuentes():
+    """Tamaño, fecha de modificación y hash de cada archivo fuente (None si no existe)"""
+    huella = {}
+    for ruta in archivos_fuente():
+        try:
+            estado = os.stat(ruta)
+        except OSError:
+            huella[ruta] = None
+            continue
+        huella[ruta] = {
+            'tamano': estado.st_size,
+            'mtime': estado.st_mtime_ns,
+            'hash': _hash_archivo(ruta)
+        }
+    return huella
+
+def snapshot_vigente(huella_guardada):
+    """Comprueba que ninguna fuente haya cambiado desde que se compiló el snapshot
+    
+    La fecha y el tamaño bastan en el caso normal; sólo si la fecha cambió (p. ej.
+    tras copiar o clonar los datos) se recalcula el hash para confirmarlo.
+    """
+    for ruta in archivos_fuente():
+        guardado = huella_guardada.get(ruta)
+        try:
+            estado = os.stat(ruta)
+        except OSError:
+            if guardado is not None:
+                return False
+            continue
+        if guardado is None or estado.st_size != guardado['tamano']:
+            return False
+        if estado.st_mtime_ns != guardado['mtime'] and _hash_archivo(ruta) != guardado['hash']:
+            return False
+    return True
+
+def cargar_snapshot(ruta=None):
+    """Carga el snapshot compilado si existe y coincide con las fuentes actuales"""
+    ruta = ruta or ARCHIVO_SNAPSHOT
+    if not USAR_SNAPSHOT or not os.path.exists(ruta):
+        return None
+    
+    try:
+        inicio = time.perf_counter()
+        # El snapshot lo genera compilar_snapshot.py en el propio servidor: es de confianza
+        with open(ruta, 'rb') as f:
+            snapshot = pickle.load(f)
+        
+        if snapshot.get('version') != VERSION_SNAPSHOT:
+            print(f"⚠️  Snapshot {ruta} de otra versión, cargando desde JSON")
+            return None
+        if not snapshot_vigente(snapshot.get('fuentes', {})):
+            print(f"⚠️  Snapshot {ruta} desactualizado, cargando desde JSON "
+                  f"(ejecute compilar_snapshot.py para regenerarlo)")
+            return None
+        
+        print(f"✅ Snapshot {ruta} cargado en {time.perf_counter() - inicio:.2f}s")
+        return snapshot['datos']
+    except Exception as e:
+        print(f"❌ Error cargando snapshot {ruta}: {e}")
+        return None
+
+def guardar_snapshot(datos, ruta=None):
+    """Escribe el snapshot de forma atómica junto con la huella de las fuentes"""
+    ruta = ruta or ARCHIVO_SNAPSHOT
+    snapshot = {
+        'version': VERSION_SNAPSHOT,
+        'fuentes': huella_fuentes(),
+        'datos': datos
+    }
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporal, ruta)
+    print(f"✅ Snapshot guardado en {ruta} ({os.path.getsize(ruta) / 1e6:.1f} MB)")
+
+def construir_indices_busqueda(tabla_comentarios, cba_append):
+    """Índices de /buscar?scope= distintos de los versículos
+    
+    Con carga perezosa los de comentarios se dejan para indice_alcance.
+    """
+    indices = {'apendices': construir_indice_apendices(cba_append)}
+    if not COMENTARIOS_PEREZOSOS:
+        for alcance in dict.fromkeys(fuente['alcance'] for fuente in FUENTES_COMENTARIOS):
+            indices[alcance] = construir_indice_comentarios(alcance, tabla_comentarios.items())
+    return indices
+
+def cargar_desde_json():
+    """Carga todas las fuentes JSON y construye las estructuras derivadas"""
+    biblia = cargar_biblia()
+    almacen = construir_almacen_versiculos(biblia)
+    indice_busqueda = construir_indice_busqueda(almacen)
+    if COMENTARIOS_PEREZOSOS:
+        print("💤 Comentarios en carga perezosa: se leerán por libro al consultarlos")
+        comentarios = {fuente['nombre']: {} for fuente in FUENTES_COMENTARIOS}
+    else:
+        comentarios = {fuente['nombre']: fuente['cargar']() for fuente in FUENTES_COMENTARIOS}
+    
+    tabla_comentarios = construir_tabla_comentarios(comentarios)
+    print(f"✅ Tabla de comentarios construida: {sum(map(len, tabla_comentarios.values()))} versículos con comentario")
+    cba_append = cargar_cba_append()
+    return {
+        'biblia': biblia,
+        'comentarios': comentarios,
+        'cba_append': cba_append,
+        'tabla_comentarios': tabla_comentarios,
+        'almacen_versiculos': almacen,
+        'indice_busqueda': indice_busqueda,
+        'sugerencias': construir_sugerencias(indice_busqueda),
+        'indices_busqueda': construir_indices_busqueda(tabla_comentarios, cba_append),
+        # Con carga perezosa se construye en la primera consulta (ver indice_citas)
+        'indice_citas': None if COMENTARIOS_PEREZOSOS else construir_indice_citas(tabla_comentarios.items(),
+                                                                                biblia)
+    }
+
+# Almacén de los textos: 'memoria' (cada worker guarda sus cadenas) o 'mmap'
+# (un único archivo de sólo lectura mapeado en memoria y compartido por todos los workers)
+ALMACEN_CORPUS = os.environ.get('ALMACEN_CORPUS', 'memoria')
+ARCHIVO_CORPUS = os.environ.get('ARCHIVO_CORPUS', 'data/biblia.corpus')
+MAGIA_CORPUS = b'BIBCORP1'
+
+# En modo 'mmap': el archivo mapeado y los offsets de inicio de cada texto (más el final)
+CORPUS = None
+OFFSETS_CORPUS = None
+
+def texto_corpus(valor):
+    """Devuelve el texto de un valor del corpus
+    
+    En modo 'memoria' los valores ya son cadenas. En modo 'mmap' las estructuras
+    guardan el número de texto y éste se lee del archivo mapeado sólo al usarlo.
+    """
+    if CORPUS is not None and type(valor) is int:
+        return str(CORPUS[OFFSETS_CORPUS[valor]:OFFSETS_CORPUS[valor + 1]], 'utf-8')
+    return valor
+
+def extraer_textos(datos):
+    """Separa los textos de las estructuras para el corpus mapeado
+    
+    Devuelve una copia de datos donde cada texto de versículo o comentario se
+    sustituye por su número, y la lista de textos en ese orden. Los textos
+    repetidos y las entradas compartidas por varios versículos se guardan una vez.
+    """
+    textos = []
+    numeros = {}
+    
+    def numero(texto):
+        if not isinstance(texto, str):
+            return texto
+        if texto not in numeros:
+            numeros[texto] = len(textos)
+            textos.append(texto)
+        return numeros[texto]
+    
+    biblia = {
+        libro: {capitulo: {v: numero(t) for v, t in versiculos.items()}
+                for capitulo, versiculos in capitulos.items()}
+        for libro, capitulos in datos['biblia'].items()
+    }
+    
+    # El índice de versículos comparte la lista de textos del almacén
+    almacen = dict(datos['almacen_versiculos'], textos=[numero(t) for t in datos['almacen_versiculos']['textos']])
+    indice = dict(datos['indice_busqueda'], almacen=almacen, documentos=almacen['textos'])
+    
+    indices = dict(datos['indices_busqueda'])
+    indices['apendices'] = dict(indices['apendices'], documentos=[
+        (documento, ruta, numero(t)) for documento, ruta, t in indices['apendices']['documentos']])
+    
+    entradas = {}
+    tabla = {}
+    for libro, tabla_libro in datos['tabla_comentarios'].items():
+        tabla[libro] = {}
+        for clave, fuentes in tabla_libro.items():
+            tabla[libro][clave] = {}
+            for fuente, entrada in fuentes.items():
+                if id(entrada) not in entradas:
+                    entradas[id(entrada)] = dict(entrada, comentario=numero(entrada['comentario']))
+                tabla[libro][clave][fuente] = entradas[id(entrada)]
+    
+    def despojar(valor):
+        if isinstance(valor, dict):
+            return {clave: despojar(v) for clave, v in valor.items()}
+        if isinstance(valor, list):
+            return [despojar(v) for v in valor]
+        return numero(valor)
+    
+    # Los datos crudos de las fuentes se guardan tal cual, con cada cadena numerada
+    comentarios = despojar(datos['comentarios'])
+    
+    despojados = dict(
+        datos,
+        biblia=biblia,
+        almacen_versiculos=almacen,
+        indice_busqueda=indice,
+        indices_busqueda=indices,
+        tabla_comentarios=tabla,
+        comentarios=comentarios
+    )
+    return despojados, textos
+
+def guardar_corpus(datos, ruta=None):
+    """Escribe el corpus mapeable y, junto a él, el snapshot con las estructuras sin textos
+    
+    Formato del corpus: MAGIA_CORPUS, id de compilación (16 bytes), número de
+    textos n (uint64), n+1 offsets absolutos (uint64 nativos) y los textos UTF-8.
+    """
+    ruta = ruta or ARCHIVO_CORPUS
+    despojados, textos = extraer_textos(datos)
+    codificados = [t.encode('utf-8') for t in textos]
+    id_compilacion = os.urandom(16)
+    
+    offsets = array('Q')
+    posicion = len(MAGIA_CORPUS) + 16 + 8 + (len(codificados) + 1) * 8
+    for codificado in codificados:
+        offsets.append(posicion)
+        posicion += len(codificado)
+    offsets.append(posicion)
+    
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    with open(temporal, 'wb') as f:
+        f.write(MAGIA_CORPUS)
+        f.write(id_compilacion)
+        f.write(len(codificados).to_bytes(8, 'little'))
+        f.write(offsets.tobytes())
+        for codificado in codificados:
+            f.write(codificado)
+    os.replace(temporal, ruta)
+    print(f"✅ Corpus guardado en {ruta} ({len(textos)} textos, {posicion / 1e6:.1f} MB)")
+    
+    despojados['id_corpus'] = id_compilacion
+    guardar_snapshot(despojados, f"{ruta}.snapshot")
+
+def cargar_corpus_mapeado():
+    """Mapea el corpus compartido y carga sus estructuras; None si no está disponible"""
+    global CORPUS, OFFSETS_CORPUS
+    
+    if not os.path.exists(ARCHIVO_CORPUS):
+        print(f"⚠️  Corpus {ARCHIVO_CORPUS} no encontrado (ejecute compilar_snapshot.py --mmap)")
+        return None
+    
+    datos = cargar_snapshot(f"{ARCHIVO_CORPUS}.snapshot")
+    if datos is None:
+        return None
+    
+    try:
+        with open(ARCHIVO_CORPUS, 'rb') as f:
+            mapa = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        inicio = len(MAGIA_CORPUS)
+        if mapa[:inicio] != MAGIA_CORPUS or mapa[inicio:inicio + 16] != datos.get('id_corpus'):
+            print(f"⚠️  Corpus {ARCHIVO_CORPUS} no corresponde a su snapshot, cargando desde JSON")
+            mapa.close()
+            return None
+        
+        cantidad = int.from_bytes(mapa[inicio + 16:inicio + 24], 'little')
+        inicio_offsets = inicio + 24
+        OFFSETS_CORPUS = memoryview(mapa)[inicio_offsets:inicio_offsets + (cantidad + 1) * 8].cast('Q')
+        CORPUS = mapa
+        print(f"✅ Corpus mapeado en memoria compartida: {cantidad} textos")
+        return datos
+    except Exception as e:
+        print(f"❌ Error mapeando corpus {ARCHIVO_CORPUS}: {e}")
+        return None
+
+def cargar_datos():
+    """Carga los datos desde el corpus mapeado, el snapshot compilado o los JSON"""
+    if ALMACEN_CORPUS == 'mmap':
+        datos = cargar_corpus_mapeado()
+        if datos is not None:
+            return datos
+        print("⚠️  Usando almacén en memoria")
+    
+    datos = cargar_snapshot()
+    if datos is None:
+        datos = cargar_desde_json()
+    elif COMENTARIOS_PEREZOSOS:
+        # El snapshot trae todos los comentarios: se descartan y se leerán por libro
+        datos = dict(datos, comentarios={nombre: {} for nombre in datos['comentarios']},
+                     tabla_comentarios={})
+    return datos
+
+def datos_actuales():
+    """Versión de los datos (DATOS) que ve la petición en curso
+    
+    Se fija en la primera lectura y dura toda la petición (también las respuestas
+    en streaming), aunque una recarga publique otra mientras tanto: una vista no
+    mezcla nunca estructuras de dos versiones. Fuera de una petición (arranque,
+    recargas, procesos de búsqueda) es la última publicada.
+    """
+    if not has_request_context():
+        return DATOS
+    if 'datos' not in g:
+        g.datos = DATOS
+    return g.datos
+
+def libro_en_biblia(libro, biblia=None):
+    """Clave de la Biblia (o de la versión biblia) para cualquier forma aceptada del nombre del libro, o None"""
+    biblia = datos_actuales()['biblia'] if biblia is None else biblia
+    for candidato in (libro, normalizar_nombre_libro(libro)):
+        if candidato in biblia and es_diccionario_valido(biblia[candidato]):
+            return candidato
+    return None
+
+def textos_capitulo(versiculos):
+    """Versículos de un capítulo con sus textos, sea cual sea el almacén"""
+    if CORPUS is None:
+        return versiculos
+    return {v: texto_corpus(t) for v, t in versiculos.items()}
+
 # Cargar datos al iniciar
 print("=" * 60)
 print("INICIANDO CARGA DE BIBLIA DIGITAL")
 print("=" * 60)
 
-BIBLIA = cargar_biblia()
-COMENTARIOS = cargar_comentarios()
-COMENTARIOS_CBA = cargar_comentarios_cba()
-CBA_APPEND = cargar_cba_append()
+def publicar_datos(datos):
+    """Publica una versión de los datos para las vistas
+    
+    Cada versión es inmutable: una recarga construye estructuras nuevas (que
+    comparten con la anterior todo lo que no cambió) y las publica aquí de una vez,
+    sustituyendo DATOS. Las vistas leen sus estructuras de datos_actuales(), así
+    que una petición en curso sigue viendo completa la versión con la que empezó.
+    """
+    global DATOS
+    DATOS = dict(datos, rangos_libros=rangos_libros(datos['almacen_versiculos']))
+    # Los resultados guardados son de los índices anteriores: sólo retendrían su memoria
+    CACHE_BUSQUEDAS.limpiar()
+
+# Sello de cada archivo fuente en los datos publicados (ver revisar_datos)
+SELLOS_DATOS = {}
+
+def sellos_fuentes():
+    """Fecha de modificación y tamaño de cada archivo fuente (None si no existe)"""
+    sellos = {}
+    for ruta in archivos_fuente():
+        try:
+            estado = os.stat(ruta)
+            sellos[ruta] = (estado.st_mtime_ns, estado.st_size)
+        except OSError:
+            sellos[ruta] = None
+    return sellos
+
+# Se toman antes de cargar, para que un cambio durante la carga se recargue después
+SELLOS_DATOS.update(sellos_fuentes())
+publicar_datos(cargar_datos())
+
+if COMENTARIOS_PEREZOSOS:
+    atexit.register(guardar_popularidad)
 
 print("\n" + "=" * 60)
 print("RESUMEN FINAL")
 print("=" * 60)
-print(f"📚 Libros cargados en la Biblia: {len(BIBLIA)}")
-print(f"💭 Libros con comentarios principales: {len(COMENTARIOS)}")
-print(f"📖 Comentarios CBA cargados: {len(COMENTARIOS_CBA)}")
-print(f"📋 Documentos CBA cargados: {len(CBA_APPEND)}")
+print(f"📚 Libros cargados en la Biblia: {len(DATOS['biblia'])}")
+for fuente in FUENTES_COMENTARIOS:
+    print(f"💭 Libros con comentarios {fuente['etiqueta'] or 'principales'}: "
+          f"{len(DATOS['comentarios'].get(fuente['nombre'], {}))}")
+print(f"📋 Documentos CBA cargados: {len(DATOS['cba_append'])}")
+
+# Recarga en caliente: segundos entre revisiones de data/ (0, por defecto, la desactiva).
+# Cada worker revisa data/ por su cuenta y vuelve a leer y a indexar en su proceso lo
+# que cambió, así que sólo conviene activarla donde data/ se edita con el servidor en
+# marcha (p. ej. INTERVALO_RECARGA_DATOS=5); si no, los cambios se aplican reiniciando.
+# Activa, las respuestas cacheadas se envían con no-cache en lugar de CACHE_MAX_AGE.
+INTERVALO_RECARGA_DATOS = float(os.environ.get('INTERVALO_RECARGA_DATOS', 0))
+if INTERVALO_RECARGA_DATOS > 0 and BUSQUEDA_PROCESOS:
+    # Tras una recarga el pool tendría que crearse de nuevo por fork desde un worker
+    # con hilos (ver iniciar_pool_busqueda): las consultas pesadas se hacen en el worker
+    print("⚠️  INTERVALO_RECARGA_DATOS desactiva BUSQUEDA_PROCESOS")
+    BUSQUEDA_PROCESOS = 0
+
+def _es_json_valido(ruta):
+    try:
+        with open(ruta, 'rb') as f:
+            json.load(f)
+        return True
+    except (OSError, ValueError):
+        return False
+
+def _textos_libro(capitulos):
+    """Contenido comparable de un libro de la Biblia, sea cual sea el almacén"""
+    if not es_diccionario_valido(capitulos):
+        return capitulos
+    return {capitulo: textos_capitulo(versiculos) if isinstance(versiculos, dict) else versiculos
+            for capitulo, versiculos in capitulos.items()}
+
+def _contenido_entradas(entradas):
+    """Contenido comparable de las entradas (capítulo, versículo) -> entrada de una fuente"""
+    return {clave: (entrada['versiculo'], texto_corpus(entrada['comentario']), entrada.get('referencia'),
+                    entrada['encontrado'], entrada['referencias_separadas'])
+            for clave, entrada in entradas.items()}
+
+def recargar_biblia():
+    """Vuelve a leer RV1960.json y sustituye sólo los libros que cambiaron
+    
+    El almacén, el índice de versículos y sus sugerencias se reconstruyen enteros (sus IDs son
+    globales) y el pool de búsqueda se renueva; se invalidan las respuestas de los
+    libros cambiados.
+    """
+    nueva = cargar_biblia()
+    if not nueva:
+        logger.error("❌ RV1960.json no se pudo recargar: se mantienen los datos actuales")
+        return []
+    
+    actual = DATOS['biblia']
+    cambiados = [libro for libro in dict.fromkeys(list(nueva) + list(actual))
+                 if _textos_libro(nueva.get(libro)) != _textos_libro(actual.get(libro))]
+    if not cambiados:
+        return []
+    
+    biblia = {libro: nueva[libro] if libro in cambiados else actual[libro] for libro in nueva}
+    # Las citas de capítulos enteros o entre capítulos dependen de los versículos de cada capítulo
+    citas = None if COMENTARIOS_PEREZOSOS else construir_indice_citas(DATOS['tabla_comentarios'].items(), biblia)
+    almacen = construir_almacen_versiculos(biblia)
+    indice = construir_indice_busqueda(almacen)
+    publicar_datos(dict(DATOS, biblia=biblia, almacen_versiculos=almacen, indice_busqueda=indice,
+                        sugerencias=construir_sugerencias(indice), indice_citas=citas))
+    # Los tramos memoizados son del almacén anterior: ya no se usarían, se libera su memoria
+    CACHE_REFERENCIAS.limpiar()
+    for libro in cambiados:
+        invalidar_respuestas('capitulos', libro)
+        invalidar_respuestas('versiculos', libro)
+        invalidar_respuestas('capitulo', libro)
+    return cambiados
+
+def recargar_cba_append():
+    """Vuelve a leer cba_append.json y su índice de búsqueda"""
+    cba_append = cargar_cba_append()
+    if cba_append == DATOS['cba_append']:
+        return []
+    indices = dict(DATOS['indices_busqueda'], apendices=construir_indice_apendices(cba_append))
+    publicar_datos(dict(DATOS, cba_append=cba_append, indices_busqueda=indices))
+    invalidar_respuestas('cba_append')
+    return list(cba_append)
+
+def recargar_comentarios(fuente):
+    """Vuelve a leer una fuente de comentarios y sustituye sólo los libros que cambiaron
+    
+    Cada libro se compara con su tabla actual (en carga perezosa, sólo los que están
+    en la caché: el resto se leerá ya del archivo nuevo). Los libros cambiados se
+    vuelven a compilar con todas sus fuentes y se publican de una vez, junto con el
+    índice de búsqueda del alcance de la fuente.
+    """
+    nombre = fuente['nombre']
+    # Las posiciones de cada libro en el archivo ya no son válidas
+    with _lock_indices_comentarios:
+        _INDICES_COMENTARIOS.pop(nombre, None)
+    
+    if COMENTARIOS_PEREZOSOS:
+        candidatos = [libro for libro in TODOS_LIBROS if libro in CACHE_COMENTARIOS]
+        actual = CACHE_COMENTARIOS.ver
+    else:
+        candidatos = list(dict.fromkeys(TODOS_LIBROS + list(DATOS['tabla_comentarios'])))
+        actual = DATOS['tabla_comentarios'].get
+    
+    cambiados = []
+    for libro in candidatos:
+        datos = fuente['cargar_libro'](libro)
+        nuevas = fuente['compilar'](datos) if datos is not None else {}
+        actuales = {clave: entradas[nombre] for clave, entradas in (actual(libro) or {}).items()
+                    if nombre in entradas}
+        if _contenido_entradas(nuevas) != _contenido_entradas(actuales):
+            cambiados.append(libro)
+    
+    crudos = {libro: leer_comentarios_libro(libro) for libro in cambiados}
+    tablas = {libro: construir_tabla_comentarios(crudos[libro]).get(libro, {}) for libro in cambiados}
+    
+    if COMENTARIOS_PEREZOSOS:
+        for libro, tabla in tablas.items():
+            CACHE_COMENTARIOS.guardar(libro, tabla, _tamano_tabla(tabla))
+        # Los libros fuera de la caché pueden haber cambiado: el índice se reconstruirá al usarlo
+        indices = {alcance: indice for alcance, indice in DATOS['indices_busqueda'].items()
+                   if alcance != fuente['alcance']}
+        publicar_datos(dict(DATOS, indices_busqueda=indices, indice_citas=None))
+        # Un capítulo cacheado de un libro que ya salió de la caché no se puede comparar
+        paquetes = {clave[1] for clave in list(RESPUESTAS_CACHE)
+                    if isinstance(clave, tuple) and clave[0] == 'capitulo' and clave[1] not in candidatos}
+        for libro in set(cambiados) | paquetes:
+            invalidar_respuestas('capitulo', libro)
+        return cambiados
+    
+    if not cambiados:
+        return []
+    tabla_comentarios = dict(DATOS['tabla_comentarios'], **tablas)
+    comentarios = {}
+    for nombre_fuente, libros in DATOS['comentarios'].items():
+        comentarios[nombre_fuente] = dict(libros)
+        for libro in cambiados:
+            comentarios[nombre_fuente].pop(libro, None)
+            comentarios[nombre_fuente].update(crudos[libro].get(nombre_fuente, {}))
+    indices = dict(DATOS['indices_busqueda'])
+    indices[fuente['alcance']] = construir_indice_comentarios(fuente['alcance'], tabla_comentarios.items())
+    publicar_datos(dict(DATOS, comentarios=comentarios, tabla_comentarios=tabla_comentarios,
+                        indices_busqueda=indices,
+                        indice_citas=construir_indice_citas(tabla_comentarios.items(), DATOS['biblia'])))
+    for libro in cambiados:
+        invalidar_respuestas('capitulo', libro)
+    return cambiados
+
+def revisar_datos():
+    """Recarga los archivos de data/ que cambiaron desde la última revisión
+    
+    Un archivo a medio escribir todavía no es JSON válido: se deja para la
+    siguiente revisión. Borrar la Biblia o los apéndices no se aplica; borrar el
+    archivo de comentarios de un libro sí.
+    """
+    sellos = sellos_fuentes()
+    cambiados = [ruta for ruta, sello in sellos.items() if sello != SELLOS_DATOS.get(ruta)]
+    listos = [ruta for ruta in cambiados
+              if (sellos[ruta] is not None and _es_json_valido(ruta))
+              or (sellos[ruta] is None and ruta.startswith('data/comment/'))]
+    
+    # (datos, archivos, función de recarga), una por fuente aunque cambien varios de sus archivos
+    recargas = []
+    if 'data/RV1960.json' in listos:
+        recargas.append(('biblia', ['data/RV1960.json'], recargar_biblia))
+    for fuente in FUENTES_COMENTARIOS:
+        archivos = [ruta for ruta in listos if ruta in fuente['archivos']]
+        if archivos:
+            recargas.append((fuente['nombre'], archivos, lambda fuente=fuente: recargar_comentarios(fuente)))
+    if 'data/cba_append.json' in listos:
+        recargas.append(('cba_append', ['data/cba_append.json'], recargar_cba_append))
+    
+    for ruta in listos:
+        SELLOS_DATOS[ruta] = sellos[ruta]
+    for datos, archivos, recargar in recargas:
+        inicio = time.perf_counter()
+        afectados = recargar()
+        contar('biblia_recargas_total', datos=datos)
+        logger.warning("🔄 Recargado %s en %.2fs: %s", ', '.join(archivos), time.perf_counter() - inicio,
+                       ', '.join(afectados) or 'sin cambios')
+
+def vigilar_datos():
+    while True:
+        time.sleep(INTERVALO_RECARGA_DATOS)
+        try:
+            revisar_datos()
+        except Exception as e:
+            logger.exception("❌ Error recargando datos: %s", e)
+
+def iniciar_vigilancia_datos():
+    """Lanza en un hilo la revisión periódica de data/ (uno por worker) si INTERVALO_RECARGA_DATOS lo activa"""
+    if INTERVALO_RECARGA_DATOS > 0:
+        threading.Thread(target=vigilar_datos, name='recarga-datos', daemon=True).start()
+
+HILOS_PROCESO.append(iniciar_vigilancia_datos)
+
+@app.after_request
+def comprimir_respuesta(respuesta):
+    """Comprime al vuelo las respuestas dinámicas grandes (comentarios, búsquedas)"""
+    # Las respuestas con ETag salen de RESPUESTAS_CACHE, que ya negoció su variante
+    if (respuesta.status_code != 200 or respuesta.direct_passthrough or respuesta.is_streamed
+            or 'ETag' in respuesta.headers or 'Content-Encoding' in respuesta.headers
+            or respuesta.mimetype not in TIPOS_COMPRIMIBLES):
+        return respuesta
+    
+    cuerpo = respuesta.get_data()
+    if len(cuerpo) < UMBRAL_COMPRESION:
+        return respuesta
+    
+    respuesta.vary.add('Accept-Encoding')
+    codificacion = request.accept_encodings.best_match(codificaciones_disponibles())
+    if codificacion:
+        respuesta.set_data(comprimir_cacheado(cuerpo, codificacion))
+        respuesta.headers['Content-Encoding'] = codificacion
+    return respuesta
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    # En modo debug la plantilla se vuelve a renderizar para ver los cambios al momento
+    if app.debug:
+        return render_template('index.html')
+    return respuesta_cacheada(
+        'index',
+        lambda: render_template('index.html').encode('utf-8'),
+        'text/html',
+        max_age=None
+    )
 
 @app.route('/libros')
 def obtener_libros():
     """Retorna los libros organizados por testamento"""
-    if BIBLIA:
-        return jsonify(ORDEN_LIBROS)
-    return jsonify({"Antiguo Testamento": [], "Nuevo Testamento": []})
+    if datos_actuales()['biblia']:
+        return respuesta_json_cacheada('libros', lambda: ORDEN_LIBROS)
+    return respuesta_json_cacheada('libros', lambda: {"Antiguo Testamento": [], "Nuevo Testamento": []})
 
 @app.route('/capitulos/<libro>')
 def obtener_capitulos(libro):
-    libro_normalizado = normalizar_nombre_libro(libro)
-    
-    # Buscar libro exacto
-    if libro in BIBLIA and es_diccionario_valido(BIBLIA[libro]):
-        capitulos = list(BIBLIA[libro].keys())
-        return jsonify(capitulos)
-    
-    # Buscar por nombre normalizado
-    for libro_biblia in BIBLIA.keys():
-        if normalizar_nombre_libro(libro_biblia) == libro_normalizado:
-            if es_diccionario_valido(BIBLIA[libro_biblia]):
-                capitulos = list(BIBLIA[libro_biblia].keys())
-                return jsonify(capitulos)
+    biblia = datos_actuales()['biblia']
+    libro_real = libro_en_biblia(libro, biblia)
+    if libro_real:
+        return respuesta_json_cacheada(('capitulos', libro_real), lambda: list(biblia[libro_real].keys()))
     
     return jsonify([])
 
 @app.route('/versiculos/<libro>/<capitulo>')
 def obtener_versiculos(libro, capitulo):
-    libro_normalizado = normalizar_nombre_libro(libro)
-    
-    # Buscar libro exacto
-    if libro in BIBLIA and es_diccionario_valido(BIBLIA[libro]):
-        if capitulo in BIBLIA[libro] and isinstance(BIBLIA[libro][capitulo], dict):
-            return jsonify(BIBLIA[libro][capitulo])
-    
-    # Buscar por nombre normalizado
-    for libro_biblia in BIBLIA.keys():
-        if normalizar_nombre_libro(libro_biblia) == libro_normalizado:
-            if es_diccionario_valido(BIBLIA[libro_biblia]):
-                if capitulo in BIBLIA[libro_biblia] and isinstance(BIBLIA[libro_biblia][capitulo], dict):
-                    return jsonify(BIBLIA[libro_biblia][capitulo])
-            break
+    biblia = datos_actuales()['biblia']
+    libro_real = libro_en_biblia(libro, biblia)
+    if libro_real and capitulo in biblia[libro_real] and isinstance(biblia[libro_real][capitulo], dict):
+        return respuesta_json_cacheada(('versiculos', libro_real, capitulo), lambda: textos_capitulo(biblia[libro_real][capitulo]))
     
     return jsonify({})
 
 @app.route('/comentarios/<libro>/<capitulo>/<versiculo>')
 def obtener_comentario(libro, capitulo, versiculo):
     try:
-        libro_normalizado = normalizar_nombre_libro(libro)
-        print(f"Buscando comentario: '{libro}' -> '{libro_normalizado}' {capitulo}:{versiculo}")
-        
-        comentario_principal = ""
-        referencia_principal = ""
-        referencias_separadas_principal = []
-        
-        # 1. BUSCAR EN COMENTARIOS PRINCIPALES (data/comment/)
-        comentario_encontrado_principal = False
-        if libro_normalizado in COMENTARIOS:
-            comentarios_libro = COMENTARIOS[libro_normalizado]
-            
-            for comentario_capitulo in comentarios_libro:
-                if str(comentario_capitulo['capitulo']) == str(capitulo):
-                    for comentario_versiculo in comentario_capitulo['versiculos']:
-                        vers_ref = comentario_versiculo['versiculo']
-                        
-                        # Manejar rangos de versículos
-                        if '-' in vers_ref:
-                            try:
-                                inicio, fin = map(int, vers_ref.split('-'))
-                                if inicio <= int(versiculo) <= fin:
-                                    comentario_principal = comentario_versiculo.get('comentario', '')
-                                    referencia_principal = comentario_versiculo.get('referencia', '')
-                                    # PROCESAR REFERENCIAS DEL COMENTARIO PRINCIPAL
-                                    if referencia_principal:
-                                        referencias_separadas_principal = procesar_referencias(referencia_principal)
-                                    else:
-                                        referencias_separadas_principal = []
-                                    comentario_encontrado_principal = True
-                                    print(f"  ✅ Encontrado comentario principal para rango {vers_ref}")
-                                    break
-                            except ValueError:
-                                continue
-                        # Coincidencia exacta
-                        elif str(vers_ref) == str(versiculo):
-                            comentario_principal = comentario_versiculo.get('comentario', '')
-                            referencia_principal = comentario_versiculo.get('referencia', '')
-                            # PROCESAR REFERENCIAS DEL COMENTARIO PRINCIPAL
-                            if referencia_principal:
-                                referencias_separadas_principal = procesar_referencias(referencia_principal)
-                            else:
-                                referencias_separadas_principal = []
-                            comentario_encontrado_principal = True
-                            print(f"  ✅ Encontrado comentario principal para versículo {vers_ref}")
-                            break
-        
-        # 2. BUSCAR EN COMENTARIOS CBA (data/cba.json)
-        comentario_cba = ""
-        referencias_cba = []
-        comentario_encontrado_cba = False
-        
-        if libro_normalizado in COMENTARIOS_CBA:
-            capitulos_cba = COMENTARIOS_CBA[libro_normalizado]
-            if str(capitulo) in capitulos_cba:
-                versiculos_cba = capitulos_cba[str(capitulo)]
-                
-                for versiculo_ref, datos_versiculo in versiculos_cba.items():
-                    if isinstance(datos_versiculo, dict):
-                        # Manejar rangos de versículos en CBA
-                        if '-' in versiculo_ref:
-                            try:
-                                inicio, fin = map(int, versiculo_ref.split('-'))
-                                if inicio <= int(versiculo) <= fin:
-                                    comentarios_lista = datos_versiculo.get('comentarios', [])
-                                    if comentarios_lista:
-                                        comentario_cba = " ".join(str(c) for c in comentarios_lista)
-                                        comentario_encontrado_cba = True
-                                    referencias = datos_versiculo.get('referencias_cruzadas', [])
-                                    for ref in referencias:
-                                        if ref and ref.strip():
-                                            referencias_cba.extend(procesar_referencias(str(ref)))
-                                    print(f"  ✅ Encontrado comentario CBA para rango {versiculo_ref}")
-                                    break
-                            except ValueError:
-                                continue
-                        # Coincidencia exacta en CBA
-                        elif str(versiculo_ref) == str(versiculo):
-                            comentarios_lista = datos_versiculo.get('comentarios', [])
-                            if comentarios_lista:
-                                comentario_cba = " ".join(str(c) for c in comentarios_lista)
-                                comentario_encontrado_cba = True
-                            referencias = datos_versiculo.get('referencias_cruzadas', [])
-                            for ref in referencias:
-                                if ref and ref.strip():
-                                    referencias_cba.extend(procesar_referencias(str(ref)))
-                            print(f"  ✅ Encontrado comentario CBA para versículo {versiculo_ref}")
-                            break
-        
-        # 3. FUSIONAR COMENTARIOS DE FORMA ELEGANTE
-        comentario_final = ""
-        referencias_finales = referencias_separadas_principal.copy()
-        
-        if comentario_encontrado_principal and comentario_encontrado_cba:
-            # AMBOS EXISTEN: Fusionar con formato bonito
-            comentario_final = f"{comentario_principal}\n\n[CBA]\n{comentario_cba}"
-            print(f"  🔄 Fusionando comentarios: Principal + CBA")
-            
-        elif comentario_encontrado_principal and not comentario_encontrado_cba:
-            # SOLO PRINCIPAL
-            comentario_final = comentario_principal
-            print(f"  📚 Usando solo comentario principal")
-            
-        elif not comentario_encontrado_principal and comentario_encontrado_cba:
-            # SOLO CBA: Usar CBA como principal
-            comentario_final = f"[CBA]\n{comentario_cba}"
-            print(f"  📖 Usando solo comentario CBA")
-            
-        else:
-            # NINGUNO
-            comentario_final = 'No hay comentario disponible para este versículo.'
-            print(f"  ❌ No hay comentarios disponibles")
-        
-        # Combinar referencias
-        referencias_finales.extend(referencias_cba)
-        referencias_finales = list(set(referencias_finales))  # Eliminar duplicados
-        
-        # Combinar referencia principal
-        referencia_final = referencia_principal
-        if referencias_cba:
-            if referencia_final:
-                referencia_final += "; " + "; ".join(referencias_cba)
-            else:
-                referencia_final = "; ".join(referencias_cba)
+        with fase('resolver_libro'):
+            libro_normalizado = normalizar_nombre_libro(libro)
+        logger.debug("Buscando comentario: '%s' -> '%s' %s:%s", libro, libro_normalizado, capitulo, versiculo)
         
-        print(f"  📋 Referencias finales: {referencias_finales}")
+        with fase('buscar_comentario'):
+            # Los rangos ya están expandidos en la tabla: "02" y "2" son el mismo versículo
+            clave_versiculo = str(int(versiculo)) if versiculo.isdigit() else versiculo
+            entradas = comentarios_libro(libro_normalizado).get((str(capitulo), clave_versiculo), {})
         
-        return jsonify({
-            'comentario': comentario_final,
-            'referencia': referencia_final,
-            'referencias_separadas': referencias_finales,
-            'fuentes': {
-                'principal': comentario_encontrado_principal,
-                'cba': comentario_encontrado_cba
-            }
-        })
+        with fase('fusionar'):
+            comentario = fusionar_comentarios(entradas)
+        with fase('serializar'):
+            return jsonify(comentario)
             
     except Exception as e:
-        print(f"Error obteniendo comentario para {libro} {capitulo}:{versiculo}: {e}")
-        import traceback
-        print(f"Traceback: {traceback.format_exc()}")
+        logger.exception("Error obteniendo comentario para %s %s:%s: %s", libro, capitulo, versiculo, e)
     
     return jsonify({
         'comentario': 'No hay comentario disponible para este versículo.', 
         'referencia': '',
         'referencias_separadas': [],
-        'fuentes': {'principal': False, 'cba': False}
+        'fuentes': {fuente['nombre']: False for fuente in FUENTES_COMENTARIOS}
     })
 
+def paquete_capitulo(libro, capitulo, versiculos):
+    """Versículos de un capítulo y todos los comentarios que los cubren
+    
+    Cada comentario aparece una sola vez en 'comentarios', aunque cubra un rango
+    ("1-3"), con el primer y el último versículo del capítulo en que se usa
+    ('inicio', 'fin'). 'por_versiculo' indica qué comentarios (posiciones en la
+    lista, en el orden de las fuentes) corresponden a cada versículo, lo mismo que
+    fusionaría /comentarios para él.
+    """
+    tabla = comentarios_libro(libro)
+    comentarios = []
+    posiciones = {}
+    por_versiculo = {}
+    for versiculo in versiculos:
+        entradas = tabla.get((capitulo, versiculo), {})
+        for fuente in FUENTES_COMENTARIOS:
+            entrada = entradas.get(fuente['nombre'])
+            if not entrada:
+                continue
+            if id(entrada) not in posiciones:
+                posiciones[id(entrada)] = len(comentarios)
+                comentario = {
+                    'fuente': fuente['nombre'],
+                    'versiculo': entrada['versiculo'],
+                    'inicio': versiculo,
+                    'fin': versiculo,
+                    'encontrado': entrada['encontrado'],
+                    'comentario': texto_corpus(entrada['comentario']),
+                    'referencias_separadas': entrada['referencias_separadas']
+                }
+                if entrada.get('referencia'):
+                    comentario['referencia'] = entrada['referencia']
+                comentarios.append(comentario)
+            else:
+                comentarios[posiciones[id(entrada)]]['fin'] = versiculo
+            por_versiculo.setdefault(versiculo, []).append(posiciones[id(entrada)])
+    
+    return {
+        'libro': libro,
+        'capitulo': capitulo,
+        'versiculos': textos_capitulo(versiculos),
+        'comentarios': comentarios,
+        'por_versiculo': por_versiculo,
+        'etiquetas': {fuente['nombre']: fuente['etiqueta'] for fuente in FUENTES_COMENTARIOS}
+    }
+
+@app.route('/capitulo/<libro>/<capitulo>')
+def obtener_capitulo(libro, capitulo):
+    """Capítulo completo para estudiarlo: versículos y comentarios en una sola respuesta cacheable"""
+    biblia = datos_actuales()['biblia']
+    libro_real = libro_en_biblia(libro, biblia)
+    if libro_real and capitulo in biblia[libro_real] and isinstance(biblia[libro_real][capitulo], dict):
+        versiculos = biblia[libro_real][capitulo]
+        return respuesta_json_cacheada(('capitulo', libro_real, capitulo),
+                                       lambda: paquete_capitulo(libro_real, capitulo, versiculos))
+    
+    return jsonify({})
+
+@app.route('/citas/<libro>/<capitulo>/<versiculo>')
+def obtener_citas(libro, capitulo, versiculo):
+    """Comentarios que citan un versículo en sus referencias (índice inverso de citas)"""
+    with fase('resolver_libro'):
+        libro_normalizado = normalizar_nombre_libro(libro)
+    clave_capitulo = str(int(capitulo)) if capitulo.isdigit() else capitulo
+    clave_versiculo = str(int(versiculo)) if versiculo.isdigit() else versiculo
+    
+    with fase('buscar_citas'):
+        indice = indice_citas()
+        pares = indice['citas'].get((libro_normalizado, clave_capitulo, clave_versiculo), ())
+    
+    citas = []
+    for posicion, referencia in pares:
+        fuente, libro_cita, capitulo_cita, versiculo_cita, clave_comentario, fragmento = indice['pasajes'][posicion]
+        citas.append({
+            'fuente': fuente,
+            'libro': libro_cita,
+            'capitulo': capitulo_cita,
+            'versiculo': versiculo_cita,
+            'comentario_versiculo': clave_comentario,
+            'referencia': referencia,
+            'fragmento': fragmento
+        })
+    with fase('serializar'):
+        return jsonify({
+            'libro': libro_normalizado,
+            'capitulo': clave_capitulo,
+            'versiculo': clave_versiculo,
+            'total': len(citas),
+            'citas': citas
+        })
+
 @app.route('/cba_append')
 def obtener_cba_append():
-    """Retorna los datos del CBA Append"""
-    return jsonify(CBA_APPEND)
+    """Retorna los datos del CBA Append (completos; la página usa el índice y las secciones)"""
+    return respuesta_json_cacheada('cba_append', lambda: datos_actuales()['cba_append'])
+
+def secciones_cba_append(documento):
+    """Partes de un documento del CBA Append que se sirven por separado: cada apéndice y las notas finales"""
+    secciones = dict(documento.get('apendices') or {})
+    if documento.get('notas_finales'):
+        secciones['notas_finales'] = documento['notas_finales']
+    return secciones
+
+def indice_cba_append(cba_append):
+    """Documentos del CBA Append con sus datos generales y sus secciones, sin el contenido
+    
+    El tamaño de cada sección es el de su JSON en bytes, para que el cliente
+    sepa qué va a descargar.
+    """
+    indice = []
+    for nombre, documento in cba_append.items():
+        if not isinstance(documento, dict):
+            continue
+        secciones = []
+        for clave, seccion in secciones_cba_append(documento).items():
+            es_notas = clave == 'notas_finales'
+            secciones.append({
+                'clave': clave,
+                'tipo': 'notas' if es_notas else 'apendice',
+                'titulo': 'Notas' if es_notas else (seccion.get('titulo', '') if isinstance(seccion, dict) else ''),
+                'tamano': len(app.json.dumps(seccion).encode('utf-8'))
+            })
+        indice.append({
+            'documento': nombre,
+            'titulo_espanol': documento.get('titulo_espanol', ''),
+            'descripcion': documento.get('descripcion', ''),
+            'pagina_inicio': documento.get('pagina_inicio'),
+            'secciones': secciones
+        })
+    return indice
+
+@app.route('/cba_append/indice')
+def obtener_indice_cba_append():
+    """Índice del CBA Append: documentos y secciones con su tamaño"""
+    cba_append = datos_actuales()['cba_append']
+    return respuesta_json_cacheada(('cba_append', 'indice'), lambda: indice_cba_append(cba_append))
+
+@app.route('/cba_append/<documento>/<seccion>')
+def obtener_seccion_cba_append(documento, seccion):
+    """Una sección del CBA Append (un apéndice o las notas finales), cacheable por separado"""
+    cba_append = datos_actuales()['cba_append']
+    contenido = cba_append.get(documento)
+    secciones = secciones_cba_append(contenido) if isinstance(contenido, dict) else {}
+    if seccion not in secciones:
+        return jsonify({'error': f'Sección "{seccion}" no encontrada en "{documento}"'}), 404
+    return respuesta_json_cacheada(('cba_append', documento, seccion), lambda: secciones[seccion])
+
+def resultado_busqueda(id_versiculo, indice=None, grupos=None):
+    """Resultado de /buscar para un ID de un índice (por defecto, el de versículos)
+    
+    Los versículos llevan su texto completo y, si se pasan los grupos de términos
+    de la consulta, las posiciones [inicio, fin] a resaltar en él ('resaltados').
+    Los comentarios y apéndices llevan su ubicación y un fragmento resaltado.
+    """
+    indice = indice or datos_actuales()['indice_busqueda']
+    documento = indice['documentos'][id_versiculo]
+    apariciones = apariciones_consulta(indice, id_versiculo, grupos or [])
+    
+    if indice['alcance'] == 'versiculos':
+        libro, capitulo, num_versiculo = ubicacion_versiculo(indice['almacen'], id_versiculo)
+        texto = documento
+        resultado = {
+            'libro': libro,
+            'capitulo': capitulo,
+            'versiculo': num_versiculo,
+            'texto': texto_corpus(texto)
+        }
+        if grupos is not None:
+            resultado['resaltados'] = [[posicion, posicion + largo] for posicion, largo in apariciones]
+        return resultado
+    
+    if indice['alcance'] == 'apendices':
+        nombre_documento, ruta, _ = documento
+        resultado = {'alcance': 'apendices', 'documento': nombre_documento, 'ruta': list(ruta)}
+    else:
+        fuente, libro, capitulo, num_versiculo, versiculos = documento
+        resultado = {
+            'alcance': indice['alcance'],
+            'fuente': fuente,
+            'libro': libro,
+            'capitulo': capitulo,
+            'versiculo': num_versiculo,
+            'versiculos': versiculos
+        }
+    resultado['fragmento'], resultado['resaltados'] = fragmento_resaltado(
+        texto_documento(indice, id_versiculo), apariciones)
+    return resultado
+
+def _parametro_entero(nombre, por_defecto, minimo, maximo):
+    """Lee un parámetro entero de la petición, acotado; por_defecto si falta o no es válido"""
+    try:
+        valor = int(request.args.get(nombre, por_defecto))
+    except ValueError:
+        return por_defecto
+    return max(minimo, min(maximo, valor))
 
 @app.route('/buscar')
 def buscar():
+    """Busca un término en el texto de los versículos, sin distinguir acentos
+    
+    Parámetros: q (término), scope (dónde buscar: versiculos/verses por defecto,
+    comentarios/commentary, cba o apendices/appendix), limit (resultados por página, 200 por defecto),
+    cursor (el devuelto por la página anterior) y formato=ndjson para recibir
+    los resultados en streaming, una línea JSON por versículo. El cursor de la
+    página siguiente llega en la cabecera X-Cursor-Siguiente o, en NDJSON, en la
+    última línea ({"cursor_siguiente": ...}); si no hay más resultados no se envía
+    (o es null).
+    
+    Con orden=relevancia (por defecto) los versículos llegan de más a menos
+    relevante según BM25, cada uno con su 'puntuacion' y las posiciones de la
+    consulta en su texto ('resaltados'). Con orden=canonico se buscan las
+    apariciones exactas del texto, en el orden de la Biblia.
+    
+    La relevancia no busca subcadenas: compara palabras enteras, y una palabra
+    que no está en el vocabulario sólo encuentra las que empiezan por ella
+    ("ierto" no encuentra "abierto"; con orden=canonico sí). Además se calcula siempre
+    en el propio worker, sin BUSQUEDA_PROCESOS ni PLAZO_BUSQUEDA: la página nunca
+    llega parcial.
+    
+    Fuera de los versículos cada resultado indica su ubicación (fuente, libro,
+    capítulo y versículo, o documento y ruta en los apéndices) y un 'fragmento'
+    del texto con las posiciones de la consulta en él.
+    
+    En orden canónico las consultas pesadas pueden repartirse entre procesos
+    (BUSQUEDA_PROCESOS); si agotan PLAZO_BUSQUEDA la página llega incompleta, con
+    la cabecera X-Busqueda-Parcial (o "parcial": true en la última línea NDJSON) y
+    un cursor desde el que continuar.
+    
+    Las consultas iguales que llegan a la vez se calculan una sola vez y las
+    recientes se sirven de caché (ver busqueda_compartida). Con el worker
+    saturado de búsquedas la petición se rechaza con 429 o 503 y Retry-After.
+    """
     termino = request.args.get('q', '').strip().lower()
+    limite = _parametro_entero('limit', LIMITE_RESULTADOS_BUSQUEDA, 1, LIMITE_MAXIMO_BUSQUEDA)
+    alcance = ALCANCES_BUSQUEDA.get(request.args.get('scope', 'versiculos'))
+    if alcance is None:
+        return jsonify({'error': f"scope debe ser uno de: {', '.join(ALCANCES_BUSQUEDA)}"}), 400
+    
+    indice = indice_alcance(alcance)
+    if request.args.get('orden', 'relevancia') != 'canonico':
+        return buscar_relevantes(indice, termino, limite)
+    
+    desde = _parametro_entero('cursor', -1, -1, sys.maxsize)
+    cursor_parcial = None
+    # Los versículos se devuelven enteros; los demás textos, como fragmento resaltado
+    grupos = None if alcance == 'versiculos' else terminos_consulta(indice, termino)
+    
+    def resultado(id_documento):
+        return resultado_busqueda(id_documento, indice, grupos)
+    
+    def calcular():
+        if alcance == 'versiculos' and es_busqueda_pesada(indice, termino):
+            logger.debug("🔍 Buscando término en paralelo: '%s'", termino)
+            with fase('buscar_en_paralelo'):
+                return buscar_en_paralelo(termino, desde, limite)
+        logger.debug("🔍 Buscando término: '%s'", termino)
+        # El índice se detiene en cuanto se llena la página (más uno, para saber si hay siguiente)
+        with fase('indice'):
+            return list(islice(buscar_en_indice(indice, termino, desde), limite + 1)), None
+    
+    if not termino or not indice['documentos']:
+        ids = iter(())
+    else:
+        # Las coincidencias exactas se comparan sin acentos: "Jesús" y "jesus" son la misma consulta
+        clave = ('canonico', alcance, plegar_acentos(termino), desde, limite)
+        try:
+            # Se comparte y se guarda sólo la lista de IDs de la página: su hueco se libera
+            # antes de serializarla, así que un cliente lento no retiene a las demás búsquedas
+            ids, cursor_parcial = busqueda_compartida(
+                clave, indice, calcular, guardar=lambda resultado: resultado[1] is None,
+                tamano=lambda resultado: len(resultado[0]))
+        except BusquedaRechazada as e:
+            return rechazo_busqueda(e)
+        ids = iter(ids)
+    
+    if request.args.get('formato') == 'ndjson':
+        return Response(stream_with_context(_generar_ndjson(ids, limite, termino, resultado, cursor_parcial)),
+                        mimetype='application/x-ndjson')
+    
     resultados = []
+    cursor_siguiente = None
+    try:
+        with fase('indice'):
+            # Sólo hay página siguiente si existe al menos un resultado más
+            ids_pagina = list(islice(ids, limite + 1))
+        if len(ids_pagina) > limite:
+            cursor_siguiente = ids_pagina[limite - 1]
+        with fase('resultados'):
+            resultados = [resultado(id_versiculo) for id_versiculo in ids_pagina[:limite]]
+        
+        logger.debug("📊 Búsqueda completada: %d resultados encontrados", len(resultados),
+                     extra={'campos': {'ruta': 'buscar', 'termino': termino, 'resultados': len(resultados)}})
+        
+    except Exception as e:
+        logger.exception("❌ Error en búsqueda: %s", e)
+    
+    with fase('serializar'):
+        respuesta = jsonify(resultados)
+    if cursor_parcial is not None:
+        cursor_siguiente = cursor_parcial
+        respuesta.headers['X-Busqueda-Parcial'] = '1'
+    if cursor_siguiente is not None:
+        respuesta.headers['X-Cursor-Siguiente'] = str(cursor_siguiente)
+    return respuesta
+
+def buscar_relevantes(indice, termino, limite):
+    """Página de /buscar?orden=relevancia: el cursor es la posición en el ranking"""
+    posicion = _parametro_entero('cursor', 0, 0, sys.maxsize)
+    
+    k = posicion + limite + 1
+    mejores = []
+    if termino:
+        # El ranking sólo depende de las palabras de la consulta, ya plegadas
+        clave = ('relevancia', indice['alcance'], tuple(tokenizar(termino)), k)
+        
+        def calcular():
+            with fase('indice'):
+                # Un resultado más que la página para saber si hay página siguiente
+                return buscar_por_relevancia(indice, termino, k)
+        
+        try:
+            mejores = busqueda_compartida(clave, indice, calcular)
+        except BusquedaRechazada as e:
+            return rechazo_busqueda(e)
+    pagina = mejores[posicion:posicion + limite]
+    cursor_siguiente = str(posicion + limite) if len(mejores) > posicion + limite else None
     
-    if not termino or not BIBLIA:
-        return jsonify(resultados)
+    grupos = terminos_consulta(indice, termino)
     
+    def resultado(id_versiculo, puntuacion):
+        return dict(resultado_busqueda(id_versiculo, indice, grupos), puntuacion=round(puntuacion, 4))
+    
+    if request.args.get('formato') == 'ndjson':
+        return Response(stream_with_context(_generar_ndjson_relevantes(pagina, termino, resultado, cursor_siguiente)),
+                        mimetype='application/x-ndjson')
+    
+    with fase('resultados'):
+        resultados = [resultado(id_versiculo, puntuacion) for id_versiculo, puntuacion in pagina]
+    logger.debug("📊 Búsqueda por relevancia: %d resultados", len(resultados),
+                 extra={'campos': {'ruta': 'buscar', 'termino': termino, 'resultados': len(resultados)}})
+    
+    with fase('serializar'):
+        respuesta = jsonify(resultados)
+    if cursor_siguiente is not None:
+        respuesta.headers['X-Cursor-Siguiente'] = cursor_siguiente
+    return respuesta
+
+def _generar_ndjson_relevantes(pagina, termino, resultado, cursor_siguiente):
+    """Genera una página de /buscar?orden=relevancia línea a línea, como _generar_ndjson"""
+    enviados = 0
     try:
-        print(f"🔍 Buscando término: '{termino}'")
+        for id_versiculo, puntuacion in pagina:
+            yield app.json.dumps(resultado(id_versiculo, puntuacion)) + '\n'
+            enviados += 1
         
-        for libro, capitulos in BIBLIA.items():
-            if not es_diccionario_valido(capitulos):
-                continue
-                
-            for capitulo, versiculos in capitulos.items():
-                if not isinstance(versiculos, dict):
-                    continue
-                    
-                for num_versiculo, texto in versiculos.items():
-                    texto_versiculo = str(texto).lower() if texto else ""
-                    if termino in texto_versiculo:
-                        resultados.append({
-                            'libro': libro,
-                            'capitulo': capitulo,
-                            'versiculo': num_versiculo,
-                            'texto': texto
-                        })
-                        print(f"  ✅ Encontrado en {libro} {capitulo}:{num_versiculo}")
-        
-        # Limitar resultados para no sobrecargar
-        resultados = resultados[:200]
-        print(f"📊 Búsqueda completada: {len(resultados)} resultados encontrados")
+        logger.debug("📊 Búsqueda por relevancia: %d resultados enviados", enviados,
+                     extra={'campos': {'ruta': 'buscar', 'termino': termino, 'resultados': enviados}})
+    except Exception as e:
+        logger.exception("❌ Error en búsqueda: %s", e)
+    
+    yield json.dumps({'cursor_siguiente': cursor_siguiente}) + '\n'
+
+def _generar_ndjson(ids, limite, termino, resultado, cursor_parcial=None):
+    """Genera los resultados de /buscar línea a línea, cerrando con el cursor siguiente"""
+    enviados = 0
+    ultimo = None
+    cursor_siguiente = None
+    try:
+        for id_versiculo in ids:
+            if enviados == limite:
+                cursor_siguiente = ultimo
+                break
+            yield app.json.dumps(resultado(id_versiculo)) + '\n'
+            enviados += 1
+            ultimo = id_versiculo
         
+        logger.debug("📊 Búsqueda completada: %d resultados enviados", enviados,
+                     extra={'campos': {'ruta': 'buscar', 'termino': termino, 'resultados': enviados}})
     except Exception as e:
-        print(f"❌ Error en búsqueda: {e}")
-        import traceback
-        print(f"Traceback: {traceback.format_exc()}")
+        logger.exception("❌ Error en búsqueda: %s", e)
     
-    return jsonify(resultados)
+    final = {'cursor_siguiente': None if cursor_siguiente is None else str(cursor_siguiente)}
+    if cursor_parcial is not None:
+        final = {'cursor_siguiente': str(cursor_parcial), 'parcial': True}
+    yield json.dumps(final) + '\n'
 
-@app.route('/referencia/<referencia>')
-def obtener_referencia(referencia):
+# "Libro Capítulo[:Versículo][-[Capítulo:]Versículo]": "Juan 3:16", "Juan 3:16-18",
+# "Juan 1:50-2:5", un capítulo entero ("Salmos 23") o varios ("Juan 3-4")
+PATRON_REFERENCIA = re.compile(r'(.+?)\s+(\d+)(?::(\d+))?(?:\s*-\s*(?:(\d+):)?(\d+))?(?![\d:])')
+
+# Máximo de referencias (ya expandidas) que se resuelven en una petición a /referencias
+LIMITE_REFERENCIAS_LOTE = 200
+# Longitud máxima (caracteres) de cada elemento de un lote
+LONGITUD_MAXIMA_REFERENCIA = 1000
+# Textos de tramos ya resueltos: memoria máxima aproximada (MB) de la caché por tramo
+MEMORIA_REFERENCIAS_MB = int(os.environ.get('MEMORIA_REFERENCIAS_MB', 8))
+
+CACHE_REFERENCIAS = CacheLRU(MEMORIA_REFERENCIAS_MB * 1024 * 1024)
+
+def lineas_tramo(almacen, inicio, fin, con_capitulo):
+    """Líneas "versículo. texto" (o "capítulo:versículo. texto") de los IDs [inicio, fin)"""
+    inicios = almacen['inicios']
+    posicion = bisect.bisect_right(inicios, inicio) - 1
+    lineas = []
+    for id_versiculo, texto in zip(range(inicio, fin), almacen['textos'][inicio:fin]):
+        while posicion + 1 < len(inicios) and inicios[posicion + 1] <= id_versiculo:
+            posicion += 1
+        prefijo = f"{almacen['ubicaciones'][posicion][1]}:" if con_capitulo else ''
+        lineas.append(f"{prefijo}{etiqueta_versiculo(almacen, id_versiculo)}. {texto_corpus(texto)}")
+    return lineas
+
+def texto_tramo(almacen, inicio, fin, con_capitulo=False, desde=None, hasta=None):
+    """Texto de los versículos [inicio, fin), una línea por versículo
+    
+    Con desde y hasta (números de un tramo dentro de un capítulo, ya acotados a
+    él) los números que el capítulo no tiene se indican en su propia línea. Se
+    memoiza en CACHE_REFERENCIAS por los IDs del tramo, no por la referencia:
+    las distintas formas de escribirla comparten entrada y ninguna crece sin límite.
+    """
+    clave = (inicio, fin, con_capitulo, desde, hasta)
+    entrada = CACHE_REFERENCIAS.obtener(clave)
+    if entrada is not None and entrada[0] is almacen:
+        return entrada[1]
+    
+    if desde is None:
+        lineas = lineas_tramo(almacen, inicio, fin, con_capitulo)
+    else:
+        lineas = []
+        siguiente = desde
+        for numero, texto in zip(almacen['numeros'][inicio:fin], almacen['textos'][inicio:fin]):
+            lineas.extend(f"{v}. [Versículo no encontrado]" for v in range(siguiente, numero))
+            lineas.append(f"{numero}. {texto_corpus(texto)}")
+            siguiente = numero + 1
+        lineas.extend(f"{v}. [Versículo no encontrado]" for v in range(siguiente, hasta + 1))
+    texto = '\n'.join(lineas)
+    CACHE_REFERENCIAS.guardar(clave, (almacen, texto), len(texto) + 64)
+    return texto
+
+def resolver_referencia(referencia):
+    """Resuelve una referencia al texto de sus versículos, o a un dict con 'error'
+    
+    Acepta un versículo ("Juan 3:16"), un tramo de un capítulo ("Juan 3:16-18") o
+    que cruza capítulos ("Juan 1:50-2:5"), un capítulo entero ("Salmos 23") o
+    varios ("Juan 3-4"). Cada tramo es un slice del almacén de versículos; los que
+    cruzan capítulos indican el último en 'capitulo_fin' y numeran sus líneas
+    con "capítulo:versículo".
+    """
     try:
-        referencia = referencia.strip()
+        match = PATRON_REFERENCIA.search(referencia.strip())
+        if not match:
+            return {'error': 'Formato de referencia inválido. Use: "Libro Capítulo:Versículo"'}
         
-        patron = r'(.+?)\s+(\d+):(\d+(?:-\d+)?)'
-        match = re.search(patron, referencia)
+        libro, capitulo, desde, capitulo_fin, hasta = match.groups()
+        libro = libro.strip()
+        if desde is None and capitulo_fin is None:
+            # "Juan 3-4": sin versículo inicial, el número tras el guion es un capítulo
+            capitulo_fin, hasta = hasta, None
         
-        if match:
-            libro = match.group(1).strip()
-            capitulo = match.group(2)
-            versiculo_rango = match.group(3)
-            
-            libro_normalizado = normalizar_nombre_libro(libro)
+        almacen = datos_actuales()['almacen_versiculos']
+        libro_real = libro_en_biblia(libro, almacen['capitulos'])
+        if not libro_real:
+            return {'error': f'Libro "{libro}" no encontrado'}
+        for numero_capitulo in (capitulo, capitulo_fin):
+            if numero_capitulo is not None and numero_capitulo not in almacen['capitulos'][libro_real]:
+                return {'error': f'Capítulo {numero_capitulo} no encontrado en {libro_real}'}
+        
+        if desde is not None and hasta is None:
+            # Versículo único
+            id_buscado = id_versiculo(almacen, libro_real, capitulo, desde)
+            if id_buscado is None:
+                return {'error': f'Versículo {desde} no encontrado en {libro_real} {capitulo}'}
+            return {
+                'libro': libro_real,
+                'capitulo': capitulo,
+                'versiculo': desde,
+                'texto': texto_corpus(almacen['textos'][id_buscado]),
+                'es_rango': False
+            }
+        
+        inicio, fin = tramo_versiculos(almacen, libro_real, capitulo, desde and int(desde),
+                                       capitulo_fin, hasta and int(hasta))
+        if desde is not None and capitulo_fin in (None, capitulo):
+            # Tramo dentro de un capítulo: los números que no tiene se indican en su
+            # línea, pero sólo hasta el último del capítulo ("1:1-1000000" acaba en él)
+            primero_capitulo, fin_capitulo = almacen['capitulos'][libro_real][capitulo]
+            numerados = bisect.bisect_left(almacen['numeros'], SIN_NUMERO, primero_capitulo, fin_capitulo)
+            ultimo = almacen['numeros'][numerados - 1] if numerados > primero_capitulo else 0
+            if int(desde) > ultimo:
+                return {'error': f'Versículo {desde} no encontrado en {libro_real} {capitulo}'}
+            return {
+                'libro': libro_real,
+                'capitulo': capitulo,
+                'versiculo': f"{desde}-{hasta}",
+                'texto': texto_tramo(almacen, inicio, fin, desde=int(desde), hasta=min(int(hasta), ultimo)),
+                'es_rango': True
+            }
+        
+        if fin <= inicio:
+            return {'error': f'La referencia "{referencia.strip()}" no contiene versículos'}
+        _, capitulo_inicio, primero = ubicacion_versiculo(almacen, inicio)
+        _, capitulo_final, ultimo = ubicacion_versiculo(almacen, fin - 1)
+        cruza = capitulo_final != capitulo_inicio
+        resultado = {
+            'libro': libro_real,
+            'capitulo': capitulo_inicio,
+            'versiculo': (f"{primero}-{capitulo_final}:{ultimo}" if cruza
+                          else f"{primero}-{ultimo}" if ultimo != primero else primero),
+            'texto': texto_tramo(almacen, inicio, fin, cruza),
+            'es_rango': True
+        }
+        if cruza:
+            resultado['capitulo_fin'] = capitulo_final
+        return resultado
             
-            # Buscar libro exacto
-            if libro in BIBLIA and es_diccionario_valido(BIBLIA[libro]):
-                libro_real = libro
+    except Exception as e:
+        logger.exception("Error obteniendo referencia %s: %s", referencia, e)
+        return {'error': 'Error procesando la referencia'}
+
+@app.route('/referencia/<referencia>')
+def obtener_referencia(referencia):
+    return jsonify(resolver_referencia(referencia))
+
+@app.route('/referencias', methods=['POST'])
+def obtener_referencias_lote():
+    """Resuelve varias referencias en una sola petición
+    
+    Recibe {"referencias": ["Juan 1:1; 3:16", "Gn 1:1-3", ...]}. Cada elemento se
+    separa con procesar_referencias() (completando los libros implícitos) y cada
+    referencia resultante se devuelve en orden con su texto o con su propio 'error'.
+    """
+    datos = request.get_json(silent=True)
+    referencias = datos.get('referencias') if isinstance(datos, dict) else datos
+    if not isinstance(referencias, list):
+        return jsonify({'error': 'Formato inválido. Envíe: {"referencias": ["Libro Capítulo:Versículo", ...]}'}), 400
+    
+    # Los límites se comprueban antes de procesar nada y al expandir cada elemento
+    demasiadas = {'error': f'Demasiadas referencias: máximo {LIMITE_REFERENCIAS_LOTE} por petición'}
+    if len(referencias) > LIMITE_REFERENCIAS_LOTE:
+        return jsonify(demasiadas), 400
+    if any(isinstance(referencia, str) and len(referencia) > LONGITUD_MAXIMA_REFERENCIA
+           for referencia in referencias):
+        return jsonify({'error': f'Referencia demasiado larga: máximo {LONGITUD_MAXIMA_REFERENCIA} caracteres'}), 400
+    
+    expandidas = []
+    with fase('procesar_referencias'):
+        for referencia in referencias:
+            if isinstance(referencia, str):
+                expandidas.extend(procesar_referencias(referencia) or [referencia])
             else:
-                # Buscar por nombre normalizado
-                libro_encontrado = None
-                for libro_biblia in BIBLIA.keys():
-                    if normalizar_nombre_libro(libro_biblia) == libro_normalizado:
-                        if es_diccionario_valido(BIBLIA[libro_biblia]):
-                            libro_encontrado = libro_biblia
-                            break
-                
-                if libro_encontrado:
-                    libro_real = libro_encontrado
-                else:
-                    return jsonify({'error': f'Libro "{libro}" no encontrado'})
-            
-            # Verificar si el capítulo existe
-            if capitulo not in BIBLIA[libro_real] or not isinstance(BIBLIA[libro_real][capitulo], dict):
-                return jsonify({'error': f'Capítulo {capitulo} no encontrado en {libro_real}'})
-            
-            # Manejar rangos de versículos
-            if '-' in versiculo_rango:
-                vers_inicio, vers_fin = map(int, versiculo_rango.split('-'))
-                versiculos_texto = []
-                
-                for v in range(vers_inicio, vers_fin + 1):
-                    vers_str = str(v)
-                    if vers_str in BIBLIA[libro_real][capitulo]:
-                        versiculos_texto.append(f"{vers_str}. {BIBLIA[libro_real][capitulo][vers_str]}")
-                    else:
-                        versiculos_texto.append(f"{vers_str}. [Versículo no encontrado]")
-                
-                texto_completo = '\n'.join(versiculos_texto)
-                return jsonify({
-                    'libro': libro_real,
-                    'capitulo': capitulo,
-                    'versiculo': versiculo_rango,
-                    'texto': texto_completo,
-                    'es_rango': True
-                })
+                expandidas.append(referencia)
+            if len(expandidas) > LIMITE_REFERENCIAS_LOTE:
+                return jsonify(demasiadas), 400
+    
+    resultados = []
+    with fase('resolver_referencias'):
+        for referencia in expandidas:
+            if isinstance(referencia, str):
+                resultado = dict(resolver_referencia(referencia))
             else:
-                # Versículo único
-                if versiculo_rango in BIBLIA[libro_real][capitulo]:
-                    return jsonify({
-                        'libro': libro_real,
-                        'capitulo': capitulo,
-                        'versiculo': versiculo_rango,
-                        'texto': BIBLIA[libro_real][capitulo][versiculo_rango],
-                        'es_rango': False
-                    })
-                else:
-                    return jsonify({'error': f'Versículo {versiculo_rango} no encontrado en {libro_real} {capitulo}'})
-        else:
-            return jsonify({'error': 'Formato de referencia inválido. Use: "Libro Capítulo:Versículo"'})
-            
-    except Exception as e:
-        print(f"Error obteniendo referencia {referencia}: {e}")
-        return jsonify({'error': 'Error procesando la referencia'})
+                resultado = {'error': 'Referencia inválida'}
+            resultado['referencia'] = referencia
+            resultados.append(resultado)
+    
+    with fase('serializar'):
+        return jsonify({'resultados': resultados})
+
+# Referencia a medio escribir: libro, capítulo y, tras los dos puntos, el comienzo del versículo ("1 Co 13:", "Sal 119:1")
+PATRON_REFERENCIA_PARCIAL = re.compile(r'^\s*((?:\d\s*)?[^\d:]+?)\s*(\d+)(?:\s*(:)\s*(\d*))?\s*$')
+# Sugerencias de /sugerir si no se pide limit
+SUGERENCIAS_POR_DEFECTO = 8
+# Longitud aproximada (caracteres) del texto que acompaña a cada versículo sugerido
+LONGITUD_FRAGMENTO_SUGERENCIA = 80
+
+def referencias_sugeridas(almacen, consulta, limite):
+    """Capítulos o versículos que completan una referencia a medio escribir, o None si la consulta no lo es"""
+    match = PATRON_REFERENCIA_PARCIAL.match(consulta)
+    if not match:
+        return None
+    nombre, capitulo, dos_puntos, versiculo = match.groups()
+    libro = libro_en_biblia(nombre) or next(iter(libros_por_prefijo(nombre, almacen['capitulos'])), None)
+    if libro is None or libro not in almacen['capitulos']:
+        return None
+    capitulos = almacen['capitulos'][libro]
+    
+    if not dos_puntos:
+        return [{'tipo': 'referencia', 'texto': f"{libro} {c}", 'libro': libro, 'capitulo': c}
+                for c in islice((c for c in capitulos if c.startswith(capitulo)), limite)]
+    
+    capitulo = str(int(capitulo))
+    if capitulo not in capitulos:
+        return []
+    ids = (i for i in range(*capitulos[capitulo]) if etiqueta_versiculo(almacen, i).startswith(versiculo))
+    sugerencias = []
+    for id_versiculo in islice(ids, limite):
+        etiqueta = etiqueta_versiculo(almacen, id_versiculo)
+        fragmento, _ = fragmento_resaltado(str(texto_corpus(almacen['textos'][id_versiculo]) or ''), [],
+                                           LONGITUD_FRAGMENTO_SUGERENCIA)
+        sugerencias.append({'tipo': 'referencia', 'texto': f"{libro} {capitulo}:{etiqueta}", 'libro': libro,
+                            'capitulo': capitulo, 'versiculo': etiqueta, 'fragmento': fragmento})
+    return sugerencias
+
+@app.route('/sugerir')
+def sugerir():
+    """Sugerencias para completar lo que se está escribiendo en el buscador
+    
+    Parámetros: q (lo escrito hasta ahora) y limit (8 por defecto, hasta
+    LIMITE_SUGERENCIAS). Una referencia a medio escribir se completa con
+    capítulos ("Juan 3" -> Juan 3, Juan 30...) o versículos con el comienzo de su
+    texto ("1 Co 13:" -> 1 Corintios 13:1...). Si no, se sugieren los libros con
+    algún nombre, alias o abreviatura que empieza por q y los términos de los
+    versículos que completan su última palabra, de más a menos frecuentes. Cada
+    sugerencia lleva su 'tipo' (referencia, libro o termino) y el 'texto' que
+    sustituye a q. Todo sale de estructuras precalculadas (bisección sobre
+    nombres y vocabulario ordenados), así que puede pedirse en cada pulsación.
+    """
+    consulta = request.args.get('q', '')
+    limite = _parametro_entero('limit', SUGERENCIAS_POR_DEFECTO, 1, LIMITE_SUGERENCIAS)
+    if not consulta.strip():
+        return jsonify([])
+    datos = datos_actuales()
+    almacen = datos['almacen_versiculos']
+    sugerencias_terminos = datos['sugerencias']
+    
+    with fase('sugerir'):
+        sugerencias = referencias_sugeridas(almacen, consulta, limite)
+        if sugerencias is None:
+            sugerencias = [{'tipo': 'libro', 'texto': libro, 'libro': libro}
+                           for libro in libros_por_prefijo(consulta, almacen['capitulos'])[:limite]]
+            palabra = re.search(r'\w+$', consulta)
+            if palabra and len(sugerencias) < limite:
+                for posicion in terminos_por_prefijo(sugerencias_terminos, plegar_acentos(palabra.group()),
+                                                     limite - len(sugerencias)):
+                    termino = sugerencias_terminos['formas'].get(posicion, sugerencias_terminos['vocabulario'][posicion])
+                    sugerencias.append({'tipo': 'termino', 'texto': consulta[:palabra.start()] + termino,
+                                        'termino': termino,
+                                        'apariciones': sugerencias_terminos['apariciones'][posicion]})
+    return jsonify(sugerencias)
+
+# Cachés lru_cache cuyos aciertos y fallos se publican en /metrics
+CACHES_LRU = {
+    'resolver_libro': resolver_libro,
+    'normalizar_nombre_libro': normalizar_nombre_libro,
+    'comprimir': comprimir_cacheado,
+}
+
+@app.route('/metrics')
+def metricas():
+    """Métricas del worker en el formato de texto de Prometheus"""
+    # Las cachés de comentarios por libro, de búsquedas y de referencias llevan su propia cuenta
+    with _lock_metricas:
+        CONTADORES[('biblia_cache_aciertos_total', (('cache', 'comentarios_libro'),))] = CACHE_COMENTARIOS.aciertos
+        CONTADORES[('biblia_cache_fallos_total', (('cache', 'comentarios_libro'),))] = CACHE_COMENTARIOS.fallos
+        CONTADORES[('biblia_cache_aciertos_total', (('cache', 'busquedas'),))] = CACHE_BUSQUEDAS.aciertos
+        CONTADORES[('biblia_cache_fallos_total', (('cache', 'busquedas'),))] = CACHE_BUSQUEDAS.fallos
+        CONTADORES[('biblia_cache_aciertos_total', (('cache', 'resolver_referencia'),))] = CACHE_REFERENCIAS.aciertos
+        CONTADORES[('biblia_cache_fallos_total', (('cache', 'resolver_referencia'),))] = CACHE_REFERENCIAS.fallos
+    return Response(texto_metricas(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/perfil', methods=['GET', 'POST'])
+def perfil():
+    """Perfilador por muestreo (sólo con PERFILADOR=1)
+    
+    POST /perfil?segundos=30&intervalo=0.005 empieza a muestrear este worker en
+    segundo plano; GET /perfil devuelve las pilas de la última ventana, de la más
+    frecuente a la menos, en formato plegado ("a;b;c N") para flamegraph.pl.
+    """
+    if not PERFILADOR:
+        return jsonify({'error': 'Perfilador desactivado (arranque con PERFILADOR=1)'}), 404
+    
+    if request.method == 'POST':
+        segundos = _parametro_entero('segundos', 30, 1, 600)
+        try:
+            intervalo = min(max(float(request.args.get('intervalo', 0.005)), 0.001), 1.0)
+        except ValueError:
+            intervalo = 0.005
+        with _lock_perfil:
+            if PERFIL['activo']:
+                return jsonify({'error': 'Ya hay un muestreo en curso'}), 409
+            PERFIL.update(activo=True, segundos=segundos, intervalo=intervalo)
+        threading.Thread(target=_muestrear_pilas, args=(segundos, intervalo),
+                         name='perfilador', daemon=True).start()
+        return jsonify({'estado': 'muestreando', 'segundos': segundos, 'intervalo': intervalo, 'pid': os.getpid()})
+    
+    with _lock_perfil:
+        if PERFIL['activo']:
+            return jsonify({'estado': 'muestreando', 'pid': os.getpid()}), 202
+        muestras = PERFIL['muestras']
+    lineas = [f"{pila} {cuenta}" for pila, cuenta in muestras.most_common()]
+    return Response('\n'.join(lineas) + '\n', mimetype='text/plain')
 
 @app.route('/favicon.ico')
 def favicon():
@@ -0,0 +1,253 @@
+"""Punto de entrada ASGI de la Biblia digital
+
+Sirve las mismas rutas que app.py (/libros, /capitulos, /versiculos, /comentarios,
+/citas, /buscar, /sugerir, /referencia, /referencias, /cba_append...) desde un bucle de eventos: cada
+conexión abierta es una corrutina y no un worker, así que un proceso mantiene miles
+de conexiones keep-alive y de clientes lentos descargando /cba_append o comentarios
+largos.
+
+Las respuestas se calculan con las mismas vistas de Flask sobre los datos ya
+cargados por app.py (DATOS, tablas, índice y caché de respuestas). Sólo se
+resuelven directamente en el bucle las respuestas que ya están en la caché de
+respuestas (bytes ya serializados y comprimidos): el resto, incluida la primera
+petición de cada una de esas, se ejecuta en un pool de hilos para no bloquearlo.
+El hilo pasa cada fragmento de la respuesta al bucle según lo genera, así que las
+búsquedas en NDJSON llegan al cliente mientras se calculan. Entre el hilo y el
+bucle caben como mucho COLA_MENSAJES_ASGI fragmentos: con un cliente lento el hilo
+espera en lugar de acumular la respuesta en memoria, y si el cliente se desconecta
+la vista deja de generarla.
+
+Producción (uvicorn y, opcionalmente, uvloop/httptools):
+
+    pip install uvicorn[standard]
+    uvicorn asgi:aplicacion --host 0.0.0.0 --port 5000 --workers 4 \\
+        --timeout-keep-alive 75 --backlog 4096
+
+o bajo gunicorn, que gestiona y reinicia los workers:
+
+    gunicorn -k uvicorn.workers.UvicornWorker -w 4 -b 0.0.0.0:5000 asgi:aplicacion
+
+o simplemente `python asgi.py` (ver las variables ASGI_* más abajo). Con
+ALMACEN_CORPUS=mmap los workers comparten además los textos (ver compilar_snapshot.py).
+"""
+import asyncio
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import app as biblia
+
+# Hilos para las rutas que calculan su respuesta
+HILOS_ASGI = int(os.environ.get('HILOS_ASGI', 8))
+# Tamaño máximo del cuerpo de una petición (POST /referencias)
+LIMITE_CUERPO_ASGI = int(os.environ.get('LIMITE_CUERPO_ASGI', 1024 * 1024))
+# Fragmentos de una respuesta que el hilo puede adelantar al envío al cliente
+COLA_MENSAJES_ASGI = int(os.environ.get('COLA_MENSAJES_ASGI', 16))
+
+# Rutas servidas desde la caché de respuestas de app.py (respuesta_cacheada): si la
+# respuesta ya está cacheada se sirve en el bucle
+PREFIJOS_EN_BUCLE = ('/libros', '/capitulos/', '/versiculos/', '/capitulo/', '/cba_append')
+
+EJECUTOR = ThreadPoolExecutor(max_workers=HILOS_ASGI, thread_name_prefix='asgi')
+
+# Marca del final de la respuesta en la cola entre el hilo y el bucle
+FIN = object()
+
+class ClienteDesconectado(Exception):
+    """El cliente ya no recibe la respuesta: la vista deja de generarla"""
+
+def en_bucle(ruta):
+    """Indica si la ruta puede servirse en el bucle cuando su respuesta ya está cacheada"""
+    return ruta == '/' or ruta.startswith(PREFIJOS_EN_BUCLE)
+
+def entorno_wsgi(scope, cuerpo):
+    """Traduce el scope HTTP de ASGI al entorno WSGI que espera Flask"""
+    servidor = scope.get('server') or ('localhost', 80)
+    cliente = scope.get('client') or ('', 0)
+    entorno = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(servidor[0]),
+        'SERVER_PORT': str(servidor[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': str(cliente[0]),
+        'REMOTE_PORT': str(cliente[1]),
+        'CONTENT_LENGTH': str(len(cuerpo)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(cuerpo),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for nombre, valor in scope.get('headers', []):
+        nombre = nombre.decode('latin-1').upper().replace('-', '_')
+        valor = valor.decode('latin-1')
+        if nombre == 'CONTENT_TYPE':
+            entorno['CONTENT_TYPE'] = valor
+        elif nombre != 'CONTENT_LENGTH':
+            clave = f'HTTP_{nombre}'
+            entorno[clave] = f"{entorno[clave]},{valor}" if clave in entorno else valor
+    return entorno
+
+def ejecutar_vista(entorno, entregar):
+    """Ejecuta la petición en la aplicación Flask y entrega sus mensajes ASGI según se generan
+
+    entregar recibe el inicio de la respuesta, cada fragmento del cuerpo y el
+    cuerpo vacío que la cierra.
+    """
+    inicio = {}
+
+    def start_response(estado, cabeceras, exc_info=None):
+        inicio['estado'] = int(estado.split(' ', 1)[0])
+        inicio['cabeceras'] = [(n.lower().encode('latin-1'), v.encode('latin-1')) for n, v in cabeceras]
+
+    def empezar():
+        entregar({'type': 'http.response.start', 'status': inicio['estado'], 'headers': inicio['cabeceras']})
+
+    resultado = biblia.app.wsgi_app(entorno, start_response)
+    empezada = False
+    try:
+        for fragmento in resultado:
+            # WSGI permite llamar a start_response al producir el primer fragmento
+            if not empezada:
+                empezar()
+                empezada = True
+            if fragmento:
+                entregar({'type': 'http.response.body', 'body': fragmento, 'more_body': True})
+    finally:
+        if hasattr(resultado, 'close'):
+            resultado.close()
+    if not empezada:
+        empezar()
+    entregar({'type': 'http.response.body', 'body': b''})
+
+async def ejecutar_en_pool(send, entorno):
+    """Ejecuta la vista en el pool de hilos y envía cada mensaje en cuanto el hilo lo entrega
+
+    La cola entre ambos está acotada (COLA_MENSAJES_ASGI): con un cliente lento
+    el hilo espera a que haya sitio. Si el envío falla (el cliente se desconectó)
+    el siguiente mensaje que entregue el hilo lanza ClienteDesconectado, así que
+    la vista cierra su respuesta y el hilo queda libre. Si la vista falla antes de
+    empezar la respuesta se envía un 500; si falla a medias, se cierra el cuerpo
+    enviado hasta entonces.
+    """
+    bucle = asyncio.get_running_loop()
+    cola = asyncio.Queue(maxsize=COLA_MENSAJES_ASGI)
+    cancelada = threading.Event()
+
+    def entregar(mensaje):
+        if cancelada.is_set():
+            raise ClienteDesconectado()
+        asyncio.run_coroutine_threadsafe(cola.put(mensaje), bucle).result()
+
+    def producir():
+        try:
+            ejecutar_vista(entorno, entregar)
+        finally:
+            if not cancelada.is_set():
+                entregar(FIN)
+
+    tarea = bucle.run_in_executor(EJECUTOR, producir)
+    empezada = terminada = False
+    try:
+        while True:
+            mensaje = await cola.get()
+            if mensaje is FIN:
+                break
+            empezada = empezada or mensaje['type'] == 'http.response.start'
+            terminada = mensaje['type'] == 'http.response.body' and not mensaje.get('more_body')
+            await send(mensaje)
+    except BaseException:
+        # Vaciar la cola despierta al hilo si esperaba sitio; su siguiente entrega ya falla
+        cancelada.set()
+        while not cola.empty():
+            cola.get_nowait()
+        raise
+    finally:
+        try:
+            await tarea
+        except ClienteDesconectado:
+            pass
+        except Exception:
+            biblia.logger.exception("❌ Error sirviendo %s", entorno.get('PATH_INFO'))
+            if not cancelada.is_set():
+                if not empezada:
+                    await enviar(send, 500, [(b'content-type', b'text/plain; charset=utf-8')], [b'Error interno'])
+                elif not terminada:
+                    await send({'type': 'http.response.body', 'body': b''})
+
+async def leer_cuerpo(receive):
+    """Lee el cuerpo completo de la petición; None si supera LIMITE_CUERPO_ASGI"""
+    partes = []
+    tamano = 0
+    while True:
+        mensaje = await receive()
+        if mensaje['type'] == 'http.disconnect':
+            return None
+        parte = mensaje.get('body', b'')
+        tamano += len(parte)
+        if tamano > LIMITE_CUERPO_ASGI:
+            return None
+        partes.append(parte)
+        if not mensaje.get('more_body'):
+            return b''.join(partes)
+
+async def enviar(send, estado, cabeceras, fragmentos):
+    await send({'type': 'http.response.start', 'status': estado, 'headers': cabeceras})
+    for fragmento in fragmentos:
+        await send({'type': 'http.response.body', 'body': fragmento, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def vida(receive, send):
+    """Protocolo lifespan: los datos ya están cargados al importar app.py"""
+    while True:
+        mensaje = await receive()
+        if mensaje['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif mensaje['type'] == 'lifespan.shutdown':
+            EJECUTOR.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def aplicacion(scope, receive, send):
+    """Aplicación ASGI con las rutas de app.py"""
+    if scope['type'] == 'lifespan':
+        await vida(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    cuerpo = await leer_cuerpo(receive)
+    if cuerpo is None:
+        await enviar(send, 413, [(b'content-type', b'text/plain; charset=utf-8')],
+                     [b'Cuerpo de la peticion demasiado grande'])
+        return
+
+    if en_bucle(scope['path']):
+        entorno = entorno_wsgi(scope, cuerpo)
+        entorno[biblia.SOLO_CACHE] = True
+        mensajes = []
+        ejecutar_vista(entorno, mensajes.append)
+        if not entorno.get(biblia.FUERA_DE_CACHE):
+            for mensaje in mensajes:
+                await send(mensaje)
+            return
+    await ejecutar_en_pool(send, entorno_wsgi(scope, cuerpo))
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run(
+        'asgi:aplicacion',
+        host=os.environ.get('ASGI_HOST', '0.0.0.0'),
+        port=int(os.environ.get('ASGI_PUERTO', 5000)),
+        workers=int(os.environ.get('ASGI_WORKERS', 1)),
+        timeout_keep_alive=int(os.environ.get('ASGI_KEEP_ALIVE', 75)),
+        backlog=int(os.environ.get('ASGI_BACKLOG', 4096)),
+    )
@@ -0,0 +1,343 @@
+"""Benchmark y prueba de carga de la Biblia digital
+
+Uso:
+    python benchmark.py [--semilla N] [--peticiones N] [--hilos N] [--duracion S]
+                        [--url http://host:puerto] [--salida resultados.json]
+                        [--base base.json] [--tolerancia 0.10]
+
+Mide, con consultas fijas y cargas aleatorias reproducibles (misma semilla, mismas
+peticiones):
+
+- el tiempo de cada función de carga (cargar_biblia, cargar_comentarios...) y de
+  la importación completa de app.py, en un proceso aparte para que sus datos no
+  cuenten en la memoria del benchmark,
+- la latencia (media y percentiles) de cada ruta a través del test client de Flask,
+- el pico de memoria residente (RSS) del proceso,
+- el rendimiento (peticiones/s) con varios hilos a la vez; con --url se lanza
+  contra un servidor real (gunicorn, asgi.py...) en lugar del test client.
+
+Los resultados se escriben en JSON (--salida). Con --base se comparan con un
+resultado anterior: se listan las métricas que empeoran más que --tolerancia y
+el proceso termina con código 1 si hay alguna, para poder usarlo en CI.
+
+Ejecutar desde la raíz del proyecto (app.py lee data/ con rutas relativas).
+Las variables de entorno de app.py (USAR_SNAPSHOT, ALMACEN_CORPUS,
+CARGA_COMENTARIOS...) se respetan, así que cada configuración se puede medir por
+separado; la recarga en caliente (INTERVALO_RECARGA_DATOS) se desactiva siempre.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Consultas fijas de /buscar: palabras frecuentes, raras, con tildes, frases y sin resultados
+CONSULTAS_BUSQUEDA = ['dios', 'jesús', 'amor', 'el principio', 'señor amor', 'pan de vida',
+                      'luz', 'e', 'gracia', 'xyzzy', 'bienaventurados', 'jehová']
+
+# Referencias fijas de /referencia, con abreviaturas y rangos
+REFERENCIAS_FIJAS = ['Juan 3:16', 'Génesis 1:1-5', 'S. Juan 1:1', 'Sal 23:1-6', '1 Co 13:4-7',
+                     'Apocalipsis 22:21', 'Romanos 8:28', 'Foo 1:1', 'Juan 1:50-2:5', 'Salmos 119']
+
+# Textos de /sugerir: se pide cada uno de sus prefijos, como al teclearlos
+TEXTOS_SUGERENCIAS = ['1 Co 13:4', 'Sal 23:', 'S. Juan 3:1', 'Apocalipsis', 'bienaventurados',
+                      'jesús', 'pan de vida', 'II Co 5', 'xyzzy']
+
+# Funciones de carga cuyo tiempo se mide por separado
+FUNCIONES_CARGA = ['cargar_biblia', 'cargar_comentarios', 'cargar_comentarios_cba',
+                   'cargar_comentarios_cba2', 'cargar_cba_append']
+
+def medir(funcion, *args):
+    """Ejecuta funcion(*args) y devuelve (resultado, segundos)"""
+    inicio = time.perf_counter()
+    resultado = funcion(*args)
+    return resultado, time.perf_counter() - inicio
+
+def percentil(valores, p):
+    """Percentil p (0-100) por interpolación lineal sobre los valores ordenados"""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    posicion = (len(ordenados) - 1) * p / 100
+    inferior = int(posicion)
+    superior = min(inferior + 1, len(ordenados) - 1)
+    return ordenados[inferior] + (ordenados[superior] - ordenados[inferior]) * (posicion - inferior)
+
+def resumen_latencias(segundos):
+    """Media y percentiles de una lista de latencias, en milisegundos"""
+    ms = [s * 1000 for s in segundos]
+    return {
+        'peticiones': len(ms),
+        'media_ms': round(statistics.fmean(ms), 3),
+        'p50_ms': round(percentil(ms, 50), 3),
+        'p90_ms': round(percentil(ms, 90), 3),
+        'p99_ms': round(percentil(ms, 99), 3),
+        'max_ms': round(max(ms), 3)
+    }
+
+def rss_maximo_mb():
+    """Pico de memoria residente del proceso en MB (None si no se puede medir)"""
+    if resource is None:
+        return None
+    maximo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo da en KB y macOS en bytes
+    return round(maximo / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def importar_app():
+    """Importa app.py (carga de todos los datos) sin su salida por consola"""
+    # Una recarga a mitad de la medición mezclaría sus tiempos y su memoria con los de las rutas
+    os.environ['INTERVALO_RECARGA_DATOS'] = '0'
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app
+    return app
+
+def medir_arranque(app):
+    """Tiempo de cada función de carga, ejecutada de nuevo tras la importación"""
+    tiempos = {}
+    cargados = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for nombre in FUNCIONES_CARGA:
+            cargados[nombre], tiempos[nombre] = medir(getattr(app, nombre))
+
+        almacen, tiempos['construir_almacen_versiculos'] = medir(app.construir_almacen_versiculos,
+                                                                 cargados['cargar_biblia'])
+        indice, tiempos['construir_indice_busqueda'] = medir(app.construir_indice_busqueda, almacen)
+        _, tiempos['construir_sugerencias'] = medir(app.construir_sugerencias, indice)
+        comentarios = {fuente['nombre']: cargados.get(fuente['cargar'].__name__) or fuente['cargar']()
+                       for fuente in app.FUENTES_COMENTARIOS}
+        _, tiempos['construir_tabla_comentarios'] = medir(app.construir_tabla_comentarios, comentarios)
+    return {nombre: round(segundos, 4) for nombre, segundos in tiempos.items()}
+
+def medir_arranque_aparte():
+    """Tiempos de arranque medidos en otro proceso (benchmark.py --solo-arranque)
+
+    medir_arranque vuelve a cargar todos los datos: en este proceso el pico de
+    memoria contaría dos copias.
+    """
+    proceso = subprocess.run([sys.executable, os.path.abspath(__file__), '--solo-arranque'],
+                             stdout=subprocess.PIPE, check=True, text=True)
+    return json.loads(proceso.stdout)
+
+def generar_carga(app, semilla, peticiones):
+    """Peticiones por ruta: las fijas más otras aleatorias reproducibles con la semilla"""
+    aleatorio = random.Random(semilla)
+    versiculos = [(libro, capitulo, versiculo)
+                  for libro, capitulos in app.DATOS['biblia'].items()
+                  for capitulo, versiculos_capitulo in capitulos.items()
+                  for versiculo in versiculos_capitulo]
+    libros = list(app.DATOS['biblia'])
+    if not versiculos:
+        raise SystemExit("No hay versículos cargados: ejecute el benchmark desde la raíz del proyecto")
+
+    def versiculos_al_azar():
+        return [versiculos[aleatorio.randrange(len(versiculos))] for _ in range(peticiones)]
+
+    def referencia_al_azar():
+        libro, capitulo, versiculo = versiculos[aleatorio.randrange(len(versiculos))]
+        if aleatorio.random() < 0.3 and versiculo.isdigit():
+            return f"{libro} {capitulo}:{versiculo}-{int(versiculo) + aleatorio.randint(1, 5)}"
+        return f"{libro} {capitulo}:{versiculo}"
+
+    secciones_cba = [(documento['documento'], seccion['clave'])
+                     for documento in app.indice_cba_append(app.DATOS['cba_append']) for seccion in documento['secciones']]
+
+    cita = urllib.parse.quote
+    tecleos = [texto[:longitud] for texto in TEXTOS_SUGERENCIAS for longitud in range(1, len(texto) + 1)]
+    carga = {
+        'libros': [('GET', '/libros', None)] * peticiones,
+        'capitulos': [('GET', f'/capitulos/{cita(aleatorio.choice(libros))}', None) for _ in range(peticiones)],
+        'versiculos': [('GET', f'/versiculos/{cita(l)}/{c}', None) for l, c, _ in versiculos_al_azar()],
+        'comentarios': [('GET', f'/comentarios/{cita(l)}/{c}/{v}', None) for l, c, v in versiculos_al_azar()],
+        'capitulo': [('GET', f'/capitulo/{cita(l)}/{c}', None) for l, c, _ in versiculos_al_azar()],
+        'citas': [('GET', f'/citas/{cita(l)}/{c}/{v}', None) for l, c, v in versiculos_al_azar()],
+        'buscar': [('GET', '/buscar?' + urllib.parse.urlencode({'q': q}), None)
+                   for q in (CONSULTAS_BUSQUEDA * peticiones)[:peticiones]],
+        'sugerir': [('GET', '/sugerir?' + urllib.parse.urlencode({'q': q}), None)
+                    for q in (tecleos * peticiones)[:peticiones]],
+        'referencia': [('GET', f'/referencia/{cita(r)}', None)
+                       for r in (REFERENCIAS_FIJAS + [referencia_al_azar() for _ in range(peticiones)])[:peticiones]],
+        'referencias': [('POST', '/referencias', {'referencias': [referencia_al_azar() for _ in range(20)]})
+                        for _ in range(max(1, peticiones // 10))],
+        'cba_append': [('GET', '/cba_append', None)] * peticiones,
+        'cba_append_indice': [('GET', '/cba_append/indice', None)] * peticiones,
+        'cba_append_seccion': [('GET', f'/cba_append/{cita(d)}/{cita(s)}', None)
+                               for d, s in (aleatorio.choice(secciones_cba) for _ in range(peticiones))]
+                              if secciones_cba else []
+    }
+    return carga
+
+def pedir_test_client(cliente, metodo, ruta, cuerpo):
+    if metodo == 'POST':
+        return cliente.post(ruta, json=cuerpo).status_code
+    return cliente.get(ruta, headers={'Accept-Encoding': 'gzip'}).status_code
+
+def pedir_url(base, metodo, ruta, cuerpo):
+    datos = json.dumps(cuerpo).encode('utf-8') if cuerpo is not None else None
+    peticion = urllib.request.Request(base + ruta, data=datos, method=metodo,
+                                      headers={'Accept-Encoding': 'gzip', 'Content-Type': 'application/json'})
+    with urllib.request.urlopen(peticion, timeout=30) as respuesta:
+        respuesta.read()
+        return respuesta.status
+
+def medir_latencias(app, carga):
+    """Latencia de cada ruta, una petición tras otra, con el test client de Flask"""
+    cliente = app.app.test_client()
+    resultados = {}
+    for ruta, peticiones in carga.items():
+        tiempos = []
+        errores = 0
+        for metodo, url, cuerpo in peticiones:
+            estado, segundos = medir(pedir_test_client, cliente, metodo, url, cuerpo)
+            tiempos.append(segundos)
+            errores += estado >= 500
+        resultados[ruta] = dict(resumen_latencias(tiempos), errores=errores)
+    return resultados
+
+def medir_rendimiento(app, carga, hilos, duracion, url=None):
+    """Peticiones por segundo de la carga mezclada, con varios hilos durante duracion segundos"""
+    mezcla = [peticion for peticiones in carga.values() for peticion in peticiones]
+    random.Random(0).shuffle(mezcla)
+    fin = time.perf_counter() + duracion
+    contador = iter(range(sys.maxsize))
+    lock = threading.Lock()
+    tiempos = []
+    errores = [0]
+
+    def trabajador():
+        cliente = None if url else app.app.test_client()
+        propios = []
+        while time.perf_counter() < fin:
+            with lock:
+                metodo, ruta, cuerpo = mezcla[next(contador) % len(mezcla)]
+            inicio = time.perf_counter()
+            try:
+                estado = (pedir_url(url, metodo, ruta, cuerpo) if url
+                          else pedir_test_client(cliente, metodo, ruta, cuerpo))
+                fallo = estado >= 500
+            except Exception:
+                fallo = True
+            propios.append(time.perf_counter() - inicio)
+            if fallo:
+                with lock:
+                    errores[0] += 1
+        with lock:
+            tiempos.extend(propios)
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(hilos) as ejecutor:
+        for _ in range(hilos):
+            ejecutor.submit(trabajador)
+    transcurrido = time.perf_counter() - inicio
+
+    return dict(resumen_latencias(tiempos), hilos=hilos, destino=url or 'test_client',
+                peticiones_por_segundo=round(len(tiempos) / transcurrido, 1), errores=errores[0])
+
+def aplanar(datos, prefijo=''):
+    """Métricas numéricas de un resultado como {'ruta.metrica': valor}"""
+    planas = {}
+    for clave, valor in datos.items():
+        nombre = f"{prefijo}{clave}"
+        if isinstance(valor, dict):
+            planas.update(aplanar(valor, nombre + '.'))
+        elif isinstance(valor, (int, float)) and not isinstance(valor, bool):
+            planas[nombre] = valor
+    return planas
+
+def comparar(resultado, base, tolerancia):
+    """Métricas que empeoran más que la tolerancia respecto a la base
+
+    En rendimiento (peticiones/s) empeorar es bajar; en todo lo demás (tiempos,
+    memoria) es subir. Los contadores de peticiones no se comparan.
+    """
+    actuales = aplanar(resultado['metricas'])
+    anteriores = aplanar(base['metricas'])
+    regresiones = []
+    for nombre, anterior in anteriores.items():
+        actual = actuales.get(nombre)
+        if actual is None or not anterior or nombre.endswith(('.peticiones', '.hilos')):
+            continue
+        cambio = (actual - anterior) / anterior
+        if nombre.endswith('peticiones_por_segundo'):
+            cambio = -cambio
+        if cambio > tolerancia:
+            regresiones.append((nombre, anterior, actual, cambio))
+    return regresiones
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark y prueba de carga de la Biblia digital")
+    parser.add_argument('--semilla', type=int, default=1960)
+    parser.add_argument('--peticiones', type=int, default=200, help="peticiones por ruta")
+    parser.add_argument('--hilos', type=int, default=8)
+    parser.add_argument('--duracion', type=float, default=10.0, help="segundos de la prueba de carga")
+    parser.add_argument('--url', help="servidor contra el que lanzar la prueba de carga")
+    parser.add_argument('--salida', help="archivo JSON donde guardar los resultados")
+    parser.add_argument('--base', help="resultado anterior con el que comparar")
+    parser.add_argument('--tolerancia', type=float, default=0.10)
+    parser.add_argument('--solo-arranque', action='store_true', help=argparse.SUPPRESS)
+    argumentos = parser.parse_args()
+
+    if argumentos.solo_arranque:
+        app, segundos_importacion = medir(importar_app)
+        print(json.dumps(dict(medir_arranque(app), importar_app=round(segundos_importacion, 4))))
+        return
+
+    arranque = medir_arranque_aparte()
+    app = importar_app()
+    carga = generar_carga(app, argumentos.semilla, argumentos.peticiones)
+    latencias = medir_latencias(app, carga)
+    rendimiento = medir_rendimiento(app, carga, argumentos.hilos, argumentos.duracion,
+                                    argumentos.url.rstrip('/') if argumentos.url else None)
+
+    resultado = {
+        'fecha': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'entorno': {
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'cpus': os.cpu_count(),
+            'semilla': argumentos.semilla,
+            'configuracion': {v: os.environ[v] for v in ('USAR_SNAPSHOT', 'ALMACEN_CORPUS', 'CARGA_COMENTARIOS',
+                                                        'BUSQUEDA_PROCESOS') if v in os.environ}
+        },
+        'metricas': {
+            'arranque_s': arranque,
+            'latencia': latencias,
+            'rendimiento': rendimiento,
+            'rss_maximo_mb': rss_maximo_mb()
+        }
+    }
+
+    texto = json.dumps(resultado, ensure_ascii=False, indent=2)
+    if argumentos.salida:
+        with open(argumentos.salida, 'w', encoding='utf-8') as f:
+            f.write(texto + '\n')
+    else:
+        print(texto)
+
+    if argumentos.base:
+        with open(argumentos.base, 'r', encoding='utf-8') as f:
+            base = json.load(f)
+        regresiones = comparar(resultado, base, argumentos.tolerancia)
+        for nombre, anterior, actual, cambio in regresiones:
+            print(f"❌ {nombre}: {anterior} -> {actual} ({cambio:+.0%})", file=sys.stderr)
+        if regresiones:
+            sys.exit(1)
+        print(f"✅ Sin regresiones mayores del {argumentos.tolerancia:.0%} respecto a {argumentos.base}",
+              file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""Compila las fuentes JSON de data/ en el snapshot binario que carga app.py
+
+Uso:
+    python compilar_snapshot.py [--mmap] [ruta_destino]
+
+Ejecutar tras cada cambio en data/ (o como paso de despliegue). Si el snapshot
+queda desactualizado, app.py lo detecta y vuelve a cargar desde los JSON.
+
+Con --mmap se genera además el corpus compartido (data/biblia.corpus y su
+snapshot de estructuras). Arrancando con ALMACEN_CORPUS=mmap, los textos de
+versículos y comentarios se leen de ese archivo mapeado en memoria y todos los
+workers comparten una sola copia física:
+
+    ALMACEN_CORPUS=mmap gunicorn -w 8 app:app
+"""
+import argparse
+import os
+
+def main():
+    parser = argparse.ArgumentParser(description="Compila las fuentes JSON de data/ en el snapshot binario que carga app.py")
+    parser.add_argument('destino', nargs='?', help="ruta del snapshot (por defecto, la que lee app.py)")
+    parser.add_argument('--mmap', action='store_true',
+                        help="generar también el corpus compartido para ALMACEN_CORPUS=mmap")
+    argumentos = parser.parse_args()
+
+    # Forzar la carga desde los JSON aunque exista un snapshot anterior
+    os.environ['USAR_SNAPSHOT'] = '0'
+    os.environ['ALMACEN_CORPUS'] = 'memoria'
+    os.environ['CARGA_COMENTARIOS'] = 'completa'
+    os.environ['INTERVALO_RECARGA_DATOS'] = '0'
+
+    import app
+
+    app.guardar_snapshot(app.DATOS, argumentos.destino)
+    if argumentos.mmap:
+        app.guardar_corpus(app.DATOS)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Datos de prueba para app.py: una Biblia pequeña en un data/ temporal"""
+import json
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Versículos por capítulo: los capítulos de Juan tienen distinto tamaño para
+# que los tramos que cruzan capítulos no caigan en posiciones regulares
+BIBLIA_PRUEBA = {
+    'Génesis': {
+        str(capitulo): {
+            str(versiculo): f"Génesis {capitulo}:{versiculo} {'Jesús' if versiculo % 3 == 0 else 'jesus'} "
+                            f"{'amor' if versiculo % 2 else 'luz'}"
+            for versiculo in range(1, 6)
+        }
+        for capitulo in range(1, 4)
+    },
+    'Juan': {
+        str(capitulo): {
+            str(versiculo): f"Juan {capitulo}:{versiculo} {'amor de Dios' if versiculo % 2 else 'paz'}"
+            for versiculo in range(1, 6 + capitulo)
+        }
+        for capitulo in range(1, 4)
+    }
+}
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    """app.py importado con BIBLIA_PRUEBA (el resto de data/ no existe: sin comentarios)"""
+    raiz = tmp_path_factory.mktemp('biblia')
+    (raiz / 'data').mkdir()
+    with open(raiz / 'data' / 'RV1960.json', 'w', encoding='utf-8') as f:
+        json.dump(BIBLIA_PRUEBA, f, ensure_ascii=False)
+
+    directorio = os.getcwd()
+    os.chdir(raiz)
+    try:
+        with mock.patch.dict(os.environ, USAR_SNAPSHOT='0', ALMACEN_CORPUS='memoria',
+                             BUSQUEDA_PROCESOS='0', INTERVALO_RECARGA_DATOS='0'):
+            import app
+        yield app
+    finally:
+        os.chdir(directorio)
+
+@pytest.fixture
+def cliente(app):
+    return app.app.test_client()
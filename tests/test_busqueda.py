@@ -0,0 +1,105 @@
+"""Búsqueda canónica, paginación y tramos de versículos sobre BIBLIA_PRUEBA"""
+import json
+
+import pytest
+
+from conftest import BIBLIA_PRUEBA
+
+CONSULTAS = ['jesus', 'Jesús', 'amor', 'amor de dios', 'sus', 'jesus luz', 'juan', 'paz', 'xyzzy']
+
+def recorrido_lineal(app, consulta):
+    """(libro, capítulo, versículo) que contienen la consulta, recorriendo la Biblia en orden"""
+    termino = app.plegar_acentos(consulta)
+    return [(libro, capitulo, versiculo)
+            for libro, capitulos in BIBLIA_PRUEBA.items()
+            for capitulo, versiculos in capitulos.items()
+            for versiculo, texto in versiculos.items()
+            if termino in app.plegar_acentos(texto)]
+
+def ubicaciones(resultados):
+    return [(r['libro'], r['capitulo'], r['versiculo']) for r in resultados]
+
+def paginas(cliente, consulta, limite, formato=None):
+    """Todas las páginas de /buscar?orden=canonico siguiendo el cursor de cada una"""
+    parametros = {'q': consulta, 'orden': 'canonico', 'limit': limite}
+    if formato:
+        parametros['formato'] = formato
+    resultado = []
+    while True:
+        respuesta = cliente.get('/buscar', query_string=parametros)
+        assert respuesta.status_code == 200
+        if formato == 'ndjson':
+            *lineas, final = [json.loads(linea) for linea in respuesta.data.decode('utf-8').splitlines()]
+            cursor = final['cursor_siguiente']
+        else:
+            lineas = respuesta.get_json()
+            cursor = respuesta.headers.get('X-Cursor-Siguiente')
+        assert len(lineas) <= limite
+        resultado.extend(lineas)
+        if cursor is None:
+            return resultado
+        parametros['cursor'] = cursor
+
+@pytest.mark.parametrize('consulta', CONSULTAS)
+def test_canonico_coincide_con_recorrido_lineal(app, cliente, consulta):
+    respuesta = cliente.get('/buscar', query_string={'q': consulta, 'orden': 'canonico'})
+    assert ubicaciones(respuesta.get_json()) == recorrido_lineal(app, consulta)
+    assert 'X-Cursor-Siguiente' not in respuesta.headers
+
+@pytest.mark.parametrize('formato', [None, 'ndjson'])
+@pytest.mark.parametrize('limite', [1, 2, 5])
+@pytest.mark.parametrize('consulta', ['jesus', 'amor', 'juan'])
+def test_paginas_concatenadas(app, cliente, consulta, limite, formato):
+    assert ubicaciones(paginas(cliente, consulta, limite, formato)) == recorrido_lineal(app, consulta)
+
+def test_cursor_de_la_ultima_pagina_llena(cliente):
+    # Juan tiene 6 + 7 + 8 versículos: con páginas de 7 la tercera es la última
+    respuesta = cliente.get('/buscar', query_string={'q': 'juan', 'orden': 'canonico', 'limit': 7})
+    primera = respuesta.get_json()
+    assert ubicaciones(primera)[-1] == ('Juan', '2', '1')
+    cursor = respuesta.headers['X-Cursor-Siguiente']
+
+    respuesta = cliente.get('/buscar', query_string={'q': 'juan', 'orden': 'canonico', 'limit': 14, 'cursor': cursor})
+    assert len(respuesta.get_json()) == 14
+    assert 'X-Cursor-Siguiente' not in respuesta.headers
+
+def textos_tramo(app, *args):
+    almacen = app.DATOS['almacen_versiculos']
+    inicio, fin = app.tramo_versiculos(almacen, *args)
+    return [app.texto_corpus(texto) for texto in almacen['textos'][inicio:fin]]
+
+def test_tramo_versiculos_cruza_capitulos(app):
+    assert textos_tramo(app, 'Juan', '1', 5, '3', 2) == [
+        'Juan 1:5 amor de Dios', 'Juan 1:6 paz',
+        *(BIBLIA_PRUEBA['Juan']['2'][str(v)] for v in range(1, 8)),
+        'Juan 3:1 amor de Dios', 'Juan 3:2 paz']
+
+def test_tramo_versiculos_capitulos_enteros_y_limites(app):
+    assert textos_tramo(app, 'Juan', '2') == list(BIBLIA_PRUEBA['Juan']['2'].values())
+    assert textos_tramo(app, 'Juan', '2', None, '3') == (list(BIBLIA_PRUEBA['Juan']['2'].values())
+                                                         + list(BIBLIA_PRUEBA['Juan']['3'].values()))
+    # Los números que el capítulo no tiene acotan el tramo
+    assert textos_tramo(app, 'Juan', '1', 5, None, 40) == ['Juan 1:5 amor de Dios', 'Juan 1:6 paz']
+    assert textos_tramo(app, 'Juan', '1', 40, None, 50) == []
+    assert app.tramo_versiculos(app.DATOS['almacen_versiculos'], 'Juan', '1', 1, '4', 1) is None
+
+def test_referencia_que_cruza_capitulos(cliente):
+    respuesta = cliente.get('/referencia/Juan 1:5-2:2').get_json()
+    assert respuesta['capitulo_fin'] == '2'
+    assert respuesta['texto'].splitlines() == ['1:5. Juan 1:5 amor de Dios', '1:6. Juan 1:6 paz',
+                                               '2:1. Juan 2:1 amor de Dios', '2:2. Juan 2:2 paz']
+
+def test_claves_cita(app):
+    biblia = app.DATOS['biblia']
+    assert app.claves_cita('Juan 1:6-2:1', biblia) == [('Juan', '1', '6'), ('Juan', '2', '1')]
+    assert app.claves_cita('Juan 1:2, 4', biblia) == [('Juan', '1', '2'), ('Juan', '1', '4')]
+    assert app.claves_cita('Juan 3', biblia) == [('Juan', '3', str(v)) for v in range(1, 9)]
+    assert app.claves_cita('Foo 1:1', biblia) == []
+
+def test_referencia_acotada_al_capitulo(cliente):
+    # Los números que faltan se rellenan sólo hasta el último versículo del capítulo
+    respuesta = cliente.get('/referencia/Juan 1:5-1000000').get_json()
+    assert respuesta['texto'].splitlines() == ['5. Juan 1:5 amor de Dios', '6. Juan 1:6 paz']
+    completo = cliente.get('/referencia/Juan 1:2-6').get_json()['texto']
+    assert cliente.get('/referencia/Juan 1:2-1000000').get_json()['texto'] == completo
+    assert 'error' in cliente.get('/referencia/Juan 1:40-1000000').get_json()